@@ -0,0 +1,601 @@
+# Copyright 2023 Aditya Mohan
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Headless batch extraction engine and command line interface
+"""
+
+import argparse
+import csv
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from typing import Optional
+
+from cache import DiskCache
+from compaction import TextCompactor
+from image import ImagePreprocessor
+from llm import LLM, ExtractionCache, DEFAULT_MODEL
+from ocr_client import OCRClient
+from pipeline import PipelineExecutor, PipelineStage
+from rules import RuleExtractor
+from scheduler import RateScheduler
+from utils import build_schema, ocr_file
+
+SUPPORTED_EXTENSIONS = (".pdf", ".jpg", ".png")
+logger = logging.getLogger(__name__)
+
+
+def load_schema(path: str) -> dict:
+    """Loads a schema file
+
+    The file either holds a schema as built by `build_schema` or a list of
+    fields such as `[{"field": "total", "dtype": "integer", "required": true}]`.
+
+    Args:
+        path (str): Path of the JSON schema file
+
+    Returns:
+        dict: Schema to be processed
+    """
+    with open(path, encoding="utf-8") as f:
+        spec = json.load(f)
+
+    if isinstance(spec, dict) and "properties" in spec:
+        spec.setdefault("required", [])
+        return spec
+
+    return build_schema(
+        field_values=[field["field"] for field in spec],
+        dtype_values=[field.get("dtype", "string") for field in spec],
+        required=[field.get("required", False) for field in spec],
+    )
+
+
+def discover_documents(source: str) -> list:
+    """Lists the documents of a batch
+
+    Args:
+        source (str): Directory that is searched recursively, or a manifest
+            file with one document path per line. Relative paths in a
+            manifest are resolved against the manifest's directory.
+
+    Returns:
+        list: Document paths in a stable order
+    """
+    if os.path.isdir(source):
+        documents = []
+        for root, _, names in os.walk(source):
+            for name in names:
+                if name.lower().endswith(SUPPORTED_EXTENSIONS):
+                    documents.append(os.path.join(root, name))
+        return sorted(documents)
+
+    base = os.path.dirname(os.path.abspath(source))
+    documents = []
+    with open(source, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            documents.append(line if os.path.isabs(line) else os.path.join(base, line))
+    return documents
+
+
+class ResultWriter:
+    """Streams extraction results to JSONL, CSV or Parquet
+
+    JSONL gets one line per document, CSV and Parquet one row per extracted
+    entity. Existing JSONL and CSV outputs are appended to unless
+    `overwrite` is set. Parquet files cannot be appended to and are only
+    readable once closed, so a Parquet output is a directory of part files,
+    each holding up to `part_documents` documents and written in one go.
+    `write` and `close` return the documents whose results are durable, which
+    are the ones that may be checkpointed.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        fields: list,
+        fmt: Optional[str] = None,
+        overwrite: bool = False,
+        part_documents: int = 100,
+    ) -> None:
+        """
+        Args:
+            path (str): Output location
+            fields (list): Schema fields, used as CSV and Parquet columns
+            fmt (str, optional): One of jsonl, csv or parquet. Inferred from
+                the extension of `path` when not given.
+            overwrite (bool): Discard the results of earlier runs
+            part_documents (int): Documents per Parquet part file
+        """
+        self.path = path
+        self.fields = list(fields)
+        self.fmt = fmt or os.path.splitext(path)[1].lstrip(".").lower() or "jsonl"
+        self.columns = ["document"] + self.fields
+        self.part_documents = part_documents
+        self._file = None
+        mode = "w" if overwrite else "a"
+
+        if self.fmt == "jsonl":
+            self._file = open(path, mode, encoding="utf-8")
+        elif self.fmt == "csv":
+            new_file = (
+                overwrite or not os.path.exists(path) or os.path.getsize(path) == 0
+            )
+            self._file = open(path, mode, encoding="utf-8", newline="")
+            self._csv = csv.DictWriter(
+                self._file, fieldnames=self.columns, extrasaction="ignore"
+            )
+            if new_file:
+                self._csv.writeheader()
+        elif self.fmt == "parquet":
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            os.makedirs(path, exist_ok=True)
+            for name in os.listdir(path):
+                # Parts of a crashed run that were never completed
+                if name.endswith(".tmp") or (overwrite and name.endswith(".parquet")):
+                    os.remove(os.path.join(path, name))
+            self._pa = pa
+            self._pq = pq
+            self._schema = pa.schema([(column, pa.string()) for column in self.columns])
+            self._rows = []
+            self._buffered = []
+        else:
+            raise ValueError(f"Unsupported output format: {self.fmt}")
+
+    def write(self, document: str, output: list) -> list:
+        """Writes the entities extracted from a document
+
+        Args:
+            document (str): Document path
+            output (list): Extracted entities
+
+        Returns:
+            list: Documents whose results are now durable, for Parquet the
+            documents of a completed part file
+        """
+        if self.fmt == "jsonl":
+            self._file.write(json.dumps(dict(document=document, output=output)) + "\n")
+            self._file.flush()
+            return [document]
+
+        rows = [dict(entity, document=document) for entity in output]
+        if self.fmt == "csv":
+            self._csv.writerows(rows)
+            self._file.flush()
+            return [document]
+
+        self._rows.extend(rows)
+        self._buffered.append(document)
+        if len(self._buffered) >= self.part_documents:
+            return self._write_part()
+        return []
+
+    def _write_part(self) -> list:
+        if not self._buffered:
+            return []
+        columns = {
+            column: [
+                None if row.get(column) is None else str(row[column])
+                for row in self._rows
+            ]
+            for column in self.columns
+        }
+        part = len([n for n in os.listdir(self.path) if n.endswith(".parquet")])
+        path = os.path.join(self.path, f"part-{part:05d}.parquet")
+        self._pq.write_table(
+            self._pa.Table.from_pydict(columns, schema=self._schema), path + ".tmp"
+        )
+        os.replace(path + ".tmp", path)
+        documents, self._rows, self._buffered = self._buffered, [], []
+        return documents
+
+    def close(self) -> list:
+        """Flushes and closes the output
+
+        Returns:
+            list: Documents whose results became durable
+        """
+        if self._file is not None:
+            self._file.close()
+            return []
+        return self._write_part()
+
+
+class Checkpoint:
+    """Append-only record of the documents a batch has finished
+
+    A document is recorded only after its results were written, so a crashed
+    run resumes by skipping every recorded document. Documents that finished
+    between the last write and the crash are processed again.
+    """
+
+    def __init__(self, path: str) -> None:
+        """
+        Args:
+            path (str): Location of the checkpoint file
+        """
+        self.path = path
+        self.done = set()
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Partially written last line of a crashed run
+                        continue
+                    if record.get("status") == "done":
+                        self.done.add(record["document"])
+
+        self._file = open(path, "a", encoding="utf-8")
+
+    def record(self, document: str, status: str) -> None:
+        """Records the outcome of a document
+
+        Args:
+            document (str): Document path
+            status (str): Either done or failed
+        """
+        self._file.write(json.dumps(dict(document=document, status=status)) + "\n")
+        self._file.flush()
+        if status == "done":
+            self.done.add(document)
+
+    def close(self) -> None:
+        """Closes the checkpoint file"""
+        self._file.close()
+
+
+class BatchExtractor:
+    """Runs OCR and extraction over a batch of documents without Streamlit"""
+
+    def __init__(
+        self,
+        llm: LLM,
+        schema: dict,
+        base_url: str,
+        pdf_endpoint: str = "ocr_pdf",
+        img_endpoint: str = "ocr_image",
+        ocr_cache: Optional[DiskCache] = None,
+        ocr_workers: int = 4,
+        llm_workers: int = 2,
+        split_pages: bool = False,
+        page_workers: int = 4,
+        client: Optional[OCRClient] = None,
+        text_layer: bool = True,
+        preprocessor: Optional[ImagePreprocessor] = None,
+        compactor: Optional[TextCompactor] = None,
+    ) -> None:
+        """
+        Args:
+            llm (LLM): Extraction model
+            schema (dict): Schema to be processed
+            base_url (str): Host and port of the OCR service
+            pdf_endpoint (str): OCR endpoint used for PDF files
+            img_endpoint (str): OCR endpoint used for images
+            ocr_cache (DiskCache, optional): Store for OCR results
+            ocr_workers (int): Maximum number of concurrent OCR calls
+            llm_workers (int): Maximum number of concurrent extraction calls
+            split_pages (bool): OCR the pages of PDF files individually
+            page_workers (int): Maximum number of concurrent page OCR calls
+            client (OCRClient, optional): Client used to call the OCR service
+            text_layer (bool): Read the text layer of born-digital PDF pages
+                locally instead of sending them to the OCR service
+            preprocessor (ImagePreprocessor, optional): Shrinks images before
+                they are sent to the OCR service
+            compactor (TextCompactor, optional): Compacts the OCR text before
+                extraction
+        """
+        self.llm = llm
+        self.schema = schema
+        self.base_url = base_url
+        self.pdf_endpoint = pdf_endpoint
+        self.img_endpoint = img_endpoint
+        self.ocr_cache = ocr_cache
+        self.ocr_workers = ocr_workers
+        self.llm_workers = llm_workers
+        self.split_pages = split_pages
+        self.page_workers = page_workers
+        self.text_layer = text_layer
+        self.preprocessor = preprocessor
+        self.compactor = compactor
+        self.client = client or OCRClient(pool_size=ocr_workers * page_workers)
+        self.tokens_before = 0
+        self.tokens_after = 0
+        self._lock = threading.Lock()
+
+    def _ocr(self, document: str) -> Optional[dict]:
+        try:
+            with open(document, "rb") as f:
+                return ocr_file(
+                    file_name=os.path.basename(document),
+                    file_obj=f,
+                    base_url=self.base_url,
+                    pdf_endpoint=self.pdf_endpoint,
+                    img_endpoint=self.img_endpoint,
+                    cache=self.ocr_cache,
+                    split_pages=self.split_pages,
+                    page_workers=self.page_workers,
+                    client=self.client,
+                    text_layer=self.text_layer,
+                    preprocessor=self.preprocessor,
+                )
+        except Exception:
+            logger.exception("OCR of %s failed", document)
+            return None
+
+    def _extract(self, resp_json: dict) -> Optional[list]:
+        try:
+            text = resp_json["text"]
+            if self.compactor is not None:
+                text, stats = self.compactor.compact(text)
+                with self._lock:
+                    self.tokens_before += stats["tokens_before"]
+                    self.tokens_after += stats["tokens_after"]
+            return self.llm.analyze_text(text, schema=self.schema)
+        except Exception:
+            logger.exception("Extraction failed")
+            return None
+
+    def run(
+        self, documents: list, writer: ResultWriter, checkpoint: Checkpoint
+    ) -> dict:
+        """Processes every document that is not yet in the checkpoint
+
+        Args:
+            documents (list): Document paths
+            writer (ResultWriter): Receives results as documents finish
+            checkpoint (Checkpoint): Finished documents of earlier runs
+
+        Returns:
+            dict: Throughput summary of the run
+        """
+        pending = [doc for doc in documents if doc not in checkpoint.done]
+        summary = dict(
+            documents=len(documents),
+            skipped=len(documents) - len(pending),
+            done=0,
+            failed=0,
+            entities=0,
+            text_layer_pages=0,
+            ocr_pages=0,
+            image_bytes_saved=0,
+        )
+
+        def on_event(idx: int, stage: PipelineStage, result) -> None:
+            document = pending[idx]
+            if stage is PipelineStage.OCR and result is not None:
+                metadata = result.get("metadata", {})
+                summary["text_layer_pages"] += metadata.get("text_layer_pages", 0)
+                summary["ocr_pages"] += metadata.get("ocr_pages", 0)
+                image = metadata.get("image")
+                if image:
+                    summary["image_bytes_saved"] += (
+                        image["original_bytes"] - image["bytes"]
+                    )
+                return
+
+            if result is None:
+                summary["failed"] += 1
+                checkpoint.record(document, "failed")
+                print(f"failed: {document}", file=sys.stderr)
+                return
+
+            for written in writer.write(document, result):
+                checkpoint.record(written, "done")
+            summary["done"] += 1
+            summary["entities"] += len(result)
+
+        start = time.perf_counter()
+        PipelineExecutor(
+            ocr_fn=self._ocr,
+            extract_fn=self._extract,
+            ocr_workers=self.ocr_workers,
+            llm_workers=self.llm_workers,
+        ).run(pending, on_event=on_event)
+        elapsed = time.perf_counter() - start
+
+        summary["seconds"] = elapsed
+        summary["documents_per_second"] = (
+            (summary["done"] + summary["failed"]) / elapsed if elapsed else 0.0
+        )
+        if self.ocr_cache is not None:
+            summary["ocr_cache"] = self.ocr_cache.stats()
+        if self.compactor is not None:
+            summary["compaction_tokens"] = dict(
+                before=self.tokens_before, after=self.tokens_after
+            )
+        summary["openai"] = self.llm.scheduler.stats()
+        summary["usage"] = self.llm.usage()
+        if self.llm.rules is not None:
+            summary["rules"] = self.llm.rules.stats()
+        summary["ocr_latency"] = {
+            endpoint: dict(count=h["count"], sum=h["sum"])
+            for endpoint, h in self.client.latency_histograms().items()
+        }
+        return summary
+
+
+def main(argv: Optional[list] = None) -> int:
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(
+        description="Extract structured information from a batch of documents"
+    )
+    parser.add_argument("input", help="Directory of PDFs/images or a manifest file")
+    parser.add_argument("--schema", required=True, help="JSON schema file")
+    parser.add_argument(
+        "--output", required=True, help="Output path (.jsonl, .csv or .parquet)"
+    )
+    parser.add_argument("--format", choices=["jsonl", "csv", "parquet"])
+    parser.add_argument(
+        "--ocr-url",
+        default=os.environ.get("OCR_URL"),
+        help="Host and port of the OCR service, e.g. http://localhost:8000",
+    )
+    parser.add_argument("--pdf-endpoint", default="ocr_pdf")
+    parser.add_argument("--img-endpoint", default="ocr_image")
+    parser.add_argument(
+        "--openai-api-key", default=os.environ.get("OPENAI_API_KEY", "")
+    )
+    parser.add_argument("--model", default=DEFAULT_MODEL)
+    parser.add_argument(
+        "--escalate-to",
+        action="append",
+        default=[],
+        help="Model used when the output of the previous one misses required "
+        "fields or has the wrong types, repeatable",
+    )
+    parser.add_argument("--temperature", type=float, default=0.0)
+    parser.add_argument("--ocr-workers", type=int, default=4)
+    parser.add_argument("--llm-workers", type=int, default=2)
+    parser.add_argument(
+        "--split-pages",
+        action="store_true",
+        help="OCR and cache the pages of PDFs individually",
+    )
+    parser.add_argument("--page-workers", type=int, default=4)
+    parser.add_argument(
+        "--no-text-layer",
+        action="store_true",
+        help="Send every PDF page to the OCR service, even born-digital ones",
+    )
+    parser.add_argument(
+        "--no-image-preprocessing",
+        action="store_true",
+        help="Upload images to the OCR service as they are",
+    )
+    parser.add_argument("--image-max-edge", type=int, default=2000)
+    parser.add_argument("--max-chunk-tokens", type=int, default=2500)
+    parser.add_argument(
+        "--retrieval-tokens",
+        type=int,
+        default=0,
+        help="Send only the passages of long documents that are relevant to the "
+        "schema, within this token budget; 0 sends the full text",
+    )
+    parser.add_argument(
+        "--no-compaction",
+        action="store_true",
+        help="Send the OCR text to the LLM without compacting it",
+    )
+    parser.add_argument(
+        "--boilerplate",
+        action="append",
+        default=[],
+        help="Regular expression of lines to drop before extraction, repeatable",
+    )
+    parser.add_argument(
+        "--no-rules",
+        action="store_true",
+        help="Send every field to the LLM instead of resolving simple ones first",
+    )
+    parser.add_argument(
+        "--rpm", type=float, help="OpenAI requests per minute of the key"
+    )
+    parser.add_argument("--tpm", type=float, help="OpenAI tokens per minute of the key")
+    parser.add_argument("--ocr-cache", default=".cache/ocr.sqlite3")
+    parser.add_argument(
+        "--checkpoint", help="Checkpoint file, defaults to <output>.checkpoint"
+    )
+    parser.add_argument(
+        "--no-resume",
+        action="store_true",
+        help="Start over, discarding the checkpoint and output of a previous run",
+    )
+    args = parser.parse_args(argv)
+
+    if not args.ocr_url:
+        parser.error("--ocr-url or the OCR_URL environment variable is required")
+    if not args.openai_api_key:
+        parser.error(
+            "--openai-api-key or the OPENAI_API_KEY environment variable is required"
+        )
+
+    schema = load_schema(args.schema)
+    documents = discover_documents(args.input)
+
+    checkpoint_path = args.checkpoint or args.output.rstrip("/") + ".checkpoint"
+    if args.no_resume and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    llm = LLM(
+        temperature=args.temperature,
+        openai_api_key=args.openai_api_key,
+        model_name=args.model,
+        escalation_models=args.escalate_to,
+        cache=ExtractionCache(),
+        max_chunk_tokens=args.max_chunk_tokens,
+        retrieval_tokens=args.retrieval_tokens or None,
+        rules=None if args.no_rules else RuleExtractor(),
+        scheduler=RateScheduler(rpm=args.rpm, tpm=args.tpm),
+        tenant="batch",
+    )
+    extractor = BatchExtractor(
+        llm=llm,
+        schema=schema,
+        base_url=args.ocr_url.rstrip("/"),
+        pdf_endpoint=args.pdf_endpoint,
+        img_endpoint=args.img_endpoint,
+        ocr_cache=DiskCache(path=args.ocr_cache) if args.ocr_cache else None,
+        ocr_workers=args.ocr_workers,
+        llm_workers=args.llm_workers,
+        split_pages=args.split_pages,
+        page_workers=args.page_workers,
+        text_layer=not args.no_text_layer,
+        preprocessor=(
+            None
+            if args.no_image_preprocessing
+            else ImagePreprocessor(max_long_edge=args.image_max_edge)
+        ),
+        compactor=(
+            None if args.no_compaction else TextCompactor(boilerplate=args.boilerplate)
+        ),
+    )
+
+    writer = ResultWriter(
+        args.output,
+        fields=list(schema["properties"]),
+        fmt=args.format,
+        overwrite=args.no_resume,
+    )
+    checkpoint = Checkpoint(checkpoint_path)
+    try:
+        summary = extractor.run(documents, writer, checkpoint)
+    finally:
+        for document in writer.close():
+            checkpoint.record(document, "done")
+        checkpoint.close()
+
+    print(
+        f"{summary['done']} done, {summary['failed']} failed, "
+        f"{summary['skipped']} skipped of {summary['documents']} documents, "
+        f"{summary['entities']} entities in {summary['seconds']:.1f}s "
+        f"({summary['documents_per_second']:.2f} documents/s)",
+        file=sys.stderr,
+    )
+    print(json.dumps(summary))
+    return 0 if summary["failed"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
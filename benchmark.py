@@ -0,0 +1,474 @@
+# Copyright 2023 Aditya Mohan
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Reproducible performance benchmark of the analysis pipeline
+
+Drives the same code paths as the TEXT_ANALYZE stage against a local stub OCR
+server and a fake chat model, both with configurable latency and failure
+profiles, so that runs are comparable without network access or API costs.
+
+The corpus is built from its own seeded generator, so a given `--seed` always
+yields the same documents. The latency and failure draws are taken by the
+server and worker threads in scheduling order and are not repeatable. The
+documents are random bytes named .pdf or .png and are sent to the OCR service
+as is, with the PDF text layer and the image preprocessor turned off, so those
+paths are not covered by the benchmark.
+"""
+
+import argparse
+import hashlib
+import http.server
+import io
+import json
+import math
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from typing import Any, List, Optional
+
+from langchain.chat_models.base import BaseChatModel
+from langchain.schema import AIMessage, ChatGeneration, ChatResult
+
+from cache import DiskCache
+from llm import LLM, ClientPool, ExtractionCache
+from ocr_client import OCRClient
+from pipeline import PipelineExecutor
+from utils import build_schema, generate_hash, ocr_file
+
+STAGES = ("hash", "ocr", "schema", "extract")
+FIELDS = (("invoice_number", "string"), ("total", "integer"), ("vendor", "string"))
+
+_random = random.Random()
+_random_lock = threading.Lock()
+
+
+def _uniform(low: float, high: float) -> float:
+    with _random_lock:
+        return _random.uniform(low, high)
+
+
+def _sleep(latency: float, jitter: float) -> None:
+    time.sleep(max(0.0, latency + _uniform(-jitter, jitter)))
+
+
+def synthetic_text(seed: bytes, chars: int) -> str:
+    """Invoice-like OCR text derived deterministically from a seed
+
+    Args:
+        seed (bytes): Seed, e.g. the uploaded file
+        chars (int): Approximate length of the text
+
+    Returns:
+        str: Text with one page break per 2000 characters
+    """
+    digest = hashlib.sha256(seed).hexdigest()
+    header = (
+        f"Invoice number {digest[:8].upper()}\n"
+        f"Vendor {digest[8:14]} Supplies\n"
+        f"Total {int(digest[14:20], 16) % 10000}\n\n"
+    )
+    filler = []
+    size = len(header)
+    line = 0
+    while size < chars:
+        paragraph = (
+            f"Item {line} {digest[line % 56 : line % 56 + 8]} quantity {line % 7}"
+        )
+        filler.append(paragraph + ("\f" if line % 40 == 39 else "\n\n"))
+        size += len(paragraph) + 2
+        line += 1
+
+    return header + "".join(filler)
+
+
+class StubOCRServer:
+    """Local HTTP server that imitates the OCR service"""
+
+    def __init__(
+        self,
+        latency: float = 0.2,
+        jitter: float = 0.0,
+        failure_rate: float = 0.0,
+        text_chars: int = 2000,
+    ) -> None:
+        """
+        Args:
+            latency (float): Mean response time in seconds
+            jitter (float): Maximum deviation from the mean in seconds
+            failure_rate (float): Share of requests answered with a 503
+            text_chars (int): Length of the returned text
+        """
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self) -> None:
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                _sleep(server.latency, server.jitter)
+                server.requests += 1
+
+                if _uniform(0, 1) < server.failure_rate:
+                    self.send_response(503)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+
+                out = json.dumps(
+                    dict(text=synthetic_text(body, server.text_chars))
+                ).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(out)))
+                self.end_headers()
+                self.wfile.write(out)
+
+            def log_message(self, *args) -> None:
+                pass
+
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.text_chars = text_chars
+        self.requests = 0
+        self._httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        """Host and port of the server"""
+        host, port = self._httpd.server_address
+        return f"http://{host}:{port}"
+
+    def __enter__(self) -> "StubOCRServer":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+class FakeExtractionModel(BaseChatModel):
+    """Chat model that answers extraction function calls locally
+
+    Values are derived from the passage so that results are deterministic,
+    and token usage is reported the way the OpenAI models report it.
+    """
+
+    latency: float = 0.5
+    jitter: float = 0.0
+    failure_rate: float = 0.0
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-extraction"
+
+    def _generate(
+        self,
+        messages: List[Any],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[Any] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        _sleep(self.latency, self.jitter)
+        if _uniform(0, 1) < self.failure_rate:
+            raise RuntimeError("Simulated chat model failure")
+
+        function = kwargs["functions"][0]
+        items = function["parameters"]["properties"]["info"]["items"]
+        passage = messages[-1].content
+        digest = hashlib.sha256(passage.encode("utf-8")).hexdigest()
+
+        entity = {}
+        for idx, (field, spec) in enumerate(items["properties"].items()):
+            chunk = digest[idx * 6 : idx * 6 + 6]
+            entity[field] = int(chunk, 16) if spec["type"] == "integer" else chunk
+
+        arguments = json.dumps(dict(info=[entity]))
+        prompt_tokens = sum(len(str(m.content)) for m in messages) // 4
+        completion_tokens = len(arguments) // 4
+        return ChatResult(
+            generations=[
+                ChatGeneration(
+                    message=AIMessage(
+                        content="",
+                        additional_kwargs=dict(
+                            function_call=dict(
+                                name=function["name"], arguments=arguments
+                            )
+                        ),
+                    )
+                )
+            ],
+            llm_output=dict(
+                token_usage=dict(
+                    prompt_tokens=prompt_tokens,
+                    completion_tokens=completion_tokens,
+                    total_tokens=prompt_tokens + completion_tokens,
+                ),
+                model_name="fake-extraction",
+            ),
+        )
+
+
+def build_corpus(
+    size: int, doc_kb: int, duplicate_ratio: float, rng: random.Random
+) -> list:
+    """Synthetic uploads, a share of which repeat earlier documents
+
+    Args:
+        size (int): Number of documents
+        doc_kb (int): Size of every document in KiB
+        duplicate_ratio (float): Share of documents that repeat an earlier one
+        rng (Random): Generator the documents are drawn from
+
+    Returns:
+        list: (file_name, file_bytes) tuples
+    """
+    corpus = []
+    for idx in range(size):
+        if corpus and rng.random() < duplicate_ratio:
+            _, data = corpus[rng.randrange(len(corpus))]
+        else:
+            data = bytes(rng.randrange(256) for _ in range(64)) * (doc_kb * 16)
+        extension = "pdf" if idx % 2 == 0 else "png"
+        corpus.append((f"doc_{idx}.{extension}", data))
+    return corpus
+
+
+def percentile(values: list, q: float) -> Optional[float]:
+    """Nearest-rank percentile
+
+    Args:
+        values (list): Observations
+        q (float): Percentile between 0 and 100
+
+    Returns:
+        Optional[float]: Percentile or None without observations
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, math.ceil(q / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def _delta(before: dict, after: dict) -> dict:
+    hits = after["hits"] - before["hits"]
+    misses = after["misses"] - before["misses"]
+    return dict(
+        hits=hits,
+        misses=misses,
+        hit_ratio=hits / (hits + misses) if hits + misses else 0.0,
+    )
+
+
+def run_configuration(
+    corpus: list, concurrency: int, server: StubOCRServer, args, workdir: str
+) -> list:
+    """Runs a cold and a warm pass over a corpus
+
+    Args:
+        corpus (list): Documents built by `build_corpus`
+        concurrency (int): Number of OCR and extraction workers
+        server (StubOCRServer): Running stub OCR service
+        args (Namespace): Benchmark settings
+        workdir (str): Directory for the caches of this configuration
+
+    Returns:
+        list: One result per pass
+    """
+    ocr_cache = DiskCache(path=os.path.join(workdir, "ocr.sqlite3"))
+    extraction_cache = ExtractionCache()
+    pool = ClientPool(
+        factory=lambda *_: FakeExtractionModel(
+            latency=args.llm_latency,
+            jitter=args.llm_jitter,
+            failure_rate=args.llm_failure_rate,
+        )
+    )
+    llm = LLM(
+        temperature=0.0,
+        openai_api_key="benchmark",
+        cache=extraction_cache,
+        max_chunk_tokens=args.max_chunk_tokens,
+        pool=pool,
+    )
+    client = OCRClient(pool_size=concurrency * 2, backoff_base=args.backoff_base)
+
+    results = []
+    for pass_name in ("cold", "warm"):
+        timings = {stage: [] for stage in STAGES}
+        errors = dict(ocr=0, extract=0)
+        lock = threading.Lock()
+
+        def record(stage: str, start: float) -> None:
+            with lock:
+                timings[stage].append(time.perf_counter() - start)
+
+        def ocr(document: tuple) -> Optional[dict]:
+            file_name, data = document
+            start = time.perf_counter()
+            generate_hash(data)
+            record("hash", start)
+
+            start = time.perf_counter()
+            resp_json = ocr_file(
+                file_name=file_name,
+                file_obj=io.BytesIO(data),
+                base_url=server.base_url,
+                pdf_endpoint="ocr_pdf",
+                img_endpoint="ocr_image",
+                cache=ocr_cache,
+                client=client,
+            )
+            record("ocr", start)
+            if resp_json is None:
+                with lock:
+                    errors["ocr"] += 1
+            return resp_json
+
+        def extract(resp_json: dict) -> Optional[list]:
+            start = time.perf_counter()
+            schema = build_schema(
+                field_values=[field for field, _ in FIELDS],
+                dtype_values=[dtype for _, dtype in FIELDS],
+                required=[True] * len(FIELDS),
+            )
+            record("schema", start)
+
+            start = time.perf_counter()
+            try:
+                return llm.analyze_text(resp_json["text"], schema=schema)
+            except Exception:
+                with lock:
+                    errors["extract"] += 1
+                return None
+            finally:
+                record("extract", start)
+
+        ocr_before = ocr_cache.stats()
+        extraction_before = extraction_cache.memory.stats()
+        tracemalloc.start()
+        start = time.perf_counter()
+        PipelineExecutor(
+            ocr_fn=ocr,
+            extract_fn=extract,
+            ocr_workers=concurrency,
+            llm_workers=concurrency,
+        ).run(corpus)
+        elapsed = time.perf_counter() - start
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        results.append(
+            dict(
+                corpus_size=len(corpus),
+                concurrency=concurrency,
+                pass_name=pass_name,
+                seconds=elapsed,
+                documents_per_second=len(corpus) / elapsed if elapsed else 0.0,
+                stages={
+                    stage: dict(
+                        count=len(values),
+                        mean=sum(values) / len(values) if values else None,
+                        p50=percentile(values, 50),
+                        p95=percentile(values, 95),
+                        p99=percentile(values, 99),
+                    )
+                    for stage, values in timings.items()
+                },
+                peak_traced_memory_bytes=peak_memory,
+                ocr_cache=_delta(ocr_before, ocr_cache.stats()),
+                extraction_cache=_delta(
+                    extraction_before, extraction_cache.memory.stats()
+                ),
+                errors=errors,
+            )
+        )
+
+    return results
+
+
+def main(argv: Optional[list] = None) -> int:
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(description="Benchmark the analysis pipeline")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 50])
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--doc-kb", type=int, default=256)
+    parser.add_argument("--duplicate-ratio", type=float, default=0.2)
+    parser.add_argument("--ocr-latency", type=float, default=0.2)
+    parser.add_argument("--ocr-jitter", type=float, default=0.05)
+    parser.add_argument("--ocr-failure-rate", type=float, default=0.0)
+    parser.add_argument("--ocr-text-chars", type=int, default=4000)
+    parser.add_argument("--llm-latency", type=float, default=0.5)
+    parser.add_argument("--llm-jitter", type=float, default=0.1)
+    parser.add_argument("--llm-failure-rate", type=float, default=0.0)
+    parser.add_argument("--max-chunk-tokens", type=int, default=2500)
+    parser.add_argument("--backoff-base", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="bench_results.json")
+    args = parser.parse_args(argv)
+
+    _random.seed(args.seed)
+    corpus_random = random.Random(args.seed)
+    results = []
+    with StubOCRServer(
+        latency=args.ocr_latency,
+        jitter=args.ocr_jitter,
+        failure_rate=args.ocr_failure_rate,
+        text_chars=args.ocr_text_chars,
+    ) as server:
+        for size in args.sizes:
+            corpus = build_corpus(
+                size, args.doc_kb, args.duplicate_ratio, corpus_random
+            )
+            for concurrency in args.concurrency:
+                with tempfile.TemporaryDirectory() as workdir:
+                    for result in run_configuration(
+                        corpus, concurrency, server, args, workdir
+                    ):
+                        results.append(result)
+                        print(
+                            f"size={size:<5} concurrency={concurrency:<3} "
+                            f"{result['pass_name']:<5} "
+                            f"{result['documents_per_second']:8.2f} docs/s  "
+                            f"ocr p95={result['stages']['ocr']['p95'] or 0:.3f}s  "
+                            f"extract p95={result['stages']['extract']['p95'] or 0:.3f}s  "
+                            f"ocr hits={result['ocr_cache']['hit_ratio']:.2f}",
+                            file=sys.stderr,
+                        )
+
+    report = dict(
+        settings=vars(args),
+        platform=dict(python=platform.python_version(), machine=platform.machine()),
+        created_at=time.time(),
+        max_rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        results=results,
+    )
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,273 @@
+# Copyright 2023 Aditya Mohan
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Persistent caches
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Optional
+
+
+class DiskCache:
+    """Content addressed key value store backed by SQLite
+
+    Values are JSON serializable dicts. Entries are evicted least recently
+    used first once the store grows past `max_bytes` or `max_entries`, and
+    expire `ttl` seconds after they were written. SQLite's locking makes the
+    store safe to share between threads, sessions and processes.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_bytes: int = 512 * 1024 * 1024,
+        max_entries: Optional[int] = None,
+        ttl: Optional[float] = None,
+    ) -> None:
+        """
+        Args:
+            path (str): Location of the SQLite database file
+            max_bytes (int): Maximum total size of the stored values
+            max_entries (int, optional): Maximum number of stored entries
+            ttl (float, optional): Seconds after which an entry expires
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+        conn = self._connect()
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+            """
+        )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS entries_accessed_at ON entries (accessed_at)"
+        )
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _expired(self, created_at: float, now: float) -> bool:
+        return self.ttl is not None and now - created_at > self.ttl
+
+    def _count(self, hit: bool) -> None:
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, key: str) -> Optional[dict]:
+        """Get a value from the cache
+
+        Args:
+            key (str): Cache key
+
+        Returns:
+            Optional[dict]: Stored value or None on a miss
+        """
+        conn = self._connect()
+        now = time.time()
+        row = conn.execute(
+            "SELECT value, created_at FROM entries WHERE key = ?", (key,)
+        ).fetchone()
+
+        if row is None or self._expired(row[1], now):
+            self._count(hit=False)
+            return None
+
+        conn.execute("UPDATE entries SET accessed_at = ? WHERE key = ?", (now, key))
+        self._count(hit=True)
+        return json.loads(row[0])
+
+    def set(self, key: str, value: dict) -> None:
+        """Store a value and evict entries that no longer fit
+
+        Args:
+            key (str): Cache key
+            value (dict): JSON serializable value
+        """
+        data = json.dumps(value)
+        now = time.time()
+        conn = self._connect()
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                (key, data, len(data.encode("utf-8")), now, now),
+            )
+            self._evict(conn, now)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _evict(self, conn: sqlite3.Connection, now: float) -> None:
+        if self.ttl is not None:
+            conn.execute("DELETE FROM entries WHERE created_at < ?", (now - self.ttl,))
+
+        if self.max_entries is not None:
+            conn.execute(
+                """
+                DELETE FROM entries WHERE key NOT IN (
+                    SELECT key FROM entries ORDER BY accessed_at DESC LIMIT ?
+                )
+                """,
+                (self.max_entries,),
+            )
+
+        conn.execute(
+            """
+            DELETE FROM entries WHERE key IN (
+                SELECT key FROM (
+                    SELECT key, SUM(size) OVER (
+                        ORDER BY accessed_at DESC, key
+                    ) AS running_size FROM entries
+                ) WHERE running_size > ?
+            )
+            """,
+            (self.max_bytes,),
+        )
+
+    def delete(self, key: str) -> None:
+        """Remove a value from the cache
+
+        Args:
+            key (str): Cache key
+        """
+        self._connect().execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def stats(self) -> dict:
+        """Cache statistics
+
+        Returns:
+            dict: Hits and misses of this process plus entry count and size
+        """
+        entries, size = (
+            self._connect()
+            .execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries")
+            .fetchone()
+        )
+        with self._lock:
+            hits, misses = self.hits, self.misses
+
+        lookups = hits + misses
+        return dict(
+            hits=hits,
+            misses=misses,
+            hit_ratio=hits / lookups if lookups else 0.0,
+            entries=entries,
+            size_bytes=size,
+        )
+
+
+class MemoryCache:
+    """Thread safe in-memory LRU cache with a bounded number of entries"""
+
+    def __init__(self, max_entries: int = 256) -> None:
+        """
+        Args:
+            max_entries (int): Maximum number of stored entries
+        """
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[Any]:
+        """Get a value from the cache
+
+        Args:
+            key (str): Cache key
+
+        Returns:
+            Optional[Any]: Stored value or None on a miss
+        """
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+
+    def set(self, key: str, value: Any) -> None:
+        """Store a value and evict the least recently used entries
+
+        Args:
+            key (str): Cache key
+            value (Any): Value to be stored
+        """
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key: str) -> None:
+        """Remove a value from the cache
+
+        Args:
+            key (str): Cache key
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def stats(self) -> dict:
+        """Cache statistics
+
+        Returns:
+            dict: Hits, misses and entry count
+        """
+        with self._lock:
+            hits, misses, entries = self.hits, self.misses, len(self._entries)
+
+        lookups = hits + misses
+        return dict(
+            hits=hits,
+            misses=misses,
+            hit_ratio=hits / lookups if lookups else 0.0,
+            entries=entries,
+        )
@@ -0,0 +1,183 @@
+# Copyright 2023 Aditya Mohan
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Token aware text chunking and merging of chunk level extractions
+"""
+
+import json
+import re
+from functools import lru_cache
+
+try:
+    import tiktoken
+except ImportError:  # pragma: no cover
+    tiktoken = None
+
+PAGE_BREAK = "\f"
+PARAGRAPH_BREAK = re.compile(r"\n\s*\n")
+
+
+@lru_cache(maxsize=8)
+def _encoding(model_name: str):
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(text: str, model_name: str = "gpt-3.5-turbo") -> int:
+    """Counts the tokens of a text
+
+    Falls back to an estimate of four characters per token when tiktoken is
+    not installed.
+
+    Args:
+        text (str): Text to be measured
+        model_name (str): OpenAI model whose tokenizer is used
+
+    Returns:
+        int: Number of tokens
+    """
+    if tiktoken is None:
+        return (len(text) + 3) // 4
+
+    return len(_encoding(model_name).encode(text, disallowed_special=()))
+
+
+def _split_oversized(unit: str, max_tokens: int, model_name: str) -> list:
+    """Splits a paragraph that does not fit the budget on lines, then words"""
+    pieces = unit.split("\n") if "\n" in unit else unit.split(" ")
+    separator = "\n" if "\n" in unit else " "
+    if len(pieces) == 1:
+        # A single word longer than the budget, cut it by characters
+        width = max(1, max_tokens * 3)
+        return [unit[i : i + width] for i in range(0, len(unit), width)]
+
+    return _pack(pieces, separator, max_tokens, model_name)
+
+
+def _pack(units: list, separator: str, max_tokens: int, model_name: str) -> list:
+    chunks = []
+    current = []
+    current_tokens = 0
+    separator_tokens = count_tokens(separator, model_name)
+
+    for unit in units:
+        unit_tokens = count_tokens(unit, model_name)
+        if unit_tokens > max_tokens:
+            if current:
+                chunks.append(separator.join(current))
+                current, current_tokens = [], 0
+            chunks.extend(_split_oversized(unit, max_tokens, model_name))
+            continue
+
+        if current and current_tokens + separator_tokens + unit_tokens > max_tokens:
+            chunks.append(separator.join(current))
+            current, current_tokens = [], 0
+
+        current_tokens += unit_tokens + (separator_tokens if current else 0)
+        current.append(unit)
+
+    if current:
+        chunks.append(separator.join(current))
+
+    return chunks
+
+
+def split_text(text: str, max_tokens: int, model_name: str = "gpt-3.5-turbo") -> list:
+    """Splits OCR text into chunks that fit a token budget
+
+    Pages (separated by form feeds) and paragraphs (separated by blank lines)
+    are never cut unless a single one exceeds the budget on its own. A chunk
+    starts on a new page whenever the previous page filled more than half
+    of the budget.
+
+    Args:
+        text (str): OCR Output to be split
+        max_tokens (int): Maximum number of tokens per chunk
+        model_name (str): OpenAI model whose tokenizer is used
+
+    Returns:
+        list: Text chunks in document order
+    """
+    chunks = []
+    for page in text.split(PAGE_BREAK):
+        paragraphs = [p.strip() for p in PARAGRAPH_BREAK.split(page) if p.strip()]
+        if not paragraphs:
+            continue
+
+        page_chunks = _pack(paragraphs, "\n\n", max_tokens, model_name)
+        if (
+            chunks
+            and count_tokens(chunks[-1], model_name) <= max_tokens // 2
+            and count_tokens(chunks[-1] + "\n\n" + page_chunks[0], model_name)
+            <= max_tokens
+        ):
+            chunks[-1] = chunks[-1] + "\n\n" + page_chunks.pop(0)
+
+        chunks.extend(page_chunks)
+
+    return chunks
+
+
+def _is_empty(value) -> bool:
+    return value is None or (isinstance(value, str) and not value.strip())
+
+
+def merge_entities(outputs: list) -> list:
+    """Merges and deduplicates the entities extracted from each chunk
+
+    Empty fields are ignored and entities without any value are dropped. An
+    entity split by a chunk boundary comes back as the last entity of one
+    chunk and the first entity of the next with disjoint fields; these two
+    are merged. Then an entity whose values are all contained in another
+    entity is dropped in favour of the more complete one.
+
+    Args:
+        outputs (list): Entity lists in chunk order
+
+    Returns:
+        list: Deduplicated entities in order of first appearance
+    """
+    entities = []
+    # Last entity of the previous chunk, None after a chunk without entities
+    last = None
+    for output in outputs:
+        filled = [
+            {k: v for k, v in entity.items() if not _is_empty(v)}
+            for entity in output or []
+        ]
+        filled = [entity for entity in filled if entity]
+        if not filled:
+            last = None
+            continue
+        if last is not None and not (last.keys() & filled[0].keys()):
+            last.update(filled.pop(0))
+        entities.extend(filled)
+        last = entities[-1]
+
+    def as_items(entity: dict) -> set:
+        return {(k, json.dumps(v, sort_keys=True)) for k, v in entity.items()}
+
+    kept = []
+    for idx, entity in sorted(
+        enumerate(entities), key=lambda item: len(item[1]), reverse=True
+    ):
+        items = as_items(entity)
+        if any(items <= as_items(other) for _, other in kept):
+            continue
+        kept.append((idx, entity))
+
+    return [entity for _, entity in sorted(kept, key=lambda item: item[0])]
@@ -0,0 +1,191 @@
+# Copyright 2023 Aditya Mohan
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compaction of OCR text before it is sent to the LLM
+"""
+
+import re
+from collections import Counter
+from typing import Iterable
+
+from chunking import PAGE_BREAK, count_tokens
+from metrics import registry
+
+COMPACTION_TOKENS = registry.counter(
+    "compaction_tokens_total", "Tokens of OCR text before and after compaction"
+)
+
+_SPACES = re.compile(r"[ \t\r\v\u00a0]+")
+# Page numbers that say so, e.g. "Page 2", "Page 2 of 5", "2 of 5" or "- 2 -"
+_PAGE_NUMBER = re.compile(
+    r"^page\s*\d{1,4}(\s*(of|/)\s*\d{1,4})?$|^\d{1,4}\s+of\s+\d{1,4}$"
+    r"|^-\s*\d{1,4}\s*-$",
+    re.IGNORECASE,
+)
+_BARE_NUMBER = re.compile(r"^\d{1,4}$")
+
+
+def _is_garbage(line: str, min_alnum_ratio: float) -> bool:
+    visible = line.replace(" ", "")
+    if not visible:
+        return False
+
+    alnum = sum(c.isalnum() for c in visible)
+    if alnum == 0:
+        return True
+    return len(visible) >= 4 and alnum / len(visible) < min_alnum_ratio
+
+
+class TextCompactor:
+    """Removes text that costs tokens without carrying information
+
+    Whitespace is normalized, lines repeated at the top or bottom of most
+    pages (headers, footers) are kept on their first page only, and lines
+    that look like OCR noise or match one of the boilerplate patterns are
+    dropped. Page numbers are dropped from documents of several pages when
+    they are spelled out, e.g. "Page 2 of 5", or when bare numbers at the
+    page edges count up with the pages. Single pages keep all their lines
+    but noise and boilerplate. Page breaks and paragraph breaks are preserved
+    for the chunking.
+    """
+
+    def __init__(
+        self,
+        strip_headers: bool = True,
+        drop_garbage: bool = True,
+        min_alnum_ratio: float = 0.5,
+        boilerplate: Iterable[str] = (),
+        edge_lines: int = 3,
+        model_name: str = "gpt-3.5-turbo",
+    ) -> None:
+        """
+        Args:
+            strip_headers (bool): Remove headers and footers repeated across pages
+            drop_garbage (bool): Remove lines that look like OCR noise
+            min_alnum_ratio (float): Minimum share of letters and digits among
+                the visible characters of a line that is kept
+            boilerplate (Iterable[str]): Regular expressions of lines to remove
+            edge_lines (int): Number of lines at the top and bottom of a page
+                that are checked for headers and footers
+            model_name (str): OpenAI model whose tokenizer is used for the stats
+        """
+        self.strip_headers = strip_headers
+        self.drop_garbage = drop_garbage
+        self.min_alnum_ratio = min_alnum_ratio
+        self.boilerplate = [re.compile(p, re.IGNORECASE) for p in boilerplate]
+        self.edge_lines = edge_lines
+        self.model_name = model_name
+
+    def _edges(self, lines: list) -> set:
+        content = [idx for idx, line in enumerate(lines) if line]
+        return set(content[: self.edge_lines] + content[-self.edge_lines :])
+
+    def _repeated(self, pages: list) -> set:
+        """Lines found at the edge of at least half of the pages"""
+        if len(pages) < 2:
+            return set()
+
+        counts = Counter()
+        for lines in pages:
+            counts.update({lines[idx].lower() for idx in self._edges(lines)})
+
+        threshold = max(2, (len(pages) + 1) // 2)
+        return {line for line, count in counts.items() if count >= threshold}
+
+    def _page_numbers(self, pages: list) -> set:
+        """(page, line) positions of page numbers
+
+        Bare numbers only count as page numbers when at least half of the
+        pages have one at their edge that counts up with the page.
+        """
+        if len(pages) < 2:
+            return set()
+
+        numbered = set()
+        offsets = {}
+        for page_idx, lines in enumerate(pages):
+            for idx in self._edges(lines):
+                if _PAGE_NUMBER.match(lines[idx]):
+                    numbered.add((page_idx, idx))
+                elif _BARE_NUMBER.match(lines[idx]):
+                    offset = int(lines[idx]) - page_idx
+                    offsets.setdefault(offset, set()).add((page_idx, idx))
+
+        threshold = max(2, (len(pages) + 1) // 2)
+        for positions in offsets.values():
+            if len({page_idx for page_idx, _ in positions}) >= threshold:
+                numbered |= positions
+        return numbered
+
+    def _clean(self, page: str, stats: dict) -> list:
+        """Normalized lines of a page without noise and boilerplate"""
+        lines = []
+        for line in page.split("\n"):
+            line = _SPACES.sub(" ", line).strip()
+            if not line:
+                # Collapse runs of blank lines into one paragraph break
+                if lines and lines[-1]:
+                    lines.append("")
+                continue
+
+            if self.drop_garbage and _is_garbage(line, self.min_alnum_ratio):
+                stats["garbage"] += 1
+                continue
+            if any(pattern.search(line) for pattern in self.boilerplate):
+                stats["boilerplate"] += 1
+                continue
+            lines.append(line)
+
+        return lines
+
+    def compact(self, text: str) -> tuple:
+        """Compacts OCR text
+
+        Args:
+            text (str): OCR Output, pages separated by form feeds
+
+        Returns:
+            tuple: Compacted text and a dict with the tokens before and after
+            and the number of removed lines per reason
+        """
+        stats = dict(headers_footers=0, garbage=0, boilerplate=0)
+        pages = [self._clean(page, stats) for page in text.split(PAGE_BREAK)]
+        repeated = self._repeated(pages) if self.strip_headers else set()
+        page_numbers = self._page_numbers(pages) if self.strip_headers else set()
+        seen = set()
+
+        compacted = []
+        for page_idx, lines in enumerate(pages):
+            edges = self._edges(lines) if self.strip_headers else set()
+            kept = []
+            for idx, line in enumerate(lines):
+                if idx in edges:
+                    if (page_idx, idx) in page_numbers or line.lower() in seen:
+                        stats["headers_footers"] += 1
+                        continue
+                    if line.lower() in repeated:
+                        seen.add(line.lower())
+
+                if line or (kept and kept[-1]):
+                    kept.append(line)
+
+            compacted.append("\n".join(kept).strip())
+
+        result = PAGE_BREAK.join(compacted)
+        stats["tokens_before"] = count_tokens(text, self.model_name)
+        stats["tokens_after"] = count_tokens(result, self.model_name)
+        COMPACTION_TOKENS.inc(stats["tokens_before"], kind="before")
+        COMPACTION_TOKENS.inc(stats["tokens_after"], kind="after")
+        return result, stats
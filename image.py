@@ -0,0 +1,139 @@
+# Copyright 2023 Aditya Mohan
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Local image handling
+"""
+
+import io
+import logging
+import time
+from typing import BinaryIO, Optional, Union
+
+from metrics import registry
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # pragma: no cover
+    Image = None
+
+IMAGE_BYTES = registry.counter(
+    "image_bytes_total", "Bytes of uploaded images before and after preprocessing"
+)
+logger = logging.getLogger(__name__)
+
+
+class ImagePreprocessor:
+    """Shrinks images before they are uploaded to the OCR service
+
+    Phone photos are often far larger than OCR needs. Images are rotated
+    according to their EXIF orientation, downscaled to `max_long_edge` pixels
+    or `target_dpi`, converted to grayscale and re-encoded as JPEG. Images are
+    decoded from the file itself, JPEG files directly at a reduced scale when
+    possible. The original is kept if it does not need downscaling, the
+    result is not smaller or the image cannot be decoded.
+    """
+
+    def __init__(
+        self,
+        max_long_edge: int = 2000,
+        target_dpi: Optional[int] = 300,
+        grayscale: bool = True,
+        quality: int = 85,
+    ) -> None:
+        """
+        Args:
+            max_long_edge (int): Maximum number of pixels of the longer side
+            target_dpi (int, optional): Resolution that images scanned at a
+                higher DPI are reduced to
+            grayscale (bool): Drop the colors
+            quality (int): JPEG quality between 1 and 95
+        """
+        self.max_long_edge = max_long_edge
+        self.target_dpi = target_dpi
+        self.grayscale = grayscale
+        self.quality = quality
+
+    def _scale(self, img) -> float:
+        scale = min(1.0, self.max_long_edge / max(img.size))
+        dpi = img.info.get("dpi")
+        if self.target_dpi and dpi and dpi[0] and dpi[0] > self.target_dpi:
+            scale = min(scale, self.target_dpi / float(dpi[0]))
+        return scale
+
+    def process(self, file_obj: Union[BinaryIO, bytes]) -> Optional[tuple]:
+        """Preprocesses an image
+
+        Only the header is read unless the image needs downscaling.
+
+        Args:
+            file_obj (BinaryIO): Seekable original image file, or its bytes;
+                left at the start
+
+        Returns:
+            Optional[tuple]: JPEG bytes and a dict with the byte counts,
+            pixel sizes and preprocessing seconds, or None if the original
+            should be sent
+        """
+        if Image is None:
+            return None
+        if isinstance(file_obj, bytes):
+            file_obj = io.BytesIO(file_obj)
+
+        start = time.perf_counter()
+        try:
+            original_bytes = file_obj.seek(0, io.SEEK_END)
+            file_obj.seek(0)
+            img = Image.open(file_obj)
+            original_size = img.size
+            scale = self._scale(img)
+            if scale >= 1.0:
+                return None
+            target = (
+                max(1, round(original_size[0] * scale)),
+                max(1, round(original_size[1] * scale)),
+            )
+            # Lets the JPEG decoder skip the resolution that is thrown away
+            img.draft("L" if self.grayscale else "RGB", target)
+            img = ImageOps.exif_transpose(img)
+
+            if img.mode in ("RGBA", "LA", "PA") or "transparency" in img.info:
+                # Transparent areas would turn black, put them on white paper
+                img = img.convert("RGBA")
+                background = Image.new("RGBA", img.size, "white")
+                img = Image.alpha_composite(background, img)
+            img = img.convert("L" if self.grayscale else "RGB")
+            img.thumbnail((max(target), max(target)), Image.LANCZOS)
+
+            out = io.BytesIO()
+            img.save(out, format="JPEG", quality=self.quality, optimize=True)
+        except Exception:
+            logger.exception("Image preprocessing failed, sending the original")
+            return None
+        finally:
+            file_obj.seek(0)
+
+        processed = out.getvalue()
+        if len(processed) >= original_bytes:
+            return None
+
+        IMAGE_BYTES.inc(original_bytes, kind="original")
+        IMAGE_BYTES.inc(len(processed), kind="sent")
+        return processed, dict(
+            original_bytes=original_bytes,
+            bytes=len(processed),
+            original_size=list(original_size),
+            size=list(img.size),
+            preprocess_seconds=time.perf_counter() - start,
+        )
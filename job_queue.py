@@ -0,0 +1,1075 @@
+# Copyright 2023 Aditya Mohan
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Persistent analysis job queue and its workers
+"""
+
+import argparse
+import enum
+import json
+import logging
+import os
+import shutil
+import socket
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from typing import BinaryIO, Optional, Union
+
+from cache import DiskCache
+from compaction import TextCompactor
+from image import ImagePreprocessor
+from llm import DEFAULT_MODEL, LLM, ExtractionCache
+from metrics import ERRORS, STAGE_SECONDS
+from ocr_client import OCRClient
+from pipeline import PipelineExecutor, PipelineStage
+from rules import RuleExtractor
+from scheduler import RateScheduler
+from utils import merge_fields, ocr_file
+
+
+@enum.unique
+class JobStatus(enum.Enum):
+    """
+    Lifecycle of a job
+    """
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+
+@enum.unique
+class ItemStatus(enum.Enum):
+    """
+    Outcome of a single file of a job
+    """
+
+    PENDING = "pending"
+    DONE = "done"
+    SKIPPED = "skipped"
+    FAILED = "failed"
+
+
+FINISHED = frozenset({JobStatus.DONE, JobStatus.FAILED, JobStatus.CANCELLED})
+logger = logging.getLogger(__name__)
+
+
+class JobCancelled(Exception):
+    """The job was cancelled or claimed by another worker"""
+
+
+class MissingSecret(Exception):
+    """The credentials a job needs are not available to the worker"""
+
+
+class JobQueue:
+    """Analysis jobs stored in SQLite, shared by UI processes and workers
+
+    A job holds the analysis settings and the files to be analyzed. The files
+    themselves are kept next to the database, addressed by their hash. Workers
+    claim queued jobs and keep a lease on them through heartbeats; a job whose
+    worker stops heartbeating is claimed again and resumes with the files that
+    are not finished yet. Secrets of a job, e.g. the OpenAI key of the user,
+    are never written to the database; they are held in memory for the
+    workers of the same process.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        file_dir: Optional[str] = None,
+        lease_seconds: float = 300.0,
+    ) -> None:
+        """
+        Args:
+            path (str): Location of the SQLite database file
+            file_dir (str, optional): Directory of the uploaded files, defaults
+                to an `uploads` directory next to the database
+            lease_seconds (float): Seconds without a heartbeat after which a
+                running job is handed to another worker
+        """
+        self.path = path
+        self.file_dir = file_dir or os.path.join(
+            os.path.dirname(os.path.abspath(path)), "uploads"
+        )
+        self.lease_seconds = lease_seconds
+        self._local = threading.local()
+        self._secrets = {}
+        self._secrets_lock = threading.Lock()
+        os.makedirs(self.file_dir, exist_ok=True)
+
+        conn = self._connect()
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                total INTEGER NOT NULL,
+                worker TEXT,
+                error TEXT,
+                summary TEXT,
+                created_at REAL NOT NULL,
+                started_at REAL,
+                heartbeat_at REAL,
+                finished_at REAL
+            )
+            """
+        )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS items (
+                job_id TEXT NOT NULL,
+                idx INTEGER NOT NULL,
+                name TEXT NOT NULL,
+                file_hash TEXT NOT NULL,
+                status TEXT NOT NULL,
+                result TEXT,
+                error TEXT,
+                updated_at REAL,
+                PRIMARY KEY (job_id, idx)
+            )
+            """
+        )
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(items)")}
+        if "updated_at" not in columns:
+            conn.execute("ALTER TABLE items ADD COLUMN updated_at REAL")
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)"
+        )
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def file_path(self, file_hash: str) -> str:
+        """Location of a stored file
+
+        Args:
+            file_hash (str): Hash of the file
+
+        Returns:
+            str: Path of the file
+        """
+        return os.path.join(self.file_dir, file_hash)
+
+    def put_file(self, file_hash: str, data: Union[bytes, BinaryIO]) -> None:
+        """Stores an uploaded file unless it is already stored
+
+        Args:
+            file_hash (str): Hash of the file
+            data (bytes | BinaryIO): File content or a file object it is
+                copied from
+        """
+        path = self.file_path(file_hash)
+        if os.path.exists(path):
+            # Refreshed so that `purge` does not race with the new job
+            os.utime(path)
+            return
+
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as f:
+            if isinstance(data, (bytes, bytearray)):
+                f.write(data)
+            else:
+                shutil.copyfileobj(data, f)
+        os.replace(tmp_path, path)
+
+    def link_file(self, file_hash: str, path: str) -> None:
+        """Stores a file that is already on disk, e.g. a spilled upload
+
+        The file is hard linked when it is on the same file system as the
+        queue, so its content is not stored twice, and copied otherwise.
+
+        Args:
+            file_hash (str): Hash of the file
+            path (str): Location of the file, which must not be modified
+                in place afterwards
+        """
+        target = self.file_path(file_hash)
+        if os.path.exists(target):
+            # Refreshed so that `purge` does not race with the new job
+            os.utime(target)
+            return
+
+        tmp_path = f"{target}.{uuid.uuid4().hex}.tmp"
+        try:
+            os.link(path, tmp_path)
+        except OSError:
+            shutil.copyfile(path, tmp_path)
+        os.replace(tmp_path, target)
+
+    def enqueue(
+        self, payload: dict, files: list, secrets: Optional[dict] = None
+    ) -> str:
+        """Adds a job
+
+        Args:
+            payload (dict): JSON serializable analysis settings
+            files (list): (file name, file hash) tuples of files stored with
+                `put_file`
+            secrets (dict, optional): Credentials of the job, kept in memory
+                only, see `secrets`
+
+        Returns:
+            str: Job id
+        """
+        job_id = uuid.uuid4().hex
+        if secrets:
+            with self._secrets_lock:
+                self._secrets[job_id] = dict(secrets)
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "INSERT INTO jobs (id, status, payload, total, created_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (
+                    job_id,
+                    JobStatus.QUEUED.value,
+                    json.dumps(payload),
+                    len(files),
+                    time.time(),
+                ),
+            )
+            conn.executemany(
+                "INSERT INTO items (job_id, idx, name, file_hash, status) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [
+                    (job_id, idx, name, file_hash, ItemStatus.PENDING.value)
+                    for idx, (name, file_hash) in enumerate(files)
+                ],
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            with self._secrets_lock:
+                self._secrets.pop(job_id, None)
+            raise
+
+        return job_id
+
+    def secrets(self, job_id: str) -> dict:
+        """Credentials a job was enqueued with
+
+        Only available in the process that enqueued the job and until the job
+        finishes; workers of other processes use their own credentials.
+
+        Args:
+            job_id (str): Job id
+
+        Returns:
+            dict: Secrets of the job, empty if they are not held here
+        """
+        with self._secrets_lock:
+            return dict(self._secrets.get(job_id, {}))
+
+    def claim(self, worker_id: str) -> Optional[dict]:
+        """Claims the oldest queued job or a running job with an expired lease
+
+        Args:
+            worker_id (str): Id of the claiming worker
+
+        Returns:
+            Optional[dict]: Job id, payload and the files that are still
+            pending, or None if there is nothing to do
+        """
+        conn = self._connect()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT id, payload FROM jobs WHERE status = ? "
+                "OR (status = ? AND heartbeat_at < ?) ORDER BY created_at LIMIT 1",
+                (
+                    JobStatus.QUEUED.value,
+                    JobStatus.RUNNING.value,
+                    now - self.lease_seconds,
+                ),
+            ).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+
+            conn.execute(
+                "UPDATE jobs SET status = ?, worker = ?, heartbeat_at = ?, "
+                "started_at = COALESCE(started_at, ?) WHERE id = ?",
+                (JobStatus.RUNNING.value, worker_id, now, now, row[0]),
+            )
+            items = conn.execute(
+                "SELECT idx, name, file_hash FROM items "
+                "WHERE job_id = ? AND status = ? ORDER BY idx",
+                (row[0], ItemStatus.PENDING.value),
+            ).fetchall()
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+        return dict(
+            id=row[0],
+            payload=json.loads(row[1]),
+            items=[dict(idx=i, name=n, file_hash=h) for i, n, h in items],
+        )
+
+    def heartbeat(self, job_id: str, worker_id: str) -> bool:
+        """Extends the lease of a running job
+
+        Args:
+            job_id (str): Job id
+            worker_id (str): Id of the worker holding the job
+
+        Returns:
+            bool: False if the job was cancelled or claimed by another worker
+        """
+        cursor = self._connect().execute(
+            "UPDATE jobs SET heartbeat_at = ? "
+            "WHERE id = ? AND worker = ? AND status = ?",
+            (time.time(), job_id, worker_id, JobStatus.RUNNING.value),
+        )
+        return cursor.rowcount == 1
+
+    def complete_item(
+        self,
+        job_id: str,
+        idx: int,
+        status: ItemStatus,
+        result: Optional[dict] = None,
+        error: Optional[str] = None,
+    ) -> None:
+        """Records the outcome of a file
+
+        Args:
+            job_id (str): Job id
+            idx (int): Position of the file in the job
+            status (ItemStatus): Outcome
+            result (dict, optional): JSON serializable result
+            error (str, optional): Error message
+        """
+        self._connect().execute(
+            "UPDATE items SET status = ?, result = ?, error = ?, updated_at = ? "
+            "WHERE job_id = ? AND idx = ?",
+            (
+                status.value,
+                json.dumps(result) if result is not None else None,
+                error,
+                time.time(),
+                job_id,
+                idx,
+            ),
+        )
+
+    def update_item(self, job_id: str, idx: int, result: dict) -> None:
+        """Records the partial result of a file that is still being analyzed
+
+        Args:
+            job_id (str): Job id
+            idx (int): Position of the file in the job
+            result (dict): JSON serializable partial result
+        """
+        self._connect().execute(
+            "UPDATE items SET result = ?, updated_at = ? "
+            "WHERE job_id = ? AND idx = ? AND status = ?",
+            (
+                json.dumps(result),
+                time.time(),
+                job_id,
+                idx,
+                ItemStatus.PENDING.value,
+            ),
+        )
+
+    def finish(
+        self,
+        job_id: str,
+        status: JobStatus,
+        error: Optional[str] = None,
+        summary: Optional[dict] = None,
+    ) -> None:
+        """Marks a job as finished
+
+        Secrets are dropped once the job no longer needs them, including
+        those stored in the payload by older versions.
+
+        Args:
+            job_id (str): Job id
+            status (JobStatus): Final status
+            error (str, optional): Error message
+            summary (dict, optional): JSON serializable run statistics
+        """
+        with self._secrets_lock:
+            self._secrets.pop(job_id, None)
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT payload FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+            payload = json.loads(row[0]) if row else {}
+            payload.pop("openai_api_key", None)
+            conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, summary = ?, payload = ?, "
+                "finished_at = ? WHERE id = ? AND status NOT IN (?, ?, ?)",
+                (
+                    status.value,
+                    error,
+                    json.dumps(summary) if summary is not None else None,
+                    json.dumps(payload),
+                    time.time(),
+                    job_id,
+                    *(s.value for s in FINISHED),
+                ),
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def cancel(self, job_id: str) -> None:
+        """Cancels a job that has not finished yet
+
+        Args:
+            job_id (str): Job id
+        """
+        self.finish(job_id, JobStatus.CANCELLED)
+
+    def status(self, job_id: str) -> Optional[dict]:
+        """Progress of a job
+
+        Args:
+            job_id (str): Job id
+
+        Returns:
+            Optional[dict]: Status, file counts, error, summary, time of the
+            last result update and the files that were skipped or failed, or
+            None for an unknown job
+        """
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT status, total, error, summary, created_at, finished_at "
+            "FROM jobs WHERE id = ?",
+            (job_id,),
+        ).fetchone()
+        if row is None:
+            return None
+
+        counts = dict(
+            conn.execute(
+                "SELECT status, COUNT(*) FROM items WHERE job_id = ? GROUP BY status",
+                (job_id,),
+            ).fetchall()
+        )
+        (updated_at,) = conn.execute(
+            "SELECT MAX(updated_at) FROM items WHERE job_id = ?", (job_id,)
+        ).fetchone()
+        problems = conn.execute(
+            "SELECT idx, name, status, error FROM items "
+            "WHERE job_id = ? AND status IN (?, ?) ORDER BY idx",
+            (job_id, ItemStatus.SKIPPED.value, ItemStatus.FAILED.value),
+        ).fetchall()
+
+        return dict(
+            status=JobStatus(row[0]),
+            total=row[1],
+            completed=row[1] - counts.get(ItemStatus.PENDING.value, 0),
+            error=row[2],
+            summary=json.loads(row[3]) if row[3] else None,
+            created_at=row[4],
+            finished_at=row[5],
+            updated_at=updated_at or 0.0,
+            problems=[
+                dict(idx=i, name=n, status=ItemStatus(s), error=e)
+                for i, n, s, e in problems
+            ],
+        )
+
+    def wait(
+        self, job_id: str, since: float, timeout: float, interval: float = 0.1
+    ) -> Optional[dict]:
+        """Waits until a result of a job is updated or the job finishes
+
+        Args:
+            job_id (str): Job id
+            since (float): `updated_at` of the last status seen
+            timeout (float): Maximum number of seconds to wait
+            interval (float): Seconds between two looks at the database
+
+        Returns:
+            Optional[dict]: Latest status, see `status`
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            job = self.status(job_id)
+            if (
+                job is None
+                or job["status"] in FINISHED
+                or job["updated_at"] > since
+                or time.monotonic() >= deadline
+            ):
+                return job
+            time.sleep(interval)
+
+    def results(self, job_id: str) -> list:
+        """Results of the files of a job
+
+        Args:
+            job_id (str): Job id
+
+        Returns:
+            list: Result of every file in job order, the partial result or
+            None while pending
+        """
+        rows = (
+            self._connect()
+            .execute(
+                "SELECT result FROM items WHERE job_id = ? ORDER BY idx", (job_id,)
+            )
+            .fetchall()
+        )
+        return [json.loads(result) if result else None for (result,) in rows]
+
+    def purge(self, max_age: float) -> int:
+        """Deletes finished jobs and the files no other job refers to
+
+        Args:
+            max_age (float): Seconds a finished job is kept
+
+        Returns:
+            int: Number of deleted jobs
+        """
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            job_ids = [
+                job_id
+                for (job_id,) in conn.execute(
+                    "SELECT id FROM jobs WHERE finished_at < ?",
+                    (time.time() - max_age,),
+                ).fetchall()
+            ]
+            for job_id in job_ids:
+                conn.execute("DELETE FROM items WHERE job_id = ?", (job_id,))
+                conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+            referenced = {
+                file_hash
+                for (file_hash,) in conn.execute(
+                    "SELECT DISTINCT file_hash FROM items"
+                ).fetchall()
+            }
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+        if job_ids:
+            cutoff = time.time() - max_age
+            for name in os.listdir(self.file_dir):
+                path = os.path.join(self.file_dir, name)
+                if name in referenced or name.endswith(".tmp"):
+                    continue
+                try:
+                    if os.path.getmtime(path) < cutoff:
+                        os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+        return len(job_ids)
+
+
+class JobWorker:
+    """Claims jobs from a queue and runs OCR and extraction on their files
+
+    Files are processed on the pipelined OCR and extraction pools, and every
+    finished file is written back to the queue right away so that the UI can
+    show progress and a reclaimed job does not redo finished files.
+    """
+
+    def __init__(
+        self,
+        queue: JobQueue,
+        base_url: str,
+        pdf_endpoint: str,
+        img_endpoint: str,
+        ocr_cache: Optional[DiskCache] = None,
+        extraction_cache: Optional[ExtractionCache] = None,
+        client: Optional[OCRClient] = None,
+        ocr_workers: int = 4,
+        llm_workers: int = 2,
+        split_pages: bool = False,
+        page_workers: int = 4,
+        text_layer: bool = True,
+        preprocessor: Optional[ImagePreprocessor] = None,
+        max_chunk_tokens: Optional[int] = None,
+        chunk_workers: int = 4,
+        retrieval_tokens: Optional[int] = None,
+        compactor: Optional[TextCompactor] = None,
+        rules: Optional[RuleExtractor] = None,
+        scheduler: Optional[RateScheduler] = None,
+        poll_interval: float = 1.0,
+        retention: float = 24 * 3600,
+        worker_id: Optional[str] = None,
+        free_tier_api_key: Optional[str] = None,
+    ) -> None:
+        """
+        Args:
+            queue (JobQueue): Queue to take jobs from
+            base_url (str): Host and port of the OCR service
+            pdf_endpoint (str): OCR endpoint for PDFs
+            img_endpoint (str): OCR endpoint for images
+            ocr_cache (DiskCache, optional): Store for OCR results
+            extraction_cache (ExtractionCache, optional): Store for extractions
+            client (OCRClient, optional): Client used to call the OCR service
+            ocr_workers (int): Maximum number of concurrent OCR calls
+            llm_workers (int): Maximum number of concurrent extraction calls
+            split_pages (bool): OCR and cache the pages of PDFs individually
+            page_workers (int): Maximum number of pages OCRed concurrently
+            text_layer (bool): Read born-digital PDF pages from their text layer
+            preprocessor (ImagePreprocessor, optional): Shrinks images before
+                they are sent to the OCR service
+            max_chunk_tokens (int, optional): Token budget per extraction chunk
+            chunk_workers (int): Maximum number of chunks extracted concurrently
+            retrieval_tokens (int, optional): Token budget of the passages
+                retrieved from long documents
+            compactor (TextCompactor, optional): Compacts the OCR text before
+                extraction
+            rules (RuleExtractor, optional): Resolves simple fields without
+                the LLM
+            scheduler (RateScheduler, optional): Admits the OpenAI calls of
+                all jobs within the rate limits of their key
+            poll_interval (float): Seconds to wait when the queue is empty
+            retention (float): Seconds finished jobs are kept in the queue
+            worker_id (str, optional): Id of the worker, generated if not given
+            free_tier_api_key (str, optional): Key of the free tier, used
+                for the jobs enqueued as free trials only; None fails them
+        """
+        self.queue = queue
+        self.base_url = base_url
+        self.pdf_endpoint = pdf_endpoint
+        self.img_endpoint = img_endpoint
+        self.ocr_cache = ocr_cache
+        self.extraction_cache = extraction_cache
+        self.client = client
+        self.ocr_workers = ocr_workers
+        self.llm_workers = llm_workers
+        self.split_pages = split_pages
+        self.page_workers = page_workers
+        self.text_layer = text_layer
+        self.preprocessor = preprocessor
+        self.max_chunk_tokens = max_chunk_tokens
+        self.chunk_workers = chunk_workers
+        self.retrieval_tokens = retrieval_tokens
+        self.compactor = compactor
+        self.rules = rules
+        self.scheduler = scheduler
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self.worker_id = worker_id or f"{socket.gethostname()}-{uuid.uuid4().hex[:8]}"
+        self.free_tier_api_key = free_tier_api_key
+
+    def run_forever(self, stop: Optional[threading.Event] = None) -> None:
+        """Processes jobs until `stop` is set
+
+        Args:
+            stop (threading.Event, optional): Ends the loop once set
+        """
+        stop = stop or threading.Event()
+        while not stop.is_set():
+            try:
+                if self.run_once():
+                    self.queue.purge(self.retention)
+                    continue
+            except Exception:
+                logger.exception("Worker %s failed to run a job", self.worker_id)
+            stop.wait(self.poll_interval)
+
+    def run_once(self) -> bool:
+        """Claims and runs a single job
+
+        Returns:
+            bool: Whether a job was run
+        """
+        job = self.queue.claim(self.worker_id)
+        if job is None:
+            return False
+
+        try:
+            summary = self.run_job(job)
+        except JobCancelled:
+            return True
+        except MissingSecret as e:
+            self.queue.finish(job["id"], JobStatus.FAILED, error=str(e))
+            return True
+        except Exception as e:
+            logger.exception("Job %s failed", job["id"])
+            self.queue.finish(job["id"], JobStatus.FAILED, error=str(e))
+            return True
+
+        self.queue.finish(job["id"], JobStatus.DONE, summary=summary)
+        return True
+
+    def run_job(self, job: dict) -> dict:
+        """Runs OCR and extraction on the pending files of a claimed job
+
+        Args:
+            job (dict): Job as returned by `JobQueue.claim`
+
+        Raises:
+            JobCancelled: The job was cancelled or lost its lease
+            MissingSecret: No OpenAI key is available for the job
+
+        Returns:
+            dict: Run statistics
+        """
+        payload = job["payload"]
+        items = job["items"]
+        # The key of the user is never replaced by the key of the free tier
+        if payload.get("free_tier"):
+            openai_api_key = self.free_tier_api_key
+            if not openai_api_key:
+                raise MissingSecret("The free tier is not available at the moment")
+        else:
+            openai_api_key = self.queue.secrets(job["id"]).get("openai_api_key")
+            if not openai_api_key:
+                raise MissingSecret(
+                    "Your OpenAI API key is no longer available, please "
+                    "re-enter your key and analyze again"
+                )
+        llm = LLM(
+            temperature=payload["temperature"],
+            openai_api_key=openai_api_key,
+            model_name=payload.get("model_name", DEFAULT_MODEL),
+            escalation_models=payload.get("escalation_models"),
+            cache=self.extraction_cache,
+            max_chunk_tokens=self.max_chunk_tokens,
+            chunk_workers=self.chunk_workers,
+            retrieval_tokens=self.retrieval_tokens,
+            rules=self.rules,
+            scheduler=self.scheduler,
+            tenant=job["id"],
+        )
+        schema = payload["schema"]
+        changed_schema = payload.get("changed_schema", schema)
+        removed_fields = payload.get("removed_fields", [])
+        previous_outputs = payload.get("previous_outputs")
+
+        def ocr(item: dict) -> Optional[dict]:
+            try:
+                with STAGE_SECONDS.time(stage="ocr"):
+                    with open(self.queue.file_path(item["file_hash"]), "rb") as f:
+                        resp_json = ocr_file(
+                            file_name=item["name"],
+                            file_obj=f,
+                            base_url=self.base_url,
+                            pdf_endpoint=self.pdf_endpoint,
+                            img_endpoint=self.img_endpoint,
+                            cache=self.ocr_cache,
+                            split_pages=self.split_pages,
+                            page_workers=self.page_workers,
+                            client=self.client,
+                            text_layer=self.text_layer,
+                            preprocessor=self.preprocessor,
+                        )
+            except Exception as e:
+                # e.g. a malformed PDF or image, fails this file only
+                ERRORS.inc(stage="ocr")
+                logger.exception("OCR of %s failed", item["name"])
+                return dict(error=f"Failed to read the file: {e}", item=item)
+            if resp_json is None:
+                return None
+            # Lets the page show that the file is being extracted
+            self.queue.update_item(
+                job["id"],
+                item["idx"],
+                dict(output=[], partial=True, metadata=resp_json.get("metadata", {})),
+            )
+            return dict(resp_json, item=item)
+
+        def extract(resp_json: dict) -> dict:
+            if "error" in resp_json:
+                return dict(error=resp_json["error"])
+            # Same fields and temperature as the previous analysis: only the
+            # added or changed fields are sent to the LLM
+            idx = resp_json["item"]["idx"]
+            previous_output = previous_outputs[idx] if previous_outputs else None
+            chunk_stats, rule_fields = [], []
+            text, compaction = resp_json["text"], None
+            if self.compactor is not None:
+                with STAGE_SECONDS.time(stage="compaction"):
+                    text, compaction = self.compactor.compact(text)
+
+            def on_partial(output: list) -> None:
+                if previous_output:
+                    output = merge_fields(
+                        previous_output,
+                        output,
+                        fields=list(changed_schema["properties"]),
+                        removed=removed_fields,
+                    )
+                self.queue.update_item(
+                    job["id"],
+                    idx,
+                    dict(
+                        output=output,
+                        partial=True,
+                        metadata=resp_json.get("metadata", {}),
+                    ),
+                )
+
+            try:
+                with STAGE_SECONDS.time(stage="extract"):
+                    if not previous_output:
+                        output = llm.analyze_text(
+                            text,
+                            schema=schema,
+                            chunk_stats=chunk_stats,
+                            rule_fields=rule_fields,
+                            on_partial=on_partial,
+                        )
+                    else:
+                        new_output = []
+                        if changed_schema["properties"]:
+                            new_output = llm.analyze_text(
+                                text,
+                                schema=changed_schema,
+                                chunk_stats=chunk_stats,
+                                rule_fields=rule_fields,
+                                on_partial=on_partial,
+                            )
+                        output = merge_fields(
+                            previous_output,
+                            new_output,
+                            fields=list(changed_schema["properties"]),
+                            removed=removed_fields,
+                        )
+            except Exception as e:
+                ERRORS.inc(stage="extract")
+                logger.exception("Extraction of %s failed", resp_json["item"]["name"])
+                return dict(error=str(e))
+
+            return dict(
+                output=output,
+                chunk_stats=chunk_stats,
+                rule_fields=rule_fields,
+                compaction=compaction,
+                metadata=resp_json.get("metadata", {}),
+            )
+
+        def on_event(idx: int, stage: PipelineStage, result) -> None:
+            if not self.queue.heartbeat(job["id"], self.worker_id):
+                raise JobCancelled(job["id"])
+
+            item = items[idx]
+            if stage is PipelineStage.OCR:
+                if result is None:
+                    self.queue.complete_item(
+                        job["id"],
+                        item["idx"],
+                        ItemStatus.SKIPPED,
+                        result=dict(output=[]),
+                        error="Failed to receive OCR output",
+                    )
+                return
+
+            if "error" in result:
+                self.queue.complete_item(
+                    job["id"],
+                    item["idx"],
+                    ItemStatus.FAILED,
+                    result=dict(output=[]),
+                    error=result["error"],
+                )
+            else:
+                self.queue.complete_item(
+                    job["id"], item["idx"], ItemStatus.DONE, result=result
+                )
+
+        # Keeps the lease while a single file takes longer than the lease
+        stop = threading.Event()
+
+        def heartbeat() -> None:
+            while not stop.wait(self.queue.lease_seconds / 3):
+                self.queue.heartbeat(job["id"], self.worker_id)
+
+        heartbeat_thread = threading.Thread(target=heartbeat, daemon=True)
+        heartbeat_thread.start()
+        start = time.perf_counter()
+        try:
+            PipelineExecutor(
+                ocr_fn=ocr,
+                extract_fn=extract,
+                ocr_workers=self.ocr_workers,
+                llm_workers=self.llm_workers,
+            ).run(items, on_event=on_event)
+        finally:
+            stop.set()
+            heartbeat_thread.join()
+
+        return dict(
+            worker=self.worker_id,
+            seconds=time.perf_counter() - start,
+            usage=llm.usage(),
+        )
+
+
+def main(argv: Optional[list] = None) -> int:
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(description="Run analysis job workers")
+    parser.add_argument("--queue", default=".cache/jobs.sqlite3")
+    parser.add_argument(
+        "--ocr-url",
+        default=os.environ.get("OCR_URL"),
+        help="Host and port of the OCR service, e.g. http://localhost:8000",
+    )
+    parser.add_argument("--pdf-endpoint", default="ocr_pdf")
+    parser.add_argument("--img-endpoint", default="ocr_image")
+    parser.add_argument(
+        "--free-tier-api-key",
+        default=os.environ.get("OPENAI_API_KEY", ""),
+        help="Key for the free trial jobs; jobs with the key of a user can only "
+        "run in the app process that holds it",
+    )
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--ocr-workers", type=int, default=4)
+    parser.add_argument("--llm-workers", type=int, default=2)
+    parser.add_argument("--split-pages", action="store_true")
+    parser.add_argument("--page-workers", type=int, default=4)
+    parser.add_argument("--no-text-layer", action="store_true")
+    parser.add_argument(
+        "--no-image-preprocessing",
+        action="store_true",
+        help="Upload images to the OCR service as they are",
+    )
+    parser.add_argument("--image-max-edge", type=int, default=2000)
+    parser.add_argument("--max-chunk-tokens", type=int, default=2500)
+    parser.add_argument("--chunk-workers", type=int, default=4)
+    parser.add_argument(
+        "--retrieval-tokens",
+        type=int,
+        default=0,
+        help="Send only the passages of long documents that are relevant to the "
+        "schema, within this token budget; 0 sends the full text",
+    )
+    parser.add_argument(
+        "--no-compaction",
+        action="store_true",
+        help="Send the OCR text to the LLM without compacting it",
+    )
+    parser.add_argument(
+        "--boilerplate",
+        action="append",
+        default=[],
+        help="Regular expression of lines to drop before extraction, repeatable",
+    )
+    parser.add_argument(
+        "--no-rules",
+        action="store_true",
+        help="Send every field to the LLM instead of resolving simple ones first",
+    )
+    parser.add_argument("--rpm", type=float, help="OpenAI requests per minute per key")
+    parser.add_argument("--tpm", type=float, help="OpenAI tokens per minute per key")
+    parser.add_argument(
+        "--max-llm-concurrency",
+        type=int,
+        default=8,
+        help="Upper bound of the OpenAI calls in flight per key",
+    )
+    parser.add_argument("--ocr-cache", default=".cache/ocr.sqlite3")
+    parser.add_argument("--extraction-cache")
+    parser.add_argument("--poll-interval", type=float, default=1.0)
+    parser.add_argument("--retention-hours", type=float, default=24)
+    args = parser.parse_args(argv)
+
+    if not args.ocr_url:
+        parser.error("--ocr-url or the OCR_URL environment variable is required")
+
+    queue = JobQueue(args.queue)
+    ocr_cache = DiskCache(path=args.ocr_cache) if args.ocr_cache else None
+    extraction_cache = ExtractionCache(
+        disk=DiskCache(path=args.extraction_cache) if args.extraction_cache else None
+    )
+    client = OCRClient(pool_size=max(10, args.workers * args.ocr_workers))
+    compactor = (
+        None if args.no_compaction else TextCompactor(boilerplate=args.boilerplate)
+    )
+    rules = None if args.no_rules else RuleExtractor()
+    preprocessor = (
+        None
+        if args.no_image_preprocessing
+        else ImagePreprocessor(max_long_edge=args.image_max_edge)
+    )
+    scheduler = RateScheduler(
+        rpm=args.rpm, tpm=args.tpm, max_concurrency=args.max_llm_concurrency
+    )
+
+    workers = [
+        JobWorker(
+            queue=queue,
+            base_url=args.ocr_url.rstrip("/"),
+            pdf_endpoint=args.pdf_endpoint,
+            img_endpoint=args.img_endpoint,
+            ocr_cache=ocr_cache,
+            extraction_cache=extraction_cache,
+            client=client,
+            ocr_workers=args.ocr_workers,
+            llm_workers=args.llm_workers,
+            split_pages=args.split_pages,
+            page_workers=args.page_workers,
+            text_layer=not args.no_text_layer,
+            preprocessor=preprocessor,
+            max_chunk_tokens=args.max_chunk_tokens,
+            chunk_workers=args.chunk_workers,
+            retrieval_tokens=args.retrieval_tokens or None,
+            compactor=compactor,
+            rules=rules,
+            scheduler=scheduler,
+            poll_interval=args.poll_interval,
+            retention=args.retention_hours * 3600,
+            free_tier_api_key=args.free_tier_api_key or None,
+        )
+        for _ in range(args.workers)
+    ]
+
+    stop = threading.Event()
+    threads = [
+        threading.Thread(target=worker.run_forever, args=(stop,), daemon=True)
+        for worker in workers
+    ]
+    for thread in threads:
+        thread.start()
+    print(f"{len(workers)} workers polling {args.queue}", file=sys.stderr)
+
+    try:
+        while any(thread.is_alive() for thread in threads):
+            time.sleep(1)
+    except KeyboardInterrupt:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
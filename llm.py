@@ -16,25 +16,671 @@
 LLM Handler Code
 """
 
+import copy
+import hashlib
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Optional
+
+from langchain.callbacks import get_openai_callback
 from langchain.chat_models import ChatOpenAI
 from langchain.chains import create_extraction_chain
 
+from cache import DiskCache, MemoryCache
+from chunking import count_tokens, merge_entities, split_text
+from metrics import LLM_CALL_TOKENS, LLM_TOKENS, STAGE_SECONDS, registry
+from pipeline import SingleFlight
+from retrieval import select_passages
+from rules import RuleExtractor
+from scheduler import RateScheduler
+from utils import canonical_schema
+from validation import missing_required, validate_output
+
+DEFAULT_MODEL = "gpt-3.5-turbo"
+EXTRACTION_FLIGHT_TIMEOUT = 600.0
+# Tokens of the extraction prompt around the text and of a typical response,
+# used to charge calls against the tokens per minute budget before they run
+PROMPT_OVERHEAD_TOKENS = 200
+COMPLETION_TOKENS_ESTIMATE = 256
+
+RETRIEVALS = registry.counter(
+    "retrieval_total", "Extractions from retrieved passages by outcome"
+)
+LLM_COST = registry.counter(
+    "llm_cost_dollars_total", "Estimated cost of the LLM calls in US dollars"
+)
+CASCADE = registry.counter(
+    "cascade_total", "Extractions per model of the cascade by validation result"
+)
+CASCADE_SECONDS = registry.histogram(
+    "cascade_seconds", "Duration of the extractions per model of the cascade"
+)
+ESCALATIONS = registry.counter(
+    "cascade_escalated_fields_total", "Invalid fields that caused an escalation"
+)
+
+
+def extraction_key(text: str, schema: dict, model_name: str, temperature: float) -> str:
+    """Cache key of an extraction request
+
+    Args:
+        text (str): OCR Output to be analyzed
+        schema (dict): Schema to be processed
+        model_name (str): OpenAI model used for the extraction
+        temperature (float): Sampling temperature
+
+    Returns:
+        str: SHA-256 hex digest identifying the request
+    """
+    text_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    key = json.dumps(
+        [text_hash, canonical_schema(schema), model_name, float(temperature)]
+    )
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+class ExtractionCache:
+    """Memoizes extraction results in memory with an optional on-disk tier"""
+
+    def __init__(
+        self, max_entries: int = 256, disk: Optional[DiskCache] = None
+    ) -> None:
+        """
+        Args:
+            max_entries (int): Maximum number of results kept in memory
+            disk (DiskCache, optional): Persistent tier behind the memory tier
+        """
+        self.memory = MemoryCache(max_entries=max_entries)
+        self.disk = disk
+
+    def get(self, key: str) -> Optional[list]:
+        """Get an extraction result
+
+        Args:
+            key (str): Key built by `extraction_key`
+
+        Returns:
+            Optional[list]: Extracted entities or None on a miss
+        """
+        output = self.memory.get(key)
+        if output is None and self.disk is not None:
+            cached = self.disk.get(key)
+            if cached is not None:
+                output = cached["output"]
+                self.memory.set(key, output)
+
+        return copy.deepcopy(output)
+
+    def set(self, key: str, output: list) -> None:
+        """Store an extraction result in every tier
+
+        Args:
+            key (str): Key built by `extraction_key`
+            output (list): Extracted entities
+        """
+        self.memory.set(key, copy.deepcopy(output))
+        if self.disk is not None:
+            self.disk.set(key, dict(output=output))
+
+    def stats(self) -> dict:
+        """Cache statistics
+
+        Returns:
+            dict: Statistics of the memory and the disk tier
+        """
+        return dict(
+            memory=self.memory.stats(),
+            disk=self.disk.stats() if self.disk is not None else None,
+        )
+
+
+def _chat_openai(openai_api_key: str, model_name: str, temperature: float):
+    # Rate limit errors are retried by the scheduler, which adapts to them
+    return ChatOpenAI(
+        temperature=temperature,
+        openai_api_key=openai_api_key,
+        model_name=model_name,
+        max_retries=0,
+    )
+
+
+class ClientPool:
+    """Shares chat model clients and their compiled extraction chains
+
+    Clients are keyed by (api key, model, temperature) and every client keeps
+    a bounded LRU cache of extraction chains keyed by the canonical schema.
+    Clients that were not used for `max_idle` seconds are released together
+    with their chains.
+    """
+
+    def __init__(
+        self,
+        max_chains: int = 64,
+        max_idle: float = 15 * 60,
+        factory: Optional[Callable] = None,
+    ) -> None:
+        """
+        Args:
+            max_chains (int): Maximum number of chains cached per client
+            max_idle (float): Seconds after which an unused client is released
+            factory (Callable, optional): Builds a chat model from
+                (openai_api_key, model_name, temperature), defaults to ChatOpenAI
+        """
+        self.max_chains = max_chains
+        self.max_idle = max_idle
+        self.factory = factory or _chat_openai
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def _entry(self, openai_api_key: str, model_name: str, temperature: float) -> dict:
+        key = (
+            hashlib.sha256(openai_api_key.encode("utf-8")).hexdigest(),
+            model_name,
+            float(temperature),
+        )
+        now = time.monotonic()
+        with self._lock:
+            self._release_idle(now)
+            entry = self._clients.get(key)
+            if entry is None:
+                entry = dict(
+                    llm=self.factory(openai_api_key, model_name, temperature),
+                    chains=MemoryCache(max_entries=self.max_chains),
+                    lock=threading.Lock(),
+                )
+                self._clients[key] = entry
+            entry["last_used"] = now
+            return entry
+
+    def _release_idle(self, now: float) -> None:
+        for key in [
+            key
+            for key, entry in self._clients.items()
+            if now - entry["last_used"] > self.max_idle
+        ]:
+            del self._clients[key]
+
+    def client(self, openai_api_key: str, model_name: str, temperature: float):
+        """Get a chat model client
+
+        Args:
+            openai_api_key (str): OpenAI API key
+            model_name (str): OpenAI model
+            temperature (float): Sampling temperature
+
+        Returns:
+            ChatOpenAI: Shared client
+        """
+        return self._entry(openai_api_key, model_name, temperature)["llm"]
+
+    def chain(
+        self, openai_api_key: str, model_name: str, temperature: float, schema: dict
+    ):
+        """Get an extraction chain for a schema
+
+        Args:
+            openai_api_key (str): OpenAI API key
+            model_name (str): OpenAI model
+            temperature (float): Sampling temperature
+            schema (dict): Schema to be processed
+
+        Returns:
+            Chain: Shared extraction chain
+        """
+        entry = self._entry(openai_api_key, model_name, temperature)
+        key = canonical_schema(schema)
+        with entry["lock"]:
+            chain = entry["chains"].get(key)
+            if chain is None:
+                chain = create_extraction_chain(schema, entry["llm"])
+                entry["chains"].set(key, chain)
+        return chain
+
+    def stats(self) -> dict:
+        """Pool statistics
+
+        Returns:
+            dict: Number of pooled clients plus chain cache hits and misses
+        """
+        with self._lock:
+            entries = list(self._clients.values())
+
+        chain_stats = [entry["chains"].stats() for entry in entries]
+        return dict(
+            clients=len(entries),
+            chains=sum(stat["entries"] for stat in chain_stats),
+            chain_hits=sum(stat["hits"] for stat in chain_stats),
+            chain_misses=sum(stat["misses"] for stat in chain_stats),
+        )
+
+
+default_pool = ClientPool()
+default_scheduler = RateScheduler()
+extraction_flight = SingleFlight("extraction", timeout=EXTRACTION_FLIGHT_TIMEOUT)
+
 
 class LLM:
     """Handles communication with OpenAI LLMs"""
 
-    def __init__(self, temperature: float, openai_api_key: str) -> None:
-        self.llm = ChatOpenAI(temperature=temperature, openai_api_key=openai_api_key)
+    def __init__(
+        self,
+        temperature: float,
+        openai_api_key: str,
+        model_name: str = DEFAULT_MODEL,
+        cache: Optional[ExtractionCache] = None,
+        max_chunk_tokens: Optional[int] = None,
+        retrieval_tokens: Optional[int] = None,
+        chunk_workers: int = 4,
+        pool: Optional[ClientPool] = None,
+        flight: Optional[SingleFlight] = None,
+        rules: Optional[RuleExtractor] = None,
+        scheduler: Optional[RateScheduler] = None,
+        tenant: str = "default",
+        escalation_models: Optional[list] = None,
+    ) -> None:
+        self.temperature = temperature
+        self.openai_api_key = openai_api_key
+        self._key_hash = hashlib.sha256(openai_api_key.encode("utf-8")).hexdigest()
+        self.model_name = model_name
+        self.cache = cache
+        self.max_chunk_tokens = max_chunk_tokens
+        self.retrieval_tokens = retrieval_tokens
+        self.chunk_workers = chunk_workers
+        self.pool = pool or default_pool
+        self.flight = flight or extraction_flight
+        self.rules = rules
+        self.scheduler = scheduler or default_scheduler
+        self.tenant = tenant
+        self.llm = self.pool.client(openai_api_key, model_name, temperature)
+        self._usage = dict(
+            calls=0,
+            fast_path=0,
+            rule_fields=0,
+            cache_hits=0,
+            coalesced=0,
+            retrieved=0,
+            fallbacks=0,
+            prompt_tokens=0,
+            completion_tokens=0,
+            cost=0.0,
+        )
+        self._usage_lock = threading.Lock()
+        # The models tried in turn when the output of the previous one does
+        # not validate against the schema, sharing everything but the model
+        self._tiers = [self] + [
+            LLM(
+                temperature,
+                openai_api_key,
+                model_name=escalation_model,
+                cache=cache,
+                max_chunk_tokens=max_chunk_tokens,
+                retrieval_tokens=retrieval_tokens,
+                chunk_workers=chunk_workers,
+                pool=self.pool,
+                flight=self.flight,
+                scheduler=self.scheduler,
+                tenant=tenant,
+            )
+            for escalation_model in escalation_models or []
+        ]
+        self._tier_stats = [
+            dict(
+                model=tier.model_name, attempts=0, accepted=0, escalated=0, seconds=0.0
+            )
+            for tier in self._tiers
+        ]
 
-    def analyze_text(self, text: str, schema: dict) -> dict:
+    def analyze_text(
+        self,
+        text: str,
+        schema: dict,
+        chunk_stats: Optional[list] = None,
+        rule_fields: Optional[list] = None,
+        on_partial: Optional[Callable[[list], None]] = None,
+    ) -> dict:
         """Analyze text according to schema
 
+        Fields that the `rules` resolve are not sent to the LLM, which is not
+        called at all when every field is resolved; their values are added to
+        every entity extracted by the LLM. Texts longer than `retrieval_tokens`
+        are reduced to the passages most relevant to the schema, falling back
+        to the full text if required fields come back empty. Texts longer than
+        `max_chunk_tokens` are analyzed in chunks, see `analyze_text_chunked`.
+        Concurrent calls for the same text, schema, model and temperature, from
+        any session, share a single LLM call. With `escalation_models` the
+        output is validated against the required fields and types of the
+        schema and documents that fail are extracted again with the next model.
+
+        The extraction chain returns a single function call, so partial output
+        is streamed at the granularity of the rules and of the chunks:
+        `on_partial` receives the entities known so far after the rules ran
+        and whenever a chunk finishes.
+
         Args:
             text (str): OCR Output to be analyzed
             schema (dict): Schema to be processed
+            chunk_stats (list, optional): Receives the per chunk statistics
+                when the text is analyzed in chunks
+            rule_fields (list, optional): Receives the fields resolved by the
+                rules
+            on_partial (Callable, optional): Called with the entities
+                extracted so far while the analysis is running
 
         Returns:
             dict: LLM Response
         """
-        chain = create_extraction_chain(schema, self.llm)
+        if self.rules is None:
+            return self._cascade(text, schema, chunk_stats, on_partial)
+
+        found, unresolved = self.rules.extract(text, schema)
+        if rule_fields is not None:
+            rule_fields.extend(found)
+        with self._usage_lock:
+            self._usage["rule_fields"] += len(found)
+        if not unresolved["properties"]:
+            self._record_usage([])
+            self._count("fast_path")
+            return [found]
+
+        def fill(output: list) -> list:
+            if not found:
+                return output
+            return [
+                {
+                    field: dict(found, **entity).get(field)
+                    for field in schema["properties"]
+                }
+                for entity in output or [{}]
+            ]
+
+        def partial(output: list) -> None:
+            on_partial(fill(output))
+
+        if on_partial is not None and found:
+            on_partial(fill([]))
+        return fill(
+            self._cascade(
+                text,
+                unresolved,
+                chunk_stats,
+                partial if on_partial is not None else None,
+            )
+        )
+
+    def _cascade(
+        self,
+        text: str,
+        schema: dict,
+        chunk_stats: Optional[list] = None,
+        on_partial: Optional[Callable[[list], None]] = None,
+    ) -> list:
+        """Extracts with each model in turn until the output is valid, the
+        output of the last model is returned as is
+
+        Only valid outputs are cached under the key of the model that produced
+        them, and the final output is also cached under the key of the first
+        model, so that a repeated call does not escalate again.
+        """
+        if len(self._tiers) == 1:
+            return self._analyze(text, schema, chunk_stats, on_partial)
+
+        last = len(self._tiers) - 1
+        for level, tier in enumerate(self._tiers):
+            start = time.perf_counter()
+            output = tier._analyze(
+                text, schema, chunk_stats, on_partial, validate=level < last
+            )
+            seconds = time.perf_counter() - start
+            problems = validate_output(output, schema)
+            escalate = bool(problems) and level < len(self._tiers) - 1
+
+            CASCADE_SECONDS.observe(seconds, model=tier.model_name)
+            CASCADE.inc(
+                model=tier.model_name,
+                result="escalated" if escalate else "invalid" if problems else "valid",
+            )
+            with self._usage_lock:
+                stats = self._tier_stats[level]
+                stats["attempts"] += 1
+                stats["seconds"] += seconds
+                stats["escalated" if escalate else "accepted"] += 1
+            if not escalate:
+                if level > 0 and self.cache is not None:
+                    self.cache.set(
+                        extraction_key(text, schema, self.model_name, self.temperature),
+                        output,
+                    )
+                return output
+            for _, reason in problems:
+                ESCALATIONS.inc(model=tier.model_name, reason=reason)
+
+    def _analyze(
+        self,
+        text: str,
+        schema: dict,
+        chunk_stats: Optional[list] = None,
+        on_partial: Optional[Callable[[list], None]] = None,
+        validate: bool = False,
+    ) -> list:
+        key = extraction_key(text, schema, self.model_name, self.temperature)
+        if self.cache is not None:
+            output = self.cache.get(key)
+            if output is not None:
+                self._record_usage([], cache_hit=True)
+                return output
+
+        def extract() -> list:
+            output, stats = self._extract_relevant(
+                text, schema, chunk_stats, on_partial
+            )
+            self._record_usage(stats)
+            # An invalid output would make every repeated call escalate
+            if self.cache is not None and not (
+                validate and validate_output(output, schema)
+            ):
+                self.cache.set(key, output)
+            return output
+
+        # Calls only coalesce with calls of the same OpenAI key, so that an
+        # invalid or rate limited key fails its own requests only
+        output, leader = self.flight.do((key, self._key_hash), extract)
+        if not leader:
+            self._record_usage([], coalesced=True)
+            return copy.deepcopy(output)
+        return output
+
+    def usage(self) -> dict:
+        """Token usage of all `analyze_text` calls made through this object
+
+        Returns:
+            dict: Number of calls, calls answered by the rules alone, fields
+            resolved by the rules, cache hits, calls that waited for an identical
+            call in flight, extractions from retrieved passages, fallbacks to
+            the full text, prompt and completion tokens and estimated cost. With
+            `escalation_models` the tokens and cost include all models, and the
+            escalation rate and the attempts, escalations, seconds, tokens and
+            cost per model are added
+        """
+        with self._usage_lock:
+            usage = dict(self._usage)
+            tiers = [dict(stats) for stats in self._tier_stats]
+        if len(self._tiers) == 1:
+            return usage
+
+        for tier, stats in zip(self._tiers, tiers):
+            tier_usage = usage if tier is self else tier.usage()
+            for key in ("prompt_tokens", "completion_tokens", "cost"):
+                stats[key] = tier_usage[key]
+        for key in ("prompt_tokens", "completion_tokens", "cost"):
+            usage[key] = sum(stats[key] for stats in tiers)
+
+        first = tiers[0]
+        usage["escalation_rate"] = (
+            first["escalated"] / first["attempts"] if first["attempts"] else 0.0
+        )
+        usage["tiers"] = tiers
+        return usage
+
+    def _record_usage(
+        self, stats: list, cache_hit: bool = False, coalesced: bool = False
+    ) -> None:
+        prompt_tokens = sum(stat["prompt_tokens"] for stat in stats)
+        completion_tokens = sum(stat["completion_tokens"] for stat in stats)
+        cost = sum(stat.get("cost", 0.0) for stat in stats)
+        if stats:
+            LLM_TOKENS.inc(prompt_tokens, model=self.model_name, kind="prompt")
+            LLM_TOKENS.inc(completion_tokens, model=self.model_name, kind="completion")
+            LLM_CALL_TOKENS.observe(
+                prompt_tokens + completion_tokens, model=self.model_name
+            )
+            LLM_COST.inc(cost, model=self.model_name)
+            for stat in stats:
+                STAGE_SECONDS.observe(stat["latency"], stage="chain")
+
+        with self._usage_lock:
+            self._usage["calls"] += 1
+            self._usage["cache_hits"] += int(cache_hit)
+            self._usage["coalesced"] += int(coalesced)
+            self._usage["prompt_tokens"] += prompt_tokens
+            self._usage["completion_tokens"] += completion_tokens
+            self._usage["cost"] += cost
+
+    def analyze_text_chunked(
+        self,
+        text: str,
+        schema: dict,
+        on_partial: Optional[Callable[[list], None]] = None,
+    ) -> tuple:
+        """Analyze a long text by extracting from its chunks concurrently
+
+        The text is split on page and paragraph boundaries so that every chunk
+        fits `max_chunk_tokens`. The entities extracted from each chunk are
+        merged and deduplicated.
+
+        Args:
+            text (str): OCR Output to be analyzed
+            schema (dict): Schema to be processed
+            on_partial (Callable, optional): Called with the merged entities
+                of the finished chunks whenever a chunk finishes
+
+        Returns:
+            tuple: Merged LLM Response and a list with the latency and token
+            counts of every chunk
+        """
+        chunks = split_text(text, self.max_chunk_tokens, self.model_name)
+        results = [None] * len(chunks)
+        with ThreadPoolExecutor(
+            max_workers=max(1, min(self.chunk_workers, len(chunks))),
+            thread_name_prefix="chunk",
+        ) as pool:
+            futures = {
+                pool.submit(self._run_chunk, chunk, schema): idx
+                for idx, chunk in enumerate(chunks)
+            }
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+                if on_partial is not None and None in results:
+                    on_partial(
+                        merge_entities(
+                            [result[0] for result in results if result is not None]
+                        )
+                    )
+
+        outputs = [output for output, _ in results]
+        stats = [dict(chunk=idx, **stat) for idx, (_, stat) in enumerate(results)]
+        return merge_entities(outputs), stats
+
+    def _extract_relevant(
+        self,
+        text: str,
+        schema: dict,
+        chunk_stats: Optional[list] = None,
+        on_partial: Optional[Callable[[list], None]] = None,
+    ) -> tuple:
+        """Extracts from the passages relevant to the schema when the text is
+        longer than `retrieval_tokens`, and from the full text if that leaves
+        required fields empty or finds several entities, whose siblings may
+        sit in passages that were not selected"""
+        if (
+            self.retrieval_tokens is None
+            or count_tokens(text, self.model_name) <= self.retrieval_tokens
+        ):
+            return self._extract(text, schema, chunk_stats, on_partial)
+
+        # Without required fields an incomplete result cannot be detected
+        if not schema.get("required"):
+            RETRIEVALS.inc(result="no_required")
+            return self._extract(text, schema, chunk_stats, on_partial)
+
+        selected = select_passages(text, schema, self.retrieval_tokens, self.model_name)
+        if selected is None:
+            RETRIEVALS.inc(result="no_match")
+            return self._extract(text, schema, chunk_stats, on_partial)
+
+        output, stats = self._extract(selected[0], schema, chunk_stats)
+        if len(output) <= 1 and not missing_required(output, schema):
+            RETRIEVALS.inc(result="used")
+            self._count("retrieved")
+            return output, stats
+
+        RETRIEVALS.inc(result="fallback")
+        self._count("fallbacks")
+        full_output, full_stats = self._extract(text, schema, chunk_stats, on_partial)
+        return full_output, stats + full_stats
+
+    def _count(self, key: str) -> None:
+        with self._usage_lock:
+            self._usage[key] += 1
+
+    def _extract(
+        self,
+        text: str,
+        schema: dict,
+        chunk_stats: Optional[list] = None,
+        on_partial: Optional[Callable[[list], None]] = None,
+    ) -> tuple:
+        if (
+            self.max_chunk_tokens is None
+            or count_tokens(text, self.model_name) <= self.max_chunk_tokens
+        ):
+            output, stat = self._run_chunk(text, schema)
+            return output, [stat]
+
+        output, stats = self.analyze_text_chunked(text, schema, on_partial)
+        if chunk_stats is not None:
+            chunk_stats.extend(stats)
+        return output, stats
+
+    def _run_chunk(self, chunk: str, schema: dict) -> tuple:
+        start = time.perf_counter()
+        text_tokens = count_tokens(chunk, self.model_name)
+        estimate = (
+            text_tokens
+            + count_tokens(canonical_schema(schema), self.model_name)
+            + PROMPT_OVERHEAD_TOKENS
+            + COMPLETION_TOKENS_ESTIMATE
+        )
+        with get_openai_callback() as cb:
+            output = self.scheduler.call(
+                self.openai_api_key,
+                lambda: self._run_chain(chunk, schema),
+                tokens=estimate,
+                tenant=self.tenant,
+                used=lambda _: cb.total_tokens,
+            )
+
+        return output, dict(
+            text_tokens=text_tokens,
+            prompt_tokens=cb.prompt_tokens,
+            completion_tokens=cb.completion_tokens,
+            cost=cb.total_cost,
+            latency=time.perf_counter() - start,
+        )
+
+    def _run_chain(self, text: str, schema: dict) -> list:
+        chain = self.pool.chain(
+            self.openai_api_key, self.model_name, self.temperature, schema
+        )
         return chain.run(text)
@@ -0,0 +1,429 @@
+# Copyright 2023 Aditya Mohan
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Stage timings, counters and their Prometheus exposition
+"""
+
+import bisect
+import functools
+import http.server
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterator
+
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+STAGE_BUCKETS = (0.001, 0.005, 0.01, 0.05) + LATENCY_BUCKETS
+TOKEN_BUCKETS = (100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000)
+
+
+class LatencyHistogram:
+    """Cumulative latency histogram in the Prometheus format"""
+
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS) -> None:
+        """
+        Args:
+            buckets (tuple): Upper bounds of the buckets in seconds
+        """
+        self.buckets = tuple(sorted(buckets))
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float) -> None:
+        """Records a latency
+
+        Args:
+            seconds (float): Observed latency
+        """
+        with self._lock:
+            self._counts[bisect.bisect_left(self.buckets, seconds)] += 1
+            self._sum += seconds
+
+    def snapshot(self) -> dict:
+        """Current state of the histogram
+
+        Returns:
+            dict: Cumulative bucket counts keyed by upper bound, total count and
+            sum of all observations
+        """
+        with self._lock:
+            counts, total = list(self._counts), self._sum
+
+        cumulative = {}
+        running = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            running += count
+            cumulative[bound] = running
+
+        return dict(buckets=cumulative, count=running, sum=total)
+
+
+def _labels(labels: dict, **extra) -> str:
+    labels = {**labels, **extra}
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in sorted(labels.items())) + "}"
+
+
+def render_histogram(name: str, help: str, snapshots: dict) -> list:
+    """Histograms in the Prometheus text exposition format
+
+    Args:
+        name (str): Metric name
+        help (str): Metric description
+        snapshots (dict): Histogram snapshots keyed by a tuple of label pairs
+
+    Returns:
+        list: Exposition lines
+    """
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} histogram"]
+    for label_key, snapshot in sorted(snapshots.items()):
+        labels = dict(label_key)
+        for bound, count in snapshot["buckets"].items():
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            lines.append(f"{name}_bucket{_labels(labels, le=le)} {count}")
+        lines.append(f"{name}_sum{_labels(labels)} {snapshot['sum']}")
+        lines.append(f"{name}_count{_labels(labels)} {snapshot['count']}")
+    return lines
+
+
+def render_counter(name: str, help: str, values: dict) -> list:
+    """Counters in the Prometheus text exposition format
+
+    Args:
+        name (str): Metric name
+        help (str): Metric description
+        values (dict): Counter values keyed by a tuple of label pairs
+
+    Returns:
+        list: Exposition lines
+    """
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} counter"]
+    for label_key, value in sorted(values.items()):
+        lines.append(f"{name}{_labels(dict(label_key))} {value}")
+    return lines
+
+
+def render_gauge(name: str, help: str, values: dict) -> list:
+    """Gauges in the Prometheus text exposition format
+
+    Args:
+        name (str): Metric name
+        help (str): Metric description
+        values (dict): Gauge values keyed by a tuple of label pairs
+
+    Returns:
+        list: Exposition lines
+    """
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} gauge"]
+    for label_key, value in sorted(values.items()):
+        lines.append(f"{name}{_labels(dict(label_key))} {value}")
+    return lines
+
+
+class Histogram:
+    """Labelled family of histograms"""
+
+    def __init__(self, name: str, help: str, buckets: tuple = LATENCY_BUCKETS):
+        """
+        Args:
+            name (str): Metric name
+            help (str): Metric description
+            buckets (tuple): Upper bounds of the buckets
+        """
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        """Records an observation
+
+        Args:
+            value (float): Observed value
+        """
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            if key not in self._histograms:
+                self._histograms[key] = LatencyHistogram(self.buckets)
+            histogram = self._histograms[key]
+        histogram.observe(value)
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        """Observes the duration of the block in seconds"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def snapshots(self) -> dict:
+        """Snapshots of all histograms keyed by a tuple of label pairs"""
+        with self._lock:
+            histograms = dict(self._histograms)
+        return {key: h.snapshot() for key, h in histograms.items()}
+
+    def render(self) -> list:
+        return render_histogram(self.name, self.help, self.snapshots())
+
+
+class Counter:
+    """Labelled family of monotonic counters"""
+
+    def __init__(self, name: str, help: str) -> None:
+        """
+        Args:
+            name (str): Metric name
+            help (str): Metric description
+        """
+        self.name = name
+        self.help = help
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, value: float = 1, **labels) -> None:
+        """Increments the counter
+
+        Args:
+            value (float): Increment
+        """
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def values(self) -> dict:
+        """Counter values keyed by a tuple of label pairs"""
+        with self._lock:
+            return dict(self._values)
+
+    def render(self) -> list:
+        return render_counter(self.name, self.help, self.values())
+
+
+class Registry:
+    """Metrics of the process and collectors of other components"""
+
+    def __init__(self) -> None:
+        self._metrics = []
+        self._collectors = {}
+        self._lock = threading.Lock()
+
+    def histogram(
+        self, name: str, help: str, buckets: tuple = LATENCY_BUCKETS
+    ) -> Histogram:
+        """Registers a histogram family
+
+        Args:
+            name (str): Metric name
+            help (str): Metric description
+            buckets (tuple): Upper bounds of the buckets
+
+        Returns:
+            Histogram: Registered histogram
+        """
+        histogram = Histogram(name, help, buckets)
+        with self._lock:
+            self._metrics.append(histogram)
+        return histogram
+
+    def counter(self, name: str, help: str) -> Counter:
+        """Registers a counter family
+
+        Args:
+            name (str): Metric name
+            help (str): Metric description
+
+        Returns:
+            Counter: Registered counter
+        """
+        counter = Counter(name, help)
+        with self._lock:
+            self._metrics.append(counter)
+        return counter
+
+    def add_collector(self, name: str, collect: Callable[[], str]) -> None:
+        """Adds or replaces a source of exposition text, e.g. the OCR client
+
+        Args:
+            name (str): Collector name
+            collect (Callable): Returns metrics in the text exposition format
+        """
+        with self._lock:
+            self._collectors[name] = collect
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format
+
+        Returns:
+            str: Metrics text
+        """
+        with self._lock:
+            metrics, collectors = list(self._metrics), list(self._collectors.values())
+
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        text = "\n".join(lines) + "\n"
+        for collect in collectors:
+            text += collect()
+        return text
+
+
+registry = Registry()
+
+STAGE_SECONDS = registry.histogram(
+    "stage_seconds", "Duration of pipeline stages", STAGE_BUCKETS
+)
+LLM_TOKENS = registry.counter(
+    "llm_tokens_total", "Tokens sent to and received from the LLM"
+)
+LLM_CALL_TOKENS = registry.histogram(
+    "llm_call_tokens", "Tokens used per analyze_text call", TOKEN_BUCKETS
+)
+ERRORS = registry.counter("errors_total", "Failed pipeline stages")
+
+
+def render_cache_stats(stats: dict) -> str:
+    """Hit and miss totals of caches in the text exposition format
+
+    Args:
+        stats (dict): `stats()` of every cache keyed by cache name
+
+    Returns:
+        str: Metrics text
+    """
+    values = {}
+    for cache, cache_stats in stats.items():
+        for result in ("hits", "misses"):
+            values[(("cache", cache), ("result", result))] = cache_stats[result]
+    return (
+        "\n".join(render_counter("cache_lookups_total", "Cache lookups", values)) + "\n"
+    )
+
+
+class Trace:
+    """Per stage timings of one session
+
+    Only aggregates are kept so that a trace stays small however often the
+    page is rerun. Every span is also observed in `STAGE_SECONDS`.
+    """
+
+    def __init__(self) -> None:
+        self._stages = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, stage: str) -> Iterator[None]:
+        """Times the block as one occurrence of a stage
+
+        Args:
+            stage (str): Stage name
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def wrap(self, stage: str) -> Callable:
+        """Decorator timing every call of a function as a stage
+
+        Args:
+            stage (str): Stage name
+        """
+
+        def decorator(fn: Callable) -> Callable:
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.span(stage):
+                    return fn(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def record(self, stage: str, seconds: float) -> None:
+        """Records a stage duration measured elsewhere
+
+        Args:
+            stage (str): Stage name
+            seconds (float): Duration
+        """
+        STAGE_SECONDS.observe(seconds, stage=stage)
+        with self._lock:
+            count, total, slowest = self._stages.get(stage, (0, 0.0, 0.0))
+            self._stages[stage] = (count + 1, total + seconds, max(slowest, seconds))
+
+    def summary(self) -> list:
+        """Aggregated timings in order of first occurrence
+
+        Returns:
+            list: Count, total, mean and maximum seconds per stage
+        """
+        with self._lock:
+            stages = dict(self._stages)
+
+        return [
+            dict(
+                stage=stage,
+                count=count,
+                total_seconds=total,
+                mean_seconds=total / count,
+                max_seconds=slowest,
+            )
+            for stage, (count, total, slowest) in stages.items()
+        ]
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    registry = registry
+
+    def do_GET(self) -> None:
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+
+        body = self.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+def start_http_server(
+    port: int, addr: str = "0.0.0.0", registry: Registry = registry
+) -> http.server.ThreadingHTTPServer:
+    """Serves the registry on /metrics from a daemon thread
+
+    Args:
+        port (int): Port to listen on
+        addr (str): Address to bind
+        registry (Registry): Metrics to expose
+
+    Returns:
+        ThreadingHTTPServer: Running server
+    """
+    handler = type("MetricsHandler", (_MetricsHandler,), dict(registry=registry))
+    server = http.server.ThreadingHTTPServer((addr, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
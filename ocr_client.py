@@ -0,0 +1,356 @@
+# Copyright 2023 Aditya Mohan
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+HTTP client for the OCR service
+"""
+
+import io
+import random
+import threading
+import time
+import uuid
+from typing import Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import LatencyHistogram, render_histogram
+
+UPLOAD_BLOCK_SIZE = 64 * 1024
+RETRY_STATUS_CODES = frozenset({429, 500, 502, 503, 504})
+
+
+class CircuitOpenError(Exception):
+    """Raised while the circuit breaker rejects requests to the OCR service"""
+
+
+class MultipartStream:
+    """multipart/form-data request body that is read lazily
+
+    `requests` builds the complete body of a `files=` upload in memory. This
+    body instead reads the files block by block while it is being sent, so
+    the memory needed per upload stays flat regardless of the file size.
+    """
+
+    def __init__(
+        self, fields: dict, files: list, block_size: int = UPLOAD_BLOCK_SIZE
+    ) -> None:
+        """
+        Args:
+            fields (dict): Form fields
+            files (list): Files as (field, (file_name, file_obj, content_type))
+            block_size (int): Number of bytes read from a file at a time
+        """
+        self.boundary = uuid.uuid4().hex
+        self.block_size = block_size
+        self._parts = []
+
+        for name, value in (fields or {}).items():
+            self._parts.append(
+                (
+                    f"--{self.boundary}\r\n"
+                    f'Content-Disposition: form-data; name="{name}"\r\n\r\n'
+                    f"{value}\r\n"
+                ).encode("utf-8")
+            )
+
+        for name, (file_name, file_obj, content_type) in files:
+            self._parts.append(
+                (
+                    f"--{self.boundary}\r\n"
+                    f'Content-Disposition: form-data; name="{name}"; '
+                    f'filename="{file_name}"\r\n'
+                    f"Content-Type: {content_type}\r\n\r\n"
+                ).encode("utf-8")
+            )
+            self._parts.append(file_obj)
+            self._parts.append(b"\r\n")
+
+        self._parts.append(f"--{self.boundary}--\r\n".encode("utf-8"))
+
+        self._length = 0
+        self._positions = {}
+        for idx, part in enumerate(self._parts):
+            if isinstance(part, bytes):
+                self._length += len(part)
+            else:
+                position = part.tell()
+                self._length += part.seek(0, io.SEEK_END) - position
+                part.seek(position)
+                self._positions[idx] = position
+
+        self._current = 0
+        self._offset = 0
+
+    def reset(self) -> None:
+        """Rewinds the body so that it can be sent again"""
+        for idx, position in self._positions.items():
+            self._parts[idx].seek(position)
+
+        self._current = 0
+        self._offset = 0
+
+    @property
+    def content_type(self) -> str:
+        """Content-Type header of the body"""
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def __len__(self) -> int:
+        return self._length
+
+    def read(self, size: int = -1) -> bytes:
+        """Reads up to `size` bytes of the body, everything if negative"""
+        if size is None or size < 0:
+            size = self._length
+
+        out = bytearray()
+        while len(out) < size and self._current < len(self._parts):
+            part = self._parts[self._current]
+            wanted = min(size - len(out), self.block_size)
+            if isinstance(part, bytes):
+                data = part[self._offset : self._offset + wanted]
+                self._offset += len(data)
+                if self._offset >= len(part):
+                    self._current += 1
+                    self._offset = 0
+            else:
+                data = part.read(wanted)
+                if len(data) < wanted:
+                    self._current += 1
+
+            out += data
+
+        return bytes(out)
+
+
+class CircuitBreaker:
+    """Fails fast while the OCR service keeps failing
+
+    The circuit opens after `failure_threshold` consecutive failures. While
+    open every request is rejected until `reset_timeout` seconds have passed,
+    then a single trial request is let through. Its success closes the
+    circuit again, its failure keeps it open for another `reset_timeout`.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0) -> None:
+        """
+        Args:
+            failure_threshold (int): Consecutive failures that open the circuit
+            reset_timeout (float): Seconds before a trial request is allowed
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        """Whether the circuit currently rejects requests"""
+        with self._lock:
+            return self._opened_at is not None
+
+    def allow(self) -> bool:
+        """Whether a request may be sent now"""
+        with self._lock:
+            if self._opened_at is None:
+                return True
+
+            if self._trial_running:
+                return False
+
+            if time.monotonic() - self._opened_at >= self.reset_timeout:
+                self._trial_running = True
+                return True
+
+            return False
+
+    def record_success(self) -> None:
+        """Records a successful request"""
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def record_failure(self) -> None:
+        """Records a failed request"""
+        with self._lock:
+            self._failures += 1
+            self._trial_running = False
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+
+
+class OCRClient:
+    """Pooled HTTP client for the OCR service
+
+    Requests share keep-alive connections from a bounded pool, have connect
+    and read timeouts, are retried with jittered exponential backoff on
+    connection errors and 5xx responses, and are rejected early while the
+    circuit breaker is open. Latencies are recorded per endpoint.
+    """
+
+    def __init__(
+        self,
+        pool_size: int = 10,
+        connect_timeout: float = 5.0,
+        read_timeout: float = 300.0,
+        max_retries: int = 3,
+        backoff_base: float = 0.5,
+        backoff_max: float = 10.0,
+        breaker: Optional[CircuitBreaker] = None,
+    ) -> None:
+        """
+        Args:
+            pool_size (int): Maximum number of pooled connections
+            connect_timeout (float): Seconds to wait for a connection
+            read_timeout (float): Seconds to wait for the OCR response
+            max_retries (int): Retries after the first attempt
+            backoff_base (float): Backoff before the first retry in seconds
+            backoff_max (float): Upper bound of the backoff in seconds
+            breaker (CircuitBreaker, optional): Shared circuit breaker
+        """
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker = breaker or CircuitBreaker()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def _histogram(self, endpoint: str) -> LatencyHistogram:
+        with self._lock:
+            if endpoint not in self._histograms:
+                self._histograms[endpoint] = LatencyHistogram()
+            return self._histograms[endpoint]
+
+    def _backoff(self, attempt: int) -> float:
+        return random.uniform(
+            0, min(self.backoff_max, self.backoff_base * 2**attempt)
+        )
+
+    def post(
+        self, url: str, body: MultipartStream, headers: Optional[dict] = None
+    ) -> requests.Response:
+        """Posts a multipart body to the OCR service
+
+        Args:
+            url (str): OCR service endpoint
+            body (MultipartStream): Request body, rewound before every retry
+            headers (dict, optional): Additional request headers
+
+        Raises:
+            CircuitOpenError: The circuit breaker rejected the request
+            requests.RequestException: The last attempt failed to connect or
+                timed out, or any attempt failed otherwise
+
+        Returns:
+            requests.Response: Response of the last attempt
+        """
+        histogram = self._histogram(url.rsplit("/", 1)[-1])
+        headers = {**(headers or {}), "Content-Type": body.content_type}
+
+        for attempt in range(self.max_retries + 1):
+            if not self.breaker.allow():
+                raise CircuitOpenError(
+                    f"OCR service circuit is open, not calling {url}"
+                )
+
+            if attempt > 0:
+                body.reset()
+
+            start = time.perf_counter()
+            try:
+                resp = self.session.post(
+                    url, data=body, headers=headers, timeout=self.timeout
+                )
+            except (requests.ConnectionError, requests.Timeout):
+                histogram.observe(time.perf_counter() - start)
+                self.breaker.record_failure()
+                if attempt == self.max_retries:
+                    raise
+            except BaseException:
+                # Any other error, e.g. a broken chunked response, is not
+                # retried but must still end a half-open trial
+                histogram.observe(time.perf_counter() - start)
+                self.breaker.record_failure()
+                raise
+            else:
+                histogram.observe(time.perf_counter() - start)
+                if resp.status_code < 500:
+                    self.breaker.record_success()
+                else:
+                    self.breaker.record_failure()
+
+                if (
+                    resp.status_code not in RETRY_STATUS_CODES
+                    or attempt == self.max_retries
+                ):
+                    return resp
+
+            time.sleep(self._backoff(attempt))
+
+    def latency_histograms(self) -> dict:
+        """Latency histograms of all endpoints called so far
+
+        Returns:
+            dict: Histogram snapshots keyed by endpoint
+        """
+        with self._lock:
+            histograms = dict(self._histograms)
+
+        return {endpoint: h.snapshot() for endpoint, h in histograms.items()}
+
+    def render_metrics(self) -> str:
+        """Latency histograms in the Prometheus text exposition format
+
+        Returns:
+            str: Metrics text
+        """
+        lines = render_histogram(
+            "ocr_request_seconds",
+            "Latency of OCR service requests",
+            {
+                (("endpoint", endpoint),): snapshot
+                for endpoint, snapshot in self.latency_histograms().items()
+            },
+        )
+        return "\n".join(lines) + "\n"
+
+
+_default_client = None
+_default_client_lock = threading.Lock()
+
+
+def default_client() -> OCRClient:
+    """OCR client shared by every caller that does not bring its own
+
+    Returns:
+        OCRClient: Process wide client with the default settings
+    """
+    global _default_client
+    with _default_client_lock:
+        if _default_client is None:
+            _default_client = OCRClient()
+        return _default_client
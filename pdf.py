@@ -0,0 +1,162 @@
+# Copyright 2023 Aditya Mohan
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Local PDF handling
+"""
+
+import io
+from typing import Optional
+
+try:
+    import pypdf
+except ImportError:  # pragma: no cover
+    pypdf = None
+
+
+def _require_pypdf() -> None:
+    if pypdf is None:
+        raise ImportError("pypdf is required to split PDFs into pages")
+
+
+def split_pdf(file_obj) -> list:
+    """Splits a PDF into single-page PDFs
+
+    The same page always serializes to the same bytes, so the pages can be
+    hashed and cached individually.
+
+    Args:
+        file_obj (BinaryIO): Readable and seekable PDF file object
+
+    Returns:
+        list: One PDF document as bytes per page, in page order
+    """
+    _require_pypdf()
+
+    reader = pypdf.PdfReader(file_obj)
+    pages = []
+    for page in reader.pages:
+        writer = pypdf.PdfWriter()
+        writer.add_page(page)
+        out = io.BytesIO()
+        writer.write(out)
+        pages.append(out.getvalue())
+
+    return pages
+
+
+def _has_images(resources, depth: int = 0) -> bool:
+    """Whether page resources draw an image, directly or through a form"""
+    try:
+        xobjects = (resources or {}).get("/XObject")
+        if xobjects is None:
+            return False
+        for ref in xobjects.get_object().values():
+            xobject = ref.get_object()
+            subtype = xobject.get("/Subtype")
+            if subtype == "/Image":
+                return True
+            if subtype == "/Form" and depth < 5:
+                if _has_images(xobject.get("/Resources"), depth + 1):
+                    return True
+    except Exception:
+        return True
+    return False
+
+
+def page_text_layer(
+    page, min_chars: int = 20, min_density: float = 0.002
+) -> Optional[str]:
+    """Extracts the embedded text of a PDF page
+
+    Born-digital pages carry a text layer that is exact and far cheaper to
+    read than OCR. Pages without one, or whose text looks like the output of
+    a broken font encoding, are left for the OCR service. So are pages that
+    draw images, e.g. scans with a typed header, unless their text is as
+    dense as that of a page of running text.
+
+    Args:
+        page (pypdf.PageObject): Page of a parsed PDF
+        min_chars (int): Minimum number of non-whitespace characters for the
+            text layer to be used
+        min_density (float): Minimum number of non-whitespace characters per
+            square point of pages with images
+
+    Returns:
+        Optional[str]: Text of the page or None if it needs OCR
+    """
+    try:
+        text = page.extract_text() or ""
+    except Exception:
+        return None
+
+    visible = [c for c in text if not c.isspace()]
+    if len(visible) < min_chars:
+        return None
+
+    readable = sum(c.isalnum() or c in ".,:;-/$%()#@&'\"" for c in visible)
+    if readable / len(visible) < 0.75:
+        return None
+
+    if _has_images(page.get("/Resources")):
+        area = float(page.mediabox.width) * float(page.mediabox.height)
+        if area <= 0 or len(visible) / area < min_density:
+            return None
+
+    return text
+
+
+def extract_text_layer(page_pdf: bytes, **kwargs) -> Optional[str]:
+    """Extracts the embedded text of a single-page PDF, see `page_text_layer`
+
+    Args:
+        page_pdf (bytes): Single-page PDF as returned by `split_pdf`
+
+    Returns:
+        Optional[str]: Text of the page or None if it needs OCR
+    """
+    _require_pypdf()
+
+    try:
+        page = pypdf.PdfReader(io.BytesIO(page_pdf)).pages[0]
+    except Exception:
+        return None
+    return page_text_layer(page, **kwargs)
+
+
+def extract_document_text_layer(file_obj, **kwargs) -> Optional[list]:
+    """Extracts the embedded text of every page of a PDF without splitting it
+
+    Args:
+        file_obj (BinaryIO): Readable and seekable PDF file object
+
+    Returns:
+        Optional[list]: Text per page in page order, or None if any page
+        needs OCR, see `page_text_layer`
+    """
+    _require_pypdf()
+
+    try:
+        pages = pypdf.PdfReader(file_obj).pages
+        texts = []
+        for page in pages:
+            text = page_text_layer(page, **kwargs)
+            if text is None:
+                return None
+            texts.append(text)
+    except Exception:
+        return None
+    finally:
+        file_obj.seek(0)
+    return texts or None
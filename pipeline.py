@@ -0,0 +1,259 @@
+# Copyright 2023 Aditya Mohan
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Pipelined OCR and LLM execution
+"""
+
+import enum
+import threading
+import weakref
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Executor,
+    Future,
+    ThreadPoolExecutor,
+    wait,
+)
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Any, Callable, Iterable, Optional
+
+from metrics import registry
+
+SINGLEFLIGHT_CALLS = registry.counter(
+    "singleflight_calls_total", "Coalesced calls by role of the caller"
+)
+
+
+@enum.unique
+class PipelineStage(enum.Enum):
+    """
+    Stages a file goes through in the pipeline
+    """
+
+    OCR = "ocr"
+    EXTRACT = "extract"
+
+
+class PipelineExecutor:
+    """Runs OCR and extraction over a batch of files on bounded worker pools
+
+    Every file is submitted to the OCR pool up front. As soon as the OCR of a
+    file finishes its text is handed to the extraction pool, so the OCR of
+    file N+1 overlaps with the extraction of file N.
+    """
+
+    def __init__(
+        self,
+        ocr_fn: Callable[[Any], Any],
+        extract_fn: Callable[[Any], Any],
+        ocr_workers: int = 4,
+        llm_workers: int = 2,
+        initializer: Optional[Callable[[], None]] = None,
+    ) -> None:
+        """
+        Args:
+            ocr_fn (Callable): Maps an input item to OCR output, or None if
+                the item has to be skipped
+            extract_fn (Callable): Maps OCR output to the extraction result
+            ocr_workers (int): Maximum number of concurrent OCR calls
+            llm_workers (int): Maximum number of concurrent extraction calls
+            initializer (Callable, optional): Run once in every worker thread
+        """
+        self.ocr_fn = ocr_fn
+        self.extract_fn = extract_fn
+        self.ocr_workers = max(1, int(ocr_workers))
+        self.llm_workers = max(1, int(llm_workers))
+        self.initializer = initializer
+
+    def run(
+        self,
+        items: list,
+        on_event: Optional[Callable[[int, PipelineStage, Any], None]] = None,
+    ) -> list:
+        """Run the pipeline over all items
+
+        `on_event` is called from the calling thread whenever a stage finishes
+        for an item, which makes it safe to update Streamlit elements from it.
+
+        Args:
+            items (list): Items to be processed
+            on_event (Callable, optional): Called as on_event(index, stage, result)
+
+        Returns:
+            list: Extraction results in the order of `items`. Items skipped
+            during OCR are left as None.
+        """
+        results = [None] * len(items)
+        if not items:
+            return results
+
+        with ThreadPoolExecutor(
+            max_workers=self.ocr_workers,
+            thread_name_prefix="ocr",
+            initializer=self.initializer,
+        ) as ocr_pool, ThreadPoolExecutor(
+            max_workers=self.llm_workers,
+            thread_name_prefix="llm",
+            initializer=self.initializer,
+        ) as llm_pool:
+            pending = {
+                ocr_pool.submit(self.ocr_fn, item): (PipelineStage.OCR, idx)
+                for idx, item in enumerate(items)
+            }
+            try:
+                while pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        stage, idx = pending.pop(future)
+                        result = future.result()
+
+                        if stage is PipelineStage.OCR and result is not None:
+                            extract_future = llm_pool.submit(self.extract_fn, result)
+                            pending[extract_future] = (PipelineStage.EXTRACT, idx)
+                        elif stage is PipelineStage.EXTRACT:
+                            results[idx] = result
+
+                        if on_event is not None:
+                            on_event(idx, stage, result)
+            except BaseException:
+                for future in pending:
+                    future.cancel()
+                raise
+
+        return results
+
+
+def _cancel_futures(futures: dict) -> None:
+    for future in list(futures.values()):
+        future.cancel()
+
+
+class BackgroundJobs:
+    """Starts keyed jobs ahead of time, e.g. OCR that later calls pick up
+    from a cache
+
+    Jobs run on a shared executor. A job is submitted at most once per key.
+    Jobs that have not started yet are cancelled by `cancel` or when the
+    object is garbage collected, e.g. together with an abandoned Streamlit
+    session.
+    """
+
+    def __init__(self, executor: Executor) -> None:
+        """
+        Args:
+            executor (Executor): Executor shared by all job sets
+        """
+        self.executor = executor
+        self._futures = {}
+        self._lock = threading.Lock()
+        self._finalizer = weakref.finalize(self, _cancel_futures, self._futures)
+
+    def submit(self, key: str, fn: Callable, *args, **kwargs) -> Future:
+        """Start a job unless one with the same key exists
+
+        Args:
+            key (str): Job key
+            fn (Callable): Job function
+
+        Returns:
+            Future: Future of the job with this key
+        """
+        with self._lock:
+            future = self._futures.get(key)
+            if future is None or future.cancelled():
+                future = self.executor.submit(fn, *args, **kwargs)
+                self._futures[key] = future
+            return future
+
+    def cancel(self, keep: Iterable = ()) -> None:
+        """Cancel and forget jobs
+
+        Args:
+            keep (Iterable): Keys of jobs that are kept
+        """
+        keep = set(keep)
+        with self._lock:
+            for key in [key for key in self._futures if key not in keep]:
+                self._futures.pop(key).cancel()
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key into a single execution
+
+    The first caller of a key runs the function, callers arriving while it is
+    in flight wait for its result instead of running it again. The result, or
+    the exception raised by the function, is handed to every waiter. Nothing
+    is kept once the call finishes, caching is left to the caller.
+    """
+
+    def __init__(self, name: str, timeout: Optional[float] = None) -> None:
+        """
+        Args:
+            name (str): Name used in the metrics
+            timeout (float, optional): Seconds a waiter waits for the running
+                call before giving up
+        """
+        self.name = name
+        self.timeout = timeout
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: Any, fn: Callable, *args, **kwargs) -> tuple:
+        """Run `fn` unless a call with the same key is in flight
+
+        Args:
+            key (Any): Hashable key identifying equivalent calls
+            fn (Callable): Function to be called
+
+        Raises:
+            concurrent.futures.TimeoutError: The running call did not finish
+                within `timeout`
+
+        Returns:
+            tuple: Result of the call and whether this caller ran it
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._calls[key] = future
+
+        if not leader:
+            try:
+                result = future.result(timeout=self.timeout)
+            except FutureTimeoutError:
+                SINGLEFLIGHT_CALLS.inc(name=self.name, role="timeout")
+                raise
+            SINGLEFLIGHT_CALLS.inc(name=self.name, role="waiter")
+            return result, False
+
+        SINGLEFLIGHT_CALLS.inc(name=self.name, role="leader")
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result, True
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+
+    def in_flight(self) -> int:
+        """Number of keys with a running call"""
+        with self._lock:
+            return len(self._calls)
@@ -0,0 +1,378 @@
+# Copyright 2023 Aditya Mohan
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Columnar store of the results of an analysis
+"""
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import weakref
+from collections import OrderedDict
+from typing import BinaryIO, Iterator, Optional
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+
+from metrics import registry
+from rules import parse_integer
+from utils import convert_to_csv
+
+COERCION_FAILURES = registry.counter(
+    "result_coercion_failures_total",
+    "Extracted values that could not be converted to the type of their column",
+)
+
+# Column types of the values of AvailableDtype, other types are kept as strings
+ARROW_TYPES = {"string": pa.string(), "integer": pa.int64()}
+EXPORT_FORMATS = {
+    "csv": "text/csv",
+    "parquet": "application/vnd.apache.parquet",
+    "jsonl": "application/x-ndjson",
+}
+
+# Suffix of the string column that keeps the values a typed column rejected
+RAW_SUFFIX = "_raw"
+
+_PANDAS_TYPES = {pa.string(): pd.StringDtype(), pa.int64(): pd.Int64Dtype()}
+
+logger = logging.getLogger(__name__)
+
+
+def coerce(value, dtype: str):
+    """Converts an extracted value to the type of its column
+
+    Args:
+        value (Any): Value returned by the LLM or the rules
+        dtype (str): Field type of the schema
+
+    Returns:
+        Any: The converted value, None if an integer cannot be parsed
+    """
+    if value is None:
+        return None
+    if dtype == "integer":
+        if isinstance(value, bool):
+            return None
+        if isinstance(value, int):
+            return value
+        if isinstance(value, float):
+            return int(value) if value.is_integer() else None
+        return parse_integer(str(value))
+    if isinstance(value, str):
+        return value
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return str(value)
+
+
+def _unique_column(name: str, taken: set) -> str:
+    """Reserves `name`, or `name_<n>` with the lowest free n, in `taken`"""
+    column, n = name, 0
+    while column in taken:
+        n += 1
+        column = f"{name}_{n}"
+    taken.add(column)
+    return column
+
+
+class ResultStore:
+    """Columnar store of the entities extracted from the files of an analysis
+
+    Every `put` stores a record batch typed by the schema, which replaces the
+    previous batch of its file. Values that do not convert to the type of
+    their column are kept as text in a companion `<field>_raw` column, which
+    is shown only for the files that have such values. The file name is kept
+    in a `document` column. A generated column whose name is taken by a field
+    gets a numeric suffix instead, e.g. `document_1`. DataFrames and CSV
+    bytes are memoized per version so that reruns of the page do not rebuild
+    them, least recently used first out once they exceed `max_memo_bytes`.
+    The combined export of all files is written batch by batch to a
+    temporary file, which is reused until a result changes.
+    """
+
+    def __init__(
+        self,
+        schema: dict,
+        directory: Optional[str] = None,
+        max_memo_bytes: int = 64 * 1024 * 1024,
+    ) -> None:
+        """
+        Args:
+            schema (dict): Schema built by `build_schema`
+            directory (str, optional): Where export files are written,
+                defaults to the system temporary directory
+            max_memo_bytes (int): Memory budget of the memoized frames and
+                CSVs
+        """
+        self.fields = list(schema["properties"])
+        self.dtypes = {
+            field: spec.get("type") for field, spec in schema["properties"].items()
+        }
+        # The generated columns never shadow a field of the schema
+        taken = set(self.fields)
+        self.document_column = _unique_column("document", taken)
+        # Values that do not convert are kept as text next to their column
+        self.raw_fields = {
+            field: _unique_column(field + RAW_SUFFIX, taken)
+            for field, dtype in self.dtypes.items()
+            if ARROW_TYPES.get(dtype, pa.string()) != pa.string()
+        }
+        columns = [(self.document_column, pa.string())]
+        for field, dtype in self.dtypes.items():
+            columns.append((field, ARROW_TYPES.get(dtype, pa.string())))
+            if field in self.raw_fields:
+                columns.append((self.raw_fields[field], pa.string()))
+        self.arrow_schema = pa.schema(columns)
+        self.directory = directory
+        self.max_memo_bytes = max_memo_bytes
+        self._version = 0
+        self._batches = {}
+        self._documents = {}
+        self._memo = OrderedDict()
+        self._memo_bytes = 0
+        self._exports = {}
+        self._export_dir = None
+        self._lock = threading.Lock()
+
+    @property
+    def version(self) -> int:
+        """Number of batches put so far"""
+        return self._version
+
+    def put(self, idx: int, document: str, output: list) -> int:
+        """Stores the entities extracted from a file
+
+        Args:
+            idx (int): Position of the file in the analysis
+            document (str): File name
+            output (list): Extracted entities
+
+        Returns:
+            int: Version of the store after the put
+        """
+        columns = {self.document_column: [document] * len(output)}
+        for field, dtype in self.dtypes.items():
+            values = [entity.get(field) for entity in output]
+            columns[field] = [coerce(value, dtype) for value in values]
+            if field not in self.raw_fields:
+                continue
+            raw = [
+                None if value is None or converted is not None else str(value)
+                for value, converted in zip(values, columns[field])
+            ]
+            columns[self.raw_fields[field]] = raw
+            rejected = len(raw) - raw.count(None)
+            if rejected:
+                COERCION_FAILURES.inc(rejected, field=field)
+                logger.warning(
+                    "%d %s values of %s are not %s, kept in %s",
+                    rejected,
+                    field,
+                    document,
+                    dtype,
+                    self.raw_fields[field],
+                )
+        batch = pa.RecordBatch.from_pydict(columns, schema=self.arrow_schema)
+
+        with self._lock:
+            self._version += 1
+            self._batches[idx] = (self._version, batch)
+            self._documents[idx] = document
+            # Memoized views of older versions of the file are never used again
+            for key in [key for key in self._memo if key[1] == idx]:
+                self._memo_bytes -= self._memo.pop(key)[1]
+            return self._version
+
+    def __len__(self) -> int:
+        return len(self._batches)
+
+    def _columns(self, batch: pa.RecordBatch) -> list:
+        """Fields of the schema and the raw columns that hold a value"""
+        columns = []
+        for field in self.fields:
+            columns.append(field)
+            raw_field = self.raw_fields.get(field)
+            if raw_field is not None:
+                raw = batch.column(raw_field)
+                if raw.null_count < len(raw):
+                    columns.append(raw_field)
+        return columns
+
+    def _batch(self, idx: int) -> tuple:
+        with self._lock:
+            return self._batches[idx]
+
+    def _memo_get(self, key: tuple):
+        with self._lock:
+            entry = self._memo.get(key)
+            if entry is None:
+                return None
+            self._memo.move_to_end(key)
+            return entry[0]
+
+    def _memo_put(self, key: tuple, value) -> None:
+        size = (
+            len(value)
+            if isinstance(value, bytes)
+            else int(value.memory_usage(deep=True).sum())
+        )
+        with self._lock:
+            if self._batches[key[1]][0] != key[2]:
+                # The file was put again while the value was built
+                return
+            previous = self._memo.pop(key, None)
+            if previous is not None:
+                self._memo_bytes -= previous[1]
+            self._memo[key] = (value, size)
+            self._memo_bytes += size
+            # The newest entry stays even if it exceeds the budget alone
+            while self._memo_bytes > self.max_memo_bytes and len(self._memo) > 1:
+                self._memo_bytes -= self._memo.popitem(last=False)[1][1]
+
+    def output(self, idx: int) -> list:
+        """Current entities of a file
+
+        Args:
+            idx (int): Position of the file in the analysis
+
+        Returns:
+            list: Entities with the converted values, and the values that did
+            not convert under the raw field names
+        """
+        _, batch = self._batch(idx)
+        return batch.select(self._columns(batch)).to_pylist()
+
+    def frame(self, idx: int) -> pd.DataFrame:
+        """Current entities of a file as a DataFrame with nullable columns
+
+        Args:
+            idx (int): Position of the file in the analysis
+
+        Returns:
+            pd.DataFrame: Memoized frame, must not be modified
+        """
+        version, batch = self._batch(idx)
+        key = ("frame", idx, version)
+        frame = self._memo_get(key)
+        if frame is None:
+            frame = batch.select(self._columns(batch)).to_pandas(
+                types_mapper=_PANDAS_TYPES.get
+            )
+            self._memo_put(key, frame)
+        return frame
+
+    def csv(self, idx: int) -> bytes:
+        """Current entities of a file as CSV
+
+        Args:
+            idx (int): Position of the file in the analysis
+
+        Returns:
+            bytes: Memoized UTF-8 encoded CSV
+        """
+        version, _ = self._batch(idx)
+        key = ("csv", idx, version)
+        data = self._memo_get(key)
+        if data is None:
+            data = convert_to_csv(self.frame(idx))
+            self._memo_put(key, data)
+        return data
+
+    def nbytes(self) -> int:
+        """Bytes held by the batches and the memoized frames and CSVs"""
+        with self._lock:
+            return (
+                sum(batch.nbytes for _, batch in self._batches.values())
+                + self._memo_bytes
+            )
+
+    def _snapshot(self) -> list:
+        with self._lock:
+            return [
+                (self._documents[idx], self._batches[idx][1])
+                for idx in sorted(self._batches)
+            ]
+
+    def batches(self) -> Iterator[pa.RecordBatch]:
+        """Current batch of every file in file order"""
+        for _, batch in self._snapshot():
+            yield batch
+
+    def export(self, fmt: str, out: BinaryIO) -> None:
+        """Writes the current entities of all files one batch at a time
+
+        CSV and Parquet get one row per entity with the file name in the
+        document column, JSONL gets one line per file.
+
+        Args:
+            fmt (str): One of csv, parquet or jsonl
+            out (BinaryIO): Destination
+        """
+        if fmt == "csv":
+            with pa_csv.CSVWriter(out, self.arrow_schema) as writer:
+                for batch in self.batches():
+                    writer.write_batch(batch)
+        elif fmt == "parquet":
+            with pq.ParquetWriter(out, self.arrow_schema) as writer:
+                for batch in self.batches():
+                    writer.write_batch(batch)
+        elif fmt == "jsonl":
+            for document, batch in self._snapshot():
+                line = dict(
+                    document=document,
+                    output=batch.select(self._columns(batch)).to_pylist(),
+                )
+                out.write((json.dumps(line) + "\n").encode("utf-8"))
+        else:
+            raise ValueError(f"Unsupported export format: {fmt}")
+
+    def export_file(self, fmt: str) -> str:
+        """Path of the combined export of the current results
+
+        Args:
+            fmt (str): One of csv, parquet or jsonl
+
+        Returns:
+            str: Temporary file, removed when the store is garbage collected
+        """
+        with self._lock:
+            version = self._version
+            exported = self._exports.get(fmt)
+            if exported is not None and exported[0] == version:
+                return exported[1]
+            if self._export_dir is None:
+                self._export_dir = tempfile.mkdtemp(
+                    prefix="results-", dir=self.directory
+                )
+                weakref.finalize(
+                    self, shutil.rmtree, self._export_dir, ignore_errors=True
+                )
+
+        path = os.path.join(self._export_dir, f"results-{version}.{fmt}")
+        with open(path, "wb") as f:
+            self.export(fmt, f)
+
+        with self._lock:
+            previous = self._exports.get(fmt)
+            self._exports[fmt] = (version, path)
+        if previous is not None and previous[1] != path:
+            os.remove(previous[1])
+        return path
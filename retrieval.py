@@ -0,0 +1,166 @@
+# Copyright 2023 Aditya Mohan
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Lexical retrieval of the passages of a document that are relevant to a schema
+"""
+
+import math
+import re
+from collections import Counter
+from typing import Optional
+
+from chunking import count_tokens, split_text
+
+_WORD = re.compile(r"[a-z0-9]+")
+_CAMEL = re.compile(r"([a-z0-9])([A-Z])")
+
+
+def tokenize(text: str) -> list:
+    """Lowercase word tokens with a plural "s" stripped
+
+    Args:
+        text (str): Text to be tokenized
+
+    Returns:
+        list: Tokens in text order
+    """
+    return [
+        word[:-1] if len(word) > 3 and word.endswith("s") else word
+        for word in _WORD.findall(text.lower())
+    ]
+
+
+def field_terms(field: str) -> list:
+    """Query terms of a schema field, e.g. invoiceNumber or invoice_number
+
+    Args:
+        field (str): Field name
+
+    Returns:
+        list: Query tokens
+    """
+    return tokenize(_CAMEL.sub(r"\1 \2", field))
+
+
+class BM25Index:
+    """Okapi BM25 index over the passages of a single document"""
+
+    def __init__(self, passages: list, k1: float = 1.5, b: float = 0.75) -> None:
+        """
+        Args:
+            passages (list): Passage texts
+            k1 (float): Term frequency saturation
+            b (float): Strength of the passage length normalization
+        """
+        self.k1 = k1
+        self.b = b
+        self.docs = [Counter(tokenize(passage)) for passage in passages]
+        self.lengths = [sum(doc.values()) for doc in self.docs]
+        self.avg_length = sum(self.lengths) / len(self.docs) if self.docs else 0.0
+
+        document_frequency = Counter()
+        for doc in self.docs:
+            document_frequency.update(doc.keys())
+        n = len(self.docs)
+        self.idf = {
+            term: math.log(1 + (n - df + 0.5) / (df + 0.5))
+            for term, df in document_frequency.items()
+        }
+
+    def scores(self, terms: list) -> list:
+        """BM25 score of every passage for a query
+
+        Args:
+            terms (list): Query tokens
+
+        Returns:
+            list: Scores in passage order
+        """
+        scores = []
+        for doc, length in zip(self.docs, self.lengths):
+            norm = self.k1 * (1 - self.b + self.b * length / (self.avg_length or 1))
+            score = 0.0
+            for term in terms:
+                tf = doc.get(term, 0)
+                if tf:
+                    score += self.idf[term] * tf * (self.k1 + 1) / (tf + norm)
+            scores.append(score)
+        return scores
+
+
+def select_passages(
+    text: str,
+    schema: dict,
+    max_tokens: int,
+    model_name: str = "gpt-3.5-turbo",
+    passage_tokens: int = 200,
+) -> Optional[tuple]:
+    """Selects the passages of a document most relevant to a schema
+
+    The document is split into small passages and ranked with BM25 once per
+    schema field, using the words of the field name as the query. Passages
+    are taken from the rankings of all fields in turn, so that every field
+    gets its best passages, until the token budget is used. The first passage
+    is always included since it usually carries the document header.
+
+    Args:
+        text (str): OCR Output
+        schema (dict): Schema built by `build_schema`
+        max_tokens (int): Token budget of the selected passages
+        model_name (str): OpenAI model whose tokenizer is used
+        passage_tokens (int): Maximum number of tokens per passage
+
+    Returns:
+        Optional[tuple]: Selected passages in document order joined as text
+        and selection stats, or None if no passage matches any field
+    """
+    passages = split_text(text, passage_tokens, model_name)
+    if len(passages) < 2:
+        return None
+
+    index = BM25Index(passages)
+    rankings = []
+    for field in schema["properties"]:
+        scores = index.scores(field_terms(field))
+        ranked = sorted(
+            (idx for idx, score in enumerate(scores) if score > 0),
+            key=lambda idx: -scores[idx],
+        )
+        rankings.append(ranked)
+
+    if not any(rankings):
+        return None
+
+    tokens = [count_tokens(passage, model_name) for passage in passages]
+    selected = {0} if tokens[0] <= max_tokens else set()
+    used = sum(tokens[idx] for idx in selected)
+    positions = [0] * len(rankings)
+    progress = True
+    while progress:
+        progress = False
+        for field_idx, ranked in enumerate(rankings):
+            while positions[field_idx] < len(ranked):
+                idx = ranked[positions[field_idx]]
+                positions[field_idx] += 1
+                if idx in selected or used + tokens[idx] > max_tokens:
+                    continue
+                selected.add(idx)
+                used += tokens[idx]
+                progress = True
+                break
+
+    return "\n\n".join(passages[idx] for idx in sorted(selected)), dict(
+        passages=len(passages), selected=len(selected), tokens=used
+    )
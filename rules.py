@@ -0,0 +1,274 @@
+# Copyright 2023 Aditya Mohan
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Rule based extraction of simple fields ahead of the LLM
+"""
+
+import re
+import threading
+from typing import Callable, Iterable, Optional
+
+from metrics import registry
+from retrieval import field_terms
+
+RULE_FIELDS = registry.counter(
+    "rule_fields_total", "Fields looked up by the rule based extractor by result"
+)
+
+# Words that may stand for the last word of a field name in a label, e.g.
+# "Invoice No." or "Invoice #" for invoice_number
+_LABEL_SYNONYMS = {
+    "number": r"(?:number|num|no|nr|#)",
+    "no": r"(?:number|num|no|nr|#)",
+    "num": r"(?:number|num|no|nr|#)",
+    "id": r"(?:id|number|no|#)",
+    "email": r"(?:e\W?mail)",
+    "phone": r"(?:phone|tel|telephone)",
+}
+_NUMBER = re.compile(r"-?\d+(?:\.\d+)?")
+_MONTH = r"(?:jan|feb|mar|apr|may|jun|jul|aug|sep|sept|oct|nov|dec)[a-z]*\.?"
+
+
+def _label(field: str) -> str:
+    """Regular expression of the label of a field in a document"""
+    terms = field_terms(field)
+    parts = [_LABEL_SYNONYMS.get(term, re.escape(term) + "s?") for term in terms]
+    return r"\b" + r"[\s_\-.]*".join(parts) + r"\.?"
+
+
+def parse_integer(value: str) -> Optional[int]:
+    """Parses an amount such as "$1,234.00" into an integer
+
+    Args:
+        value (str): Matched text
+
+    Returns:
+        Optional[int]: The integer, or None if the amount has a fraction
+    """
+    value = re.sub(r"[$€£,\s]", "", value)
+    if not _NUMBER.fullmatch(value):
+        return None
+    number = float(value)
+    if not number.is_integer():
+        return None
+    return int(number)
+
+
+class FieldRule:
+    """Extracts the value of the fields whose name matches a pattern"""
+
+    def __init__(
+        self,
+        name: str,
+        fields: str,
+        value: str,
+        dtypes: Iterable[str] = ("string",),
+        labelled: bool = True,
+        confidence: float = 0.95,
+        parse: Optional[Callable[[str], Optional[object]]] = None,
+    ) -> None:
+        """
+        Args:
+            name (str): Rule name used in the metrics
+            fields (str): Regular expression matched against the words of the
+                field names, e.g. "invoice number" for invoiceNumber
+            value (str): Regular expression of the value
+            dtypes (Iterable[str]): Field types the rule applies to
+            labelled (bool): Only take values that follow the label of the
+                field, e.g. "Invoice No.: INV-42"
+            confidence (float): Confidence of a unique match
+            parse (Callable, optional): Converts a match into the field value,
+                returns None when it cannot. Integer fields default to
+                `parse_integer`, string fields to the stripped match
+        """
+        self.name = name
+        self.fields = re.compile(fields, re.IGNORECASE)
+        self.value = value
+        self.dtypes = set(dtypes)
+        self.labelled = labelled
+        self.confidence = confidence
+        self.parse = parse
+
+    def applies(self, field: str, spec: dict) -> bool:
+        """Whether the rule handles a schema field
+
+        Args:
+            field (str): Field name
+            spec (dict): Field specification of the schema
+
+        Returns:
+            bool: True if the name and the type match
+        """
+        if spec.get("type") not in self.dtypes:
+            return False
+        return bool(self.fields.search(" ".join(field_terms(field))))
+
+    def extract(self, text: str, field: str, dtype: str) -> Optional[object]:
+        """Extracts a field from a document
+
+        Args:
+            text (str): OCR Output
+            field (str): Field name
+            dtype (str): Field type
+
+        Returns:
+            Optional[object]: The value if the document contains exactly one
+            distinct value for the field, otherwise None
+        """
+        if self.labelled:
+            # The label may be followed by up to two words, e.g. "Total
+            # amount due: 10", and a separator on the same line
+            pattern = (
+                _label(field)
+                + r"(?:[ \t]+[a-z]+\.?){0,2}[ \t]*[:#]?[ \t]*("
+                + self.value
+                + r")"
+            )
+        else:
+            pattern = r"(" + self.value + r")"
+
+        parse = self.parse or (parse_integer if dtype == "integer" else str.strip)
+        values = set()
+        for match in re.finditer(pattern, text, re.IGNORECASE):
+            value = parse(match.group(1))
+            if value is None or value == "":
+                return None
+            values.add(value)
+
+        if len(values) != 1:
+            return None
+        return values.pop()
+
+
+DEFAULT_RULES = (
+    FieldRule(
+        "email",
+        fields=r"\be ?mail\b",
+        value=r"[\w.+\-]+@[\w\-]+(?:\.[\w\-]+)+",
+    ),
+    FieldRule(
+        "phone",
+        fields=r"\b(phone|mobile|fax|telephone)\b",
+        value=r"\+?\(?\d[\d \-().]{5,}\d",
+    ),
+    FieldRule(
+        "date",
+        fields=r"\b(date|dob|birthday)\b",
+        value=(
+            r"\d{4}-\d{1,2}-\d{1,2}|\d{1,2}[./\-]\d{1,2}[./\-]\d{2,4}"
+            rf"|\d{{1,2}}\s+{_MONTH},?\s+\d{{4}}|{_MONTH}\s+\d{{1,2}},?\s+\d{{4}}"
+        ),
+    ),
+    FieldRule(
+        "amount",
+        fields=r"\b(total|amount|price|cost|balance|subtotal|tax|fee|sum)\b",
+        value=r"[$€£]?[ \t]?-?\d{1,3}(?:,\d{3})+(?:\.\d+)?|[$€£]?[ \t]?-?\d+(?:\.\d+)?",
+        dtypes=("string", "integer"),
+    ),
+    FieldRule(
+        "identifier",
+        fields=r"\b(number|num|no|id|code|ref|reference)$",
+        value=r"(?=[A-Za-z0-9\-/]*\d)[A-Za-z0-9][A-Za-z0-9\-/]*",
+        dtypes=("string", "integer"),
+    ),
+    # Any integer field whose label is followed by a number; the label alone
+    # is weak evidence, so the rule is off unless min_confidence is lowered
+    FieldRule(
+        "labelled_integer",
+        fields=r".",
+        value=r"-?\d[\d,]*",
+        dtypes=("integer",),
+        confidence=0.8,
+    ),
+)
+
+
+class RuleExtractor:
+    """Fills simple fields with patterns before the LLM is called
+
+    Every field is looked up with the rules that apply to its name and type,
+    in order of precedence. A field is resolved when a rule with sufficient
+    confidence finds exactly one distinct value in the document; all other
+    fields are left to the LLM.
+    """
+
+    def __init__(
+        self, rules: Iterable[FieldRule] = DEFAULT_RULES, min_confidence: float = 0.9
+    ) -> None:
+        """
+        Args:
+            rules (Iterable[FieldRule]): Rules in order of precedence
+            min_confidence (float): Minimum confidence of the rules that are used
+        """
+        self.rules = list(rules)
+        self.min_confidence = min_confidence
+        self._stats = dict(fields=0, hits=0, documents=0, complete=0)
+        self._lock = threading.Lock()
+
+    def extract(self, text: str, schema: dict) -> tuple:
+        """Extracts the fields of a schema that the rules can resolve
+
+        Args:
+            text (str): OCR Output
+            schema (dict): Schema built by `build_schema`
+
+        Returns:
+            tuple: Resolved values keyed by field and the schema of the
+            unresolved fields
+        """
+        found = {}
+        for field, spec in schema["properties"].items():
+            for rule in self.rules:
+                if rule.confidence < self.min_confidence or not rule.applies(
+                    field, spec
+                ):
+                    continue
+                value = rule.extract(text, field, spec.get("type"))
+                if value is not None:
+                    found[field] = value
+                    RULE_FIELDS.inc(rule=rule.name, result="hit")
+                    break
+            else:
+                RULE_FIELDS.inc(rule="none", result="miss")
+
+        unresolved = dict(
+            properties={
+                field: spec
+                for field, spec in schema["properties"].items()
+                if field not in found
+            },
+            required=[
+                field for field in schema.get("required", []) if field not in found
+            ],
+        )
+
+        with self._lock:
+            self._stats["fields"] += len(schema["properties"])
+            self._stats["hits"] += len(found)
+            self._stats["documents"] += 1
+            self._stats["complete"] += int(not unresolved["properties"])
+        return found, unresolved
+
+    def stats(self) -> dict:
+        """Rule statistics
+
+        Returns:
+            dict: Fields looked up and resolved, documents and documents
+            resolved without the LLM, and the share of resolved fields
+        """
+        with self._lock:
+            stats = dict(self._stats)
+        stats["hit_rate"] = stats["hits"] / stats["fields"] if stats["fields"] else 0.0
+        return stats
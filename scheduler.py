@@ -0,0 +1,415 @@
+# Copyright 2023 Aditya Mohan
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Rate limited scheduling of OpenAI calls shared by all sessions
+"""
+
+import hashlib
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Callable, Optional
+
+from metrics import STAGE_BUCKETS, registry, render_gauge
+
+SCHEDULER_WAIT = registry.histogram(
+    "llm_queue_seconds",
+    "Time extraction calls waited for the rate limits",
+    STAGE_BUCKETS,
+)
+RATE_LIMITED = registry.counter(
+    "llm_rate_limited_total", "Extraction calls rejected by OpenAI with a 429"
+)
+
+
+def is_rate_limit(error: BaseException) -> bool:
+    """Whether an exception is a 429 response of the OpenAI API
+
+    Args:
+        error (BaseException): Exception raised by the chat model
+
+    Returns:
+        bool: True for rate limit errors of any openai version
+    """
+    status = getattr(error, "status_code", None) or getattr(error, "http_status", None)
+    return status == 429 or type(error).__name__ == "RateLimitError"
+
+
+def retry_after(error: BaseException) -> Optional[float]:
+    """Delay requested by a rate limit response
+
+    Args:
+        error (BaseException): Rate limit error
+
+    Returns:
+        Optional[float]: Seconds to wait, None if the response has no hint
+    """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
+class TokenBucket:
+    """Budget refilled continuously at a rate per minute
+
+    The level may go negative when the actual usage of a call exceeds its
+    estimate, later calls then wait until the debt is refilled. Not thread
+    safe, the scheduler holds its lock while using it.
+    """
+
+    def __init__(self, per_minute: float) -> None:
+        """
+        Args:
+            per_minute (float): Budget per minute, also the burst capacity
+        """
+        self.rate = per_minute / 60.0
+        self.capacity = float(per_minute)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, amount: float, now: float) -> float:
+        """Seconds until `amount` is available, capped at the capacity"""
+        self._refill(now)
+        missing = min(amount, self.capacity) - self.level
+        return missing / self.rate if missing > 0 else 0.0
+
+    def take(self, amount: float, now: float) -> None:
+        """Consumes `amount`, a negative amount gives budget back"""
+        self._refill(now)
+        self.level = min(self.capacity, self.level - amount)
+
+
+class _Ticket:
+    __slots__ = ("tenant", "tokens", "granted_at")
+
+    def __init__(self, tenant: str, tokens: int) -> None:
+        self.tenant = tenant
+        self.tokens = tokens
+        self.granted_at = None
+
+
+class _KeyState:
+    def __init__(
+        self, rpm: Optional[float], tpm: Optional[float], max_concurrency: int
+    ) -> None:
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.max_concurrency = max_concurrency
+        self.limit = float(max_concurrency)
+        self.in_flight = 0
+        self.cooldown_until = 0.0
+        self.last_decrease = 0.0
+        self.queues = OrderedDict()
+        self.completed = 0
+        self.rate_limited = 0
+        self.last_used = time.monotonic()
+
+    def idle(self) -> bool:
+        return not self.queues and not self.in_flight
+
+
+class RateScheduler:
+    """Admits OpenAI calls within the request and token budgets of their key
+
+    Calls wait in one queue per tenant (a job or a session) and are admitted
+    round-robin across tenants, so that a large batch does not starve small
+    ones. A call is admitted when the requests per minute bucket, the tokens
+    per minute bucket (charged with an estimate that is corrected once the
+    actual usage is known) and the concurrency limit of its key allow it. The
+    concurrency limit grows by one per limit successes and is halved on a 429,
+    after which the key pauses for the requested or a backoff delay and the
+    call is retried.
+    """
+
+    def __init__(
+        self,
+        rpm: Optional[float] = None,
+        tpm: Optional[float] = None,
+        max_concurrency: int = 8,
+        max_retries: int = 5,
+        backoff_base: float = 1.0,
+        backoff_max: float = 60.0,
+        max_idle: float = 15 * 60,
+    ) -> None:
+        """
+        Args:
+            rpm (float, optional): Requests per minute of every key, unlimited
+                if not given
+            tpm (float, optional): Tokens per minute of every key, unlimited
+                if not given
+            max_concurrency (int): Upper bound of the calls in flight per key
+            max_retries (int): Retries of a call rejected with a 429
+            backoff_base (float): Pause after the first 429 without a
+                retry-after hint in seconds
+            backoff_max (float): Upper bound of the pause in seconds
+            max_idle (float): Seconds after which the state of an unused key
+                is released
+        """
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_idle = max_idle
+        self._limits = {}
+        self._keys = {}
+        self._cond = threading.Condition()
+
+    @staticmethod
+    def _key_id(api_key: str) -> str:
+        return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:12]
+
+    def configure(
+        self,
+        api_key: str,
+        rpm: Optional[float] = None,
+        tpm: Optional[float] = None,
+        max_concurrency: Optional[int] = None,
+    ) -> None:
+        """Sets the limits of a single key, e.g. the shared trial key
+
+        Args:
+            api_key (str): OpenAI API key
+            rpm (float, optional): Requests per minute
+            tpm (float, optional): Tokens per minute
+            max_concurrency (int, optional): Upper bound of the calls in flight
+        """
+        key_id = self._key_id(api_key)
+        with self._cond:
+            self._limits[key_id] = dict(
+                rpm=rpm, tpm=tpm, max_concurrency=max_concurrency
+            )
+            if key_id in self._keys and self._keys[key_id].idle():
+                del self._keys[key_id]
+
+    def _state(self, key_id: str) -> _KeyState:
+        now = time.monotonic()
+        for idle_id in [
+            other
+            for other, state in self._keys.items()
+            if state.idle() and now - state.last_used > self.max_idle
+        ]:
+            del self._keys[idle_id]
+
+        state = self._keys.get(key_id)
+        if state is None:
+            limits = self._limits.get(key_id, {})
+            state = _KeyState(
+                rpm=limits.get("rpm") or self.rpm,
+                tpm=limits.get("tpm") or self.tpm,
+                max_concurrency=limits.get("max_concurrency") or self.max_concurrency,
+            )
+            self._keys[key_id] = state
+        state.last_used = now
+        return state
+
+    def _dispatch(self, state: _KeyState, now: float) -> Optional[float]:
+        """Admits queued calls, returns the seconds until the next one can be
+        admitted or None if it has to wait for a call to finish"""
+        granted = False
+        delay = None
+        while state.queues:
+            if state.in_flight >= int(state.limit):
+                break
+            if now < state.cooldown_until:
+                delay = state.cooldown_until - now
+                break
+
+            tenant, queue = next(iter(state.queues.items()))
+            ticket = queue[0]
+            delay = max(
+                state.requests.delay(1, now) if state.requests else 0.0,
+                state.tokens.delay(ticket.tokens, now) if state.tokens else 0.0,
+            )
+            if delay > 0:
+                break
+            delay = None
+
+            queue.popleft()
+            if state.requests:
+                state.requests.take(1, now)
+            if state.tokens:
+                state.tokens.take(ticket.tokens, now)
+            state.in_flight += 1
+            ticket.granted_at = now
+            granted = True
+
+            # Round-robin: the tenant goes to the back of the line
+            if queue:
+                state.queues.move_to_end(tenant)
+            else:
+                del state.queues[tenant]
+
+        if granted:
+            self._cond.notify_all()
+        return delay
+
+    def _acquire(self, state: _KeyState, tenant: str, tokens: int) -> _Ticket:
+        ticket = _Ticket(tenant, tokens)
+        start = time.monotonic()
+        with self._cond:
+            state.queues.setdefault(tenant, deque()).append(ticket)
+            try:
+                while ticket.granted_at is None:
+                    delay = self._dispatch(state, time.monotonic())
+                    if ticket.granted_at is None:
+                        self._cond.wait(delay)
+            except BaseException:
+                queue = state.queues.get(tenant)
+                if ticket.granted_at is None and queue is not None:
+                    queue.remove(ticket)
+                    if not queue:
+                        del state.queues[tenant]
+                raise
+
+        SCHEDULER_WAIT.observe(time.monotonic() - start)
+        return ticket
+
+    def _release(
+        self,
+        state: _KeyState,
+        ticket: _Ticket,
+        used: Optional[int] = None,
+        rate_limited: bool = False,
+        failed: bool = False,
+        pause: float = 0.0,
+    ) -> None:
+        with self._cond:
+            now = time.monotonic()
+            state.in_flight -= 1
+            if used is not None and state.tokens:
+                state.tokens.take(used - ticket.tokens, now)
+
+            if rate_limited:
+                state.rate_limited += 1
+                # Calls sent before the last decrease saw the old limit
+                if ticket.granted_at >= state.last_decrease:
+                    state.limit = max(1.0, state.limit / 2)
+                    state.last_decrease = now
+                state.cooldown_until = max(state.cooldown_until, now + pause)
+            elif not failed:
+                state.completed += 1
+                state.limit = min(
+                    float(state.max_concurrency), state.limit + 1 / state.limit
+                )
+
+            self._dispatch(state, now)
+            self._cond.notify_all()
+
+    def _backoff(self, attempt: int) -> float:
+        return random.uniform(0.5, 1.0) * min(
+            self.backoff_max, self.backoff_base * 2**attempt
+        )
+
+    def call(
+        self,
+        api_key: str,
+        fn: Callable,
+        tokens: int = 0,
+        tenant: str = "default",
+        used: Optional[Callable] = None,
+    ):
+        """Runs `fn` once the budgets of the key allow it
+
+        Args:
+            api_key (str): OpenAI API key the call is billed to
+            fn (Callable): Makes the call
+            tokens (int): Estimated prompt and completion tokens of the call
+            tenant (str): Queue the call waits in
+            used (Callable, optional): Returns the actual tokens of the call
+                from its result
+
+        Raises:
+            Exception: The error of the call, for a 429 once the retries
+                are exhausted
+
+        Returns:
+            Any: Result of `fn`
+        """
+        key_id = self._key_id(api_key)
+        attempt = 0
+        while True:
+            with self._cond:
+                state = self._state(key_id)
+            ticket = self._acquire(state, tenant, tokens)
+            try:
+                result = fn()
+            except Exception as e:
+                if not is_rate_limit(e):
+                    self._release(state, ticket, failed=True)
+                    raise
+
+                RATE_LIMITED.inc(key=key_id)
+                pause = retry_after(e) or self._backoff(attempt)
+                self._release(state, ticket, rate_limited=True, pause=pause)
+                if attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                continue
+
+            self._release(state, ticket, used=used(result) if used else None)
+            return result
+
+    def stats(self) -> dict:
+        """Scheduler statistics
+
+        Returns:
+            dict: Concurrency limit, calls in flight, queued calls, completed
+            calls and 429 responses keyed by a prefix of the key hash
+        """
+        with self._cond:
+            return {
+                key_id: dict(
+                    limit=state.limit,
+                    in_flight=state.in_flight,
+                    queued=sum(len(queue) for queue in state.queues.values()),
+                    tenants=len(state.queues),
+                    completed=state.completed,
+                    rate_limited=state.rate_limited,
+                )
+                for key_id, state in self._keys.items()
+            }
+
+    def render_metrics(self) -> str:
+        """Concurrency limits and queue depths in the text exposition format
+
+        Returns:
+            str: Metrics text
+        """
+        stats = self.stats()
+        lines = render_gauge(
+            "llm_concurrency_limit",
+            "Adaptive limit of concurrent OpenAI calls per key",
+            {(("key", key_id),): s["limit"] for key_id, s in stats.items()},
+        )
+        lines += render_gauge(
+            "llm_queued_calls",
+            "OpenAI calls waiting for the rate limits per key",
+            {(("key", key_id),): s["queued"] for key_id, s in stats.items()},
+        )
+        return "\n".join(lines) + "\n"
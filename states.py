@@ -15,9 +15,11 @@
 """
 State Machine and transition code
 """
-import json
 import enum
 import time
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 from transitions import State
 from transitions import Machine
@@ -27,14 +29,51 @@ import streamlit as st
 
 # from decouple import config
 
-from llm import LLM
-from utils import generate_hash, get_ocr_response, build_schema, convert_to_csv
+from cache import DiskCache
+from compaction import TextCompactor
+from image import ImagePreprocessor
+from job_queue import FINISHED, JobQueue, JobStatus, JobWorker
+from llm import DEFAULT_MODEL, ExtractionCache
+from metrics import Trace, registry, render_cache_stats, start_http_server
+from ocr_client import OCRClient
+from pipeline import BackgroundJobs
+from results import EXPORT_FORMATS, ResultStore
+from rules import RuleExtractor
+from scheduler import RateScheduler
+from storage import BlobStore, FileHandle, SessionStorage
+from utils import (
+    build_schema,
+    diff_schema,
+    ocr_file,
+)
 
 HOST_URL = st.secrets["HOST_URL"]
 OCR_SERVICE_PORT = st.secrets["OCR_SERVICE_PORT"]
 OCR_PDF_RESP_ENDPOINT = st.secrets["OCR_PDF_RESP_ENDPOINT"]
 OCR_IMG_RESP_ENDPOINT = st.secrets["OCR_IMG_RESP_ENDPOINT"]
 ALLOW_FREE = st.secrets["ALLOW_FREE"]
+OCR_WORKERS = int(st.secrets.get("OCR_WORKERS", 4))
+LLM_WORKERS = int(st.secrets.get("LLM_WORKERS", 2))
+OCR_SPLIT_PAGES = bool(st.secrets.get("OCR_SPLIT_PAGES", False))
+OCR_PAGE_WORKERS = int(st.secrets.get("OCR_PAGE_WORKERS", 4))
+PDF_TEXT_LAYER = bool(st.secrets.get("PDF_TEXT_LAYER", True))
+SPECULATIVE_OCR_WORKERS = int(st.secrets.get("SPECULATIVE_OCR_WORKERS", 4))
+MAX_CHUNK_TOKENS = int(st.secrets.get("MAX_CHUNK_TOKENS", 2500))
+CHUNK_WORKERS = int(st.secrets.get("CHUNK_WORKERS", 4))
+RETRIEVAL_TOKENS = int(st.secrets.get("RETRIEVAL_TOKENS", 0))
+METRICS_PORT = st.secrets.get("METRICS_PORT")
+DEBUG_PANEL = bool(st.secrets.get("DEBUG_PANEL", False))
+JOB_WORKERS = int(st.secrets.get("JOB_WORKERS", 4))
+JOB_POLL_INTERVAL = float(st.secrets.get("JOB_POLL_INTERVAL", 1.0))
+MAX_UPLOAD_FILES = int(st.secrets.get("MAX_UPLOAD_FILES", 500))
+TEXT_COMPACTION = bool(st.secrets.get("TEXT_COMPACTION", True))
+IMAGE_PREPROCESSING = bool(st.secrets.get("IMAGE_PREPROCESSING", True))
+RULE_EXTRACTION = bool(st.secrets.get("RULE_EXTRACTION", True))
+OPENAI_RPM = st.secrets.get("OPENAI_RPM")
+OPENAI_TPM = st.secrets.get("OPENAI_TPM")
+OPENAI_MAX_CONCURRENCY = int(st.secrets.get("OPENAI_MAX_CONCURRENCY", 8))
+LLM_MODEL = st.secrets.get("LLM_MODEL", DEFAULT_MODEL)
+LLM_ESCALATION_MODELS = list(st.secrets.get("LLM_ESCALATION_MODELS", []))
 
 
 class AvailableDtype(enum.Enum):
@@ -132,12 +171,459 @@ class App(Machine):
     #     st.session_state["llm_object"] = llm
 
 
+@st.cache_resource
+def get_ocr_cache() -> DiskCache:
+    """OCR result store shared by all sessions of this process"""
+    return DiskCache(
+        path=st.secrets.get("OCR_CACHE_PATH", ".cache/ocr.sqlite3"),
+        max_bytes=int(st.secrets.get("OCR_CACHE_MAX_MB", 512)) * 1024 * 1024,
+        ttl=float(st.secrets.get("OCR_CACHE_TTL_HOURS", 24 * 30)) * 3600,
+    )
+
+
+@st.cache_resource
+def get_ocr_client() -> OCRClient:
+    """OCR service client shared by all sessions of this process"""
+    return OCRClient(
+        pool_size=int(st.secrets.get("OCR_POOL_SIZE", 10)),
+        connect_timeout=float(st.secrets.get("OCR_CONNECT_TIMEOUT", 5)),
+        read_timeout=float(st.secrets.get("OCR_READ_TIMEOUT", 300)),
+        max_retries=int(st.secrets.get("OCR_MAX_RETRIES", 3)),
+    )
+
+
+@st.cache_resource
+def get_extraction_cache() -> ExtractionCache:
+    """Extraction result cache shared by all sessions of this process"""
+    disk_path = st.secrets.get("EXTRACTION_CACHE_PATH")
+    return ExtractionCache(
+        max_entries=int(st.secrets.get("EXTRACTION_CACHE_SIZE", 256)),
+        disk=DiskCache(path=disk_path) if disk_path else None,
+    )
+
+
+@st.cache_resource
+def get_session_storage() -> SessionStorage:
+    """Disk store of the uploads and results of all sessions of this process"""
+    return SessionStorage(
+        # Next to the job queue by default, so that uploads are hard linked
+        # into the queue instead of being copied
+        store=BlobStore(st.secrets.get("SESSION_STORE_DIR", ".cache")),
+        ttl=float(st.secrets.get("SESSION_TTL_MINUTES", 60)) * 60,
+    )
+
+
+@st.cache_resource
+def get_speculative_ocr_pool() -> ThreadPoolExecutor:
+    """Executor running the speculative OCR jobs of all sessions"""
+    return ThreadPoolExecutor(
+        max_workers=SPECULATIVE_OCR_WORKERS, thread_name_prefix="speculative_ocr"
+    )
+
+
+@st.cache_resource
+def get_text_compactor() -> TextCompactor | None:
+    """Compaction of OCR text before extraction, None when disabled"""
+    if not TEXT_COMPACTION:
+        return None
+    return TextCompactor(
+        min_alnum_ratio=float(st.secrets.get("TEXT_MIN_ALNUM_RATIO", 0.5)),
+        boilerplate=list(st.secrets.get("TEXT_BOILERPLATE_PATTERNS", [])),
+    )
+
+
+@st.cache_resource
+def get_image_preprocessor() -> ImagePreprocessor | None:
+    """Shrinking of images before OCR, None when disabled"""
+    if not IMAGE_PREPROCESSING:
+        return None
+    target_dpi = st.secrets.get("IMAGE_TARGET_DPI", 300)
+    return ImagePreprocessor(
+        max_long_edge=int(st.secrets.get("IMAGE_MAX_LONG_EDGE", 2000)),
+        target_dpi=int(target_dpi) if target_dpi else None,
+        grayscale=bool(st.secrets.get("IMAGE_GRAYSCALE", True)),
+        quality=int(st.secrets.get("IMAGE_JPEG_QUALITY", 85)),
+    )
+
+
+@st.cache_resource
+def get_rule_extractor() -> RuleExtractor | None:
+    """Rule based extraction of simple fields, None when disabled"""
+    if not RULE_EXTRACTION:
+        return None
+    return RuleExtractor(
+        min_confidence=float(st.secrets.get("RULE_MIN_CONFIDENCE", 0.9))
+    )
+
+
+@st.cache_resource
+def get_llm_scheduler() -> RateScheduler:
+    """Scheduler admitting the OpenAI calls of all sessions
+
+    OPENAI_RPM and OPENAI_TPM are the limits of the app's own key, shared by
+    every trial user. Keys brought by users only get the adaptive concurrency
+    limit since their rate limits are not known.
+    """
+    scheduler = RateScheduler(max_concurrency=OPENAI_MAX_CONCURRENCY)
+    if st.secrets.get("OPENAI_API_KEY"):
+        scheduler.configure(
+            st.secrets["OPENAI_API_KEY"],
+            rpm=float(OPENAI_RPM) if OPENAI_RPM else None,
+            tpm=float(OPENAI_TPM) if OPENAI_TPM else None,
+        )
+    return scheduler
+
+
+@st.cache_resource
+def get_job_queue() -> JobQueue:
+    """Analysis job queue shared by all sessions and worker processes"""
+    return JobQueue(path=st.secrets.get("JOB_QUEUE_PATH", ".cache/jobs.sqlite3"))
+
+
+@st.cache_resource
+def get_job_workers() -> list:
+    """Workers running queued analyses inside this process
+
+    Every worker runs one job at a time, so JOB_WORKERS is the number of
+    sessions analyzed concurrently; their OpenAI calls share the scheduler,
+    which admits them round-robin. With JOB_WORKERS = 0 the jobs are left to
+    workers started with `python job_queue.py`.
+    """
+    workers = [
+        JobWorker(
+            queue=get_job_queue(),
+            base_url=HOST_URL + ":" + OCR_SERVICE_PORT,
+            pdf_endpoint=OCR_PDF_RESP_ENDPOINT,
+            img_endpoint=OCR_IMG_RESP_ENDPOINT,
+            ocr_cache=get_ocr_cache(),
+            extraction_cache=get_extraction_cache(),
+            client=get_ocr_client(),
+            ocr_workers=OCR_WORKERS,
+            llm_workers=LLM_WORKERS,
+            split_pages=OCR_SPLIT_PAGES,
+            page_workers=OCR_PAGE_WORKERS,
+            text_layer=PDF_TEXT_LAYER,
+            preprocessor=get_image_preprocessor(),
+            max_chunk_tokens=MAX_CHUNK_TOKENS,
+            chunk_workers=CHUNK_WORKERS,
+            retrieval_tokens=RETRIEVAL_TOKENS or None,
+            compactor=get_text_compactor(),
+            rules=get_rule_extractor(),
+            scheduler=get_llm_scheduler(),
+            free_tier_api_key=(
+                st.secrets.get("OPENAI_API_KEY") if ALLOW_FREE else None
+            ),
+        )
+        for _ in range(JOB_WORKERS)
+    ]
+    for idx, worker in enumerate(workers):
+        threading.Thread(
+            target=worker.run_forever, name=f"job_worker_{idx}", daemon=True
+        ).start()
+    return workers
+
+
+@st.cache_resource
+def get_metrics_exporter():
+    """Registers the shared caches and clients with the metrics registry and
+    serves it on METRICS_PORT when configured"""
+    ocr_cache, ocr_client = get_ocr_cache(), get_ocr_client()
+    extraction_cache = get_extraction_cache()
+
+    def cache_stats() -> str:
+        stats = dict(ocr=ocr_cache.stats(), extraction=extraction_cache.memory.stats())
+        if extraction_cache.disk is not None:
+            stats["extraction_disk"] = extraction_cache.disk.stats()
+        return render_cache_stats(stats)
+
+    registry.add_collector("ocr_client", ocr_client.render_metrics)
+    registry.add_collector("caches", cache_stats)
+    registry.add_collector("scheduler", get_llm_scheduler().render_metrics)
+    registry.add_collector("sessions", get_session_storage().render_metrics)
+
+    if METRICS_PORT:
+        return start_http_server(int(METRICS_PORT))
+    return None
+
+
+def get_trace() -> Trace:
+    """Stage timings of this session"""
+    if "trace" not in st.session_state:
+        st.session_state["trace"] = Trace()
+    return st.session_state.trace
+
+
+def get_session_id() -> str:
+    """Id of this session in the session storage"""
+    if "session_id" not in st.session_state:
+        st.session_state["session_id"] = uuid.uuid4().hex
+    return st.session_state.session_id
+
+
+def spill_uploads(uploaded_files: list) -> list:
+    """Move freshly uploaded files to the session storage
+
+    Uploads of the session that are not part of the new files are released.
+
+    Args:
+        uploaded_files (list): Files uploaded by the user
+
+    Returns:
+        list: FileHandle of every file, kept in the session state instead of
+        the uploaded files
+    """
+    storage, session_id = get_session_storage(), get_session_id()
+    with get_trace().span("spill"):
+        handles = [
+            storage.put_upload(session_id, uploaded_file)
+            for uploaded_file in uploaded_files
+        ]
+
+    kept = {handle.file_hash for handle in handles}
+    for handle in st.session_state.get("uploaded_files", []):
+        if handle.file_hash not in kept:
+            storage.release(session_id, handle.file_hash)
+    return handles
+
+
+def ocr_uploaded_file(
+    upload: FileHandle, cache: DiskCache, client: OCRClient
+) -> dict | None:
+    """Run OCR on an uploaded file
+
+    Args:
+        upload (FileHandle): File uploaded by the user
+        cache (DiskCache): OCR result store
+        client (OCRClient): OCR service client
+
+    Returns:
+        dict | None: OCR Output or None if the OCR service failed
+    """
+    with upload.open() as file_obj:
+        return ocr_file(
+            file_name=upload.name,
+            file_obj=file_obj,
+            base_url=HOST_URL + ":" + OCR_SERVICE_PORT,
+            pdf_endpoint=OCR_PDF_RESP_ENDPOINT,
+            img_endpoint=OCR_IMG_RESP_ENDPOINT,
+            cache=cache,
+            split_pages=OCR_SPLIT_PAGES,
+            page_workers=OCR_PAGE_WORKERS,
+            client=client,
+            text_layer=PDF_TEXT_LAYER,
+            preprocessor=get_image_preprocessor(),
+        )
+
+
+def start_speculative_ocr(uploaded_files: list) -> None:
+    """Start the OCR of freshly uploaded files in the background
+
+    OCR runs while the user is still building the schema. The in-process job
+    workers share the OCR cache and the OCR single flight with these jobs, so
+    they pick up a finished result from the cache and wait for one in flight
+    instead of calling the OCR service again. Workers in other processes
+    cannot wait for them, so with JOB_WORKERS = 0 no jobs are started. Jobs
+    of files that are no longer uploaded are cancelled.
+
+    Args:
+        uploaded_files (list): FileHandle of every uploaded file
+    """
+    file_hashes = [upload.file_hash for upload in uploaded_files]
+    st.session_state["file_hashes"] = file_hashes
+    if JOB_WORKERS == 0:
+        return
+
+    if "ocr_jobs" not in st.session_state:
+        st.session_state["ocr_jobs"] = BackgroundJobs(get_speculative_ocr_pool())
+
+    jobs: BackgroundJobs = st.session_state.ocr_jobs
+    jobs.cancel(keep=file_hashes)
+    cache, client = get_ocr_cache(), get_ocr_client()
+    for upload in uploaded_files:
+        # Every job opens the spilled file itself, so it never races with
+        # other jobs over the file position
+        jobs.submit(upload.file_hash, ocr_uploaded_file, upload, cache, client)
+
+
+def enqueue_analysis(uploaded_files: list) -> str:
+    """Queue the analysis of the uploaded files with the schema of the session
+
+    A reanalysis of the same files at the same temperature only sends the
+    fields that were added or changed to the LLM.
+
+    Args:
+        uploaded_files (list): FileHandle of every uploaded file
+
+    Returns:
+        str: Job id
+    """
+    with get_trace().span("schema"):
+        schema = build_schema(
+            field_values=st.session_state.field_values,
+            dtype_values=st.session_state.dtype_values,
+            required=st.session_state.required_field,
+        )
+
+    if "file_hashes" not in st.session_state:
+        start_speculative_ocr(uploaded_files)
+    file_hashes = st.session_state.file_hashes
+
+    previous = st.session_state.get("last_analysis")
+    if (
+        previous is not None
+        and previous["file_hashes"] == file_hashes
+        and previous["temp"] == st.session_state.temp
+    ):
+        changed_schema, removed_fields = diff_schema(previous["schema"], schema)
+    else:
+        previous = None
+        changed_schema, removed_fields = schema, []
+
+    queue = get_job_queue()
+    for upload in uploaded_files:
+        queue.link_file(upload.file_hash, upload.path)
+
+    st.session_state["job_analysis"] = dict(
+        file_hashes=file_hashes, temp=st.session_state.temp, schema=schema
+    )
+    return queue.enqueue(
+        payload=dict(
+            schema=schema,
+            changed_schema=changed_schema,
+            removed_fields=removed_fields,
+            previous_outputs=(
+                get_session_storage().get_json(previous["outputs"])
+                if previous
+                else None
+            ),
+            temperature=st.session_state.temp,
+            free_tier=st.session_state.get("free_tier", False),
+            model_name=LLM_MODEL,
+            escalation_models=LLM_ESCALATION_MODELS,
+        ),
+        files=[
+            (uploaded_file.name, file_hash)
+            for uploaded_file, file_hash in zip(uploaded_files, file_hashes)
+        ],
+        secrets=(
+            None
+            if st.session_state.get("free_tier")
+            else dict(openai_api_key=st.session_state.openai_api_key)
+        ),
+    )
+
+
+def describe_result(result: dict | None) -> list:
+    """Notes shown below the entities extracted from a file
+
+    Args:
+        result (dict | None): Result of the file as stored by the job worker
+
+    Returns:
+        list: Caption texts
+    """
+    result = result or {}
+    metadata = result.get("metadata", {})
+    chunk_stats = result.get("chunk_stats")
+    compaction = result.get("compaction")
+    rule_fields = result.get("rule_fields")
+
+    notes = []
+    if metadata.get("text_layer_pages"):
+        notes.append(
+            f"{metadata['text_layer_pages']} of {metadata['pages']} pages read "
+            "from the PDF text layer"
+        )
+    if metadata.get("image"):
+        image = metadata["image"]
+        saved = 1 - image["bytes"] / image["original_bytes"]
+        notes.append(
+            f"Image reduced from {image['original_bytes'] / 1e6:.1f} MB to "
+            f"{image['bytes'] / 1e6:.1f} MB ({saved:.0%} saved) in "
+            f"{image['preprocess_seconds']:.2f}s, OCR took "
+            f"{metadata['ocr_seconds']:.1f}s"
+        )
+    if compaction and compaction["tokens_before"]:
+        saved = 1 - compaction["tokens_after"] / compaction["tokens_before"]
+        notes.append(
+            f"OCR text compacted from {compaction['tokens_before']} to "
+            f"{compaction['tokens_after']} tokens ({saved:.0%} saved)"
+        )
+    if rule_fields:
+        notes.append(f"{', '.join(rule_fields)} found without the LLM")
+    if chunk_stats:
+        notes.append(
+            f"Extracted from {len(chunk_stats)} chunks, "
+            f"{sum(c['prompt_tokens'] for c in chunk_stats)} prompt tokens, "
+            f"slowest chunk {max(c['latency'] for c in chunk_stats):.1f}s"
+        )
+    return notes
+
+
+def attach_job_results(job_id: str, job: dict) -> None:
+    """Move the results of a finished job into the session
+
+    Args:
+        job_id (str): Job id
+        job (dict): Status of the job as returned by `JobQueue.status`
+    """
+    results = get_job_queue().results(job_id)
+
+    # Skipped documents keep an empty result so that outputs stay aligned
+    # with the tabs of the uploaded files
+    outputs = [result["output"] if result is not None else [] for result in results]
+    st.session_state["file_notes"] = [describe_result(result) for result in results]
+    store = ResultStore(st.session_state.job_analysis["schema"])
+    for idx, (upload, output) in enumerate(
+        zip(st.session_state.uploaded_files, outputs)
+    ):
+        store.put(idx, upload.name, output)
+
+    # Only handles stay in the session state, the results live in the storage
+    storage, session_id = get_session_storage(), get_session_id()
+    storage.attach(session_id, "results", store)
+    outputs_key = storage.put_json(session_id, outputs)
+    previous = st.session_state.get("last_analysis")
+    if previous is not None and previous["outputs"] != outputs_key:
+        storage.release(session_id, previous["outputs"])
+    st.session_state["last_analysis"] = dict(
+        st.session_state.pop("job_analysis"), outputs=outputs_key
+    )
+    st.session_state["llm_usage"] = (job["summary"] or {}).get("usage", {})
+    if job["status"] is JobStatus.FAILED:
+        st.session_state["analysis_notice"] = f"Analysis failed: {job['error']}"
+    elif job["status"] is JobStatus.CANCELLED:
+        st.session_state["analysis_notice"] = "Analysis cancelled"
+    else:
+        st.session_state["analysis_notice"] = None
+    get_trace().record("job", (job["finished_at"] or time.time()) - job["created_at"])
+    del st.session_state["job_id"]
+
+
+def cancel_speculative_ocr() -> None:
+    """Cancel the background OCR jobs of this session"""
+    if "ocr_jobs" in st.session_state:
+        st.session_state.ocr_jobs.cancel()
+
+
 def run() -> None:
     """
     Main Driver Code
     """
     st.title("Information Extraction using LLM")
     st.markdown("""---""")
+    get_metrics_exporter()
+    trace = get_trace()
+
+    if not get_session_storage().touch(get_session_id()):
+        if "app" in st.session_state:
+            # The uploads and results of the session were evicted while it
+            # was idle, start over
+            cancel_speculative_ocr()
+            for key in list(st.session_state.keys()):
+                if key != "session_id":
+                    del st.session_state[key]
+            st.info("Your session expired, please upload your files again", icon="⌛")
 
     if "app" not in st.session_state:
         st.session_state["app"] = App()
@@ -145,6 +631,10 @@ def run() -> None:
         st.session_state["schema_length"] = 1
         st.session_state["tries"] = 0
 
+    notice = st.session_state.pop("session_notice", None)
+    if notice:
+        st.info(notice, icon="⌛")
+
     if st.session_state.app.state == AnalysisStage.DEFAULT:
         if st.session_state.tries == 0:
             api_key = st.text_input(
@@ -160,6 +650,7 @@ def run() -> None:
             )
 
         st.session_state.openai_api_key = api_key
+        st.session_state["free_tier"] = False
 
         submit_btn = st.button(
             label="Submit Key",
@@ -168,7 +659,7 @@ def run() -> None:
         )
 
         st.markdown("""---""")
-        
+
         if ALLOW_FREE:
             if st.session_state.tries < 5:
                 try_for_free = st.button(
@@ -191,6 +682,7 @@ def run() -> None:
                     time.sleep(3)
                     st.rerun()
                 st.session_state.openai_api_key = st.secrets["OPENAI_API_KEY"]
+                st.session_state["free_tier"] = True
                 st.session_state.app.openai_api_key_presented()
 
     if st.session_state.app.state == AnalysisStage.FILE_UPLOAD:
@@ -204,21 +696,23 @@ def run() -> None:
 
         if len(uploaded_files) == 1:
             # print("Here!")
-            st.session_state["uploaded_files"] = uploaded_files
+            st.session_state["uploaded_files"] = spill_uploads(uploaded_files)
+            start_speculative_ocr(st.session_state.uploaded_files)
             st.session_state.app.single_file_uploaded()
             st.rerun()
 
         elif len(uploaded_files) > 1:
             # print("Here2!")
-            if len(uploaded_files) > 5:
+            if len(uploaded_files) > MAX_UPLOAD_FILES:
                 uploaded_files = []
                 st.error(
-                    "For now only a maximum of 5 files can be uploaded at once!",
+                    f"For now only a maximum of {MAX_UPLOAD_FILES} files can be uploaded at once!",
                     icon="❌",
                 )
                 st.rerun()
 
-            st.session_state["uploaded_files"] = uploaded_files
+            st.session_state["uploaded_files"] = spill_uploads(uploaded_files)
+            start_speculative_ocr(st.session_state.uploaded_files)
             st.session_state.app.single_file_uploaded()
             st.rerun()
 
@@ -293,108 +787,85 @@ def run() -> None:
 
     if st.session_state.app.state == AnalysisStage.TEXT_ANALYZE:
         # st.text("text analyze")
-        print(st.session_state.field_values)
-        print(st.session_state.dtype_values)
-
-        my_bar = st.progress(0, text="Analysis in progress. Please wait!")
-        st.session_state["llm_output"] = []
+        uploaded_files = st.session_state.uploaded_files
+        queue = get_job_queue()
+        get_job_workers()
+
+        # The analysis runs on the job queue, so reruns and reconnects of the
+        # page only poll its progress
+        job = None
+        if "job_id" in st.session_state:
+            job = queue.status(st.session_state.job_id)
+        if job is None:
+            st.session_state["job_id"] = enqueue_analysis(uploaded_files)
+            job = queue.status(st.session_state.job_id)
+        job_id = st.session_state.job_id
 
         with st.container():
-            for cnt, uploaded_file in enumerate(st.session_state.uploaded_files):
-                if uploaded_file.tell() > 0:
-                    uploaded_file.seek(0)
-
-                file_hash = generate_hash(uploaded_file.read())
-                uploaded_file.seek(0)
-
-                my_bar.progress(
-                    cnt / len(st.session_state.uploaded_files),
-                    text=f"Analyzing {uploaded_file.name}",
-                )
-                byte_type: str = uploaded_file.name.split(".")[-1]
-                print(byte_type)
-
-                if byte_type == "pdf":
-                    url: str = (
-                        HOST_URL + ":" + OCR_SERVICE_PORT + "/" + OCR_PDF_RESP_ENDPOINT
-                    )
-                    files = [
-                        (
-                            "file",
-                            (
-                                uploaded_file.name,
-                                uploaded_file,
-                                "application/pdf",
-                            ),
-                        )
-                    ]
-                else:
-                    url = (
-                        HOST_URL + ":" + OCR_SERVICE_PORT + "/" + OCR_IMG_RESP_ENDPOINT
-                    )
-                    files = [
-                        (
-                            "file",
-                            (
-                                uploaded_file.name,
-                                uploaded_file,
-                                f"image/{byte_type}",
-                            ),
-                        )
-                    ]
-
-                payload = {}
-                headers = {}
-
-                resp = get_ocr_response(
-                    url=url,
-                    payload=payload,
-                    files=files,
-                    headers=headers,
-                    file_hash=file_hash,
-                )
-                if resp.status_code == 200:
-                    st.info("Received OCR Output", icon="ℹ️")
-                else:
-                    st.warning(
-                        "Failed to receive OCR output! Skipping this document",
-                        icon="⚠️",
-                    )
-                    continue
-
-                resp_json = json.loads(resp.text)
-                # st.write("Extracting information from text")
-                schema = build_schema(
-                    field_values=st.session_state.field_values,
-                    dtype_values=st.session_state.dtype_values,
-                    required=st.session_state.required_field,
+            st.progress(
+                job["completed"] / max(1, job["total"]),
+                text=f"Analyzed {job['completed']} of {job['total']} files. Please wait!",
+            )
+            for problem in job["problems"]:
+                st.warning(
+                    f"{problem['name']}: {problem['error']}! Skipping this document",
+                    icon="⚠️",
                 )
-                with st.spinner("OpenAI API Analyzing Text"):
-                    llm_obj = LLM(
-                        temperature=st.session_state.temp,
-                        openai_api_key=st.session_state.openai_api_key,
-                    )
-                    output = llm_obj.analyze_text(resp_json["text"], schema=schema)
 
-                st.session_state.llm_output.append(output)
-                # st.write("Received LLM Output!")
+            if job["status"] in FINISHED:
+                attach_job_results(job_id, job)
+                st.session_state.app.llm_output()
+                st.rerun()
 
-            my_bar.progress(
-                1.0,
-                text="Done Analyzing!",
-            )
-            st.success("Analysis Complete!")
-            time.sleep(2)
-            st.session_state.app.llm_output()
+            cancel = st.button("Cancel Analysis", use_container_width=True)
+
+            # Files are shown as soon as their extraction finishes, and while
+            # long documents are extracted chunk by chunk
+            results = queue.results(job_id)
+            for tab, result in zip(
+                st.tabs([uploaded_file.name for uploaded_file in uploaded_files]),
+                results,
+            ):
+                with tab:
+                    if result is None:
+                        st.caption("Waiting for OCR...")
+                        continue
+                    if result.get("partial"):
+                        st.caption("Extracting...")
+                    st.dataframe(pd.DataFrame(result["output"]))
+                    for note in describe_result(result):
+                        st.caption(note)
+
+            if cancel:
+                queue.cancel(job_id)
+            # Returns as soon as a file makes progress
+            queue.wait(job_id, since=job["updated_at"], timeout=JOB_POLL_INTERVAL)
             st.rerun()
 
     if st.session_state.app.state == AnalysisStage.LLM_OUTPUT:
         # print(len(st.session_state.llm_output))
+        results = get_session_storage().get(get_session_id(), "results")
+        if results is None:
+            # The results were released with the session storage, e.g. after
+            # a restart of the app, start over
+            cancel_speculative_ocr()
+            st.session_state["session_notice"] = (
+                "The results of your last analysis are no longer available, "
+                "please upload your files again"
+            )
+            st.session_state.app.analyze_more()
+            st.rerun()
+
         all_files = [
             uploaded_file.name for uploaded_file in st.session_state.uploaded_files
         ]
         st.markdown("## LLM Output")
+        if st.session_state.get("analysis_notice"):
+            st.warning(st.session_state.analysis_notice, icon="⚠️")
+        ocr_stats = get_ocr_cache().stats()
+        st.caption(f"OCR cache: {ocr_stats['hits']} hits, {ocr_stats['misses']} misses")
         tab_list = st.tabs(all_files)
+        file_notes = st.session_state.get("file_notes", [])
 
         with st.sidebar:
             st.markdown("## Schema Builder")
@@ -479,8 +950,11 @@ def run() -> None:
 
         for cnt, tab in enumerate(tab_list):
             with tab:
-                df = pd.DataFrame(st.session_state.llm_output[cnt])
+                with trace.span("dataframe"):
+                    df = results.frame(cnt)
                 st.dataframe(df)
+                for note in file_notes[cnt] if cnt < len(file_notes) else []:
+                    st.caption(note)
 
                 upload_more = st.button(
                     "Analyze more files",
@@ -494,14 +968,17 @@ def run() -> None:
                 )
 
                 if upload_more:
+                    cancel_speculative_ocr()
                     st.session_state.app.analyze_more()
                     st.rerun()
 
                 if update_key:
+                    cancel_speculative_ocr()
                     st.session_state.app.update_api_key()
                     st.rerun()
 
-                csv = convert_to_csv(df)
+                with trace.span("csv"):
+                    csv = results.csv(cnt)
                 st.download_button(
                     label="Export as CSV 💾",
                     data=csv,
@@ -511,6 +988,31 @@ def run() -> None:
                     use_container_width=True,
                 )
 
+        if len(all_files) > 1:
+            export_format = st.selectbox(
+                "Export format", list(EXPORT_FORMATS), key="export_format"
+            )
+            with trace.span("export"):
+                export_path = results.export_file(export_format)
+            with open(export_path, "rb") as f:
+                st.download_button(
+                    label="Export all files 💾",
+                    data=f,
+                    file_name=f"results.{export_format}",
+                    mime=EXPORT_FORMATS[export_format],
+                    key="export_all",
+                    use_container_width=True,
+                )
+
+        if DEBUG_PANEL:
+            with st.expander("Debug"):
+                st.markdown("#### Stage timings of this session")
+                st.dataframe(pd.DataFrame(trace.summary()), use_container_width=True)
+                st.markdown("#### LLM usage of the last analysis")
+                st.json(st.session_state.get("llm_usage", {}))
+                st.markdown("#### Metrics")
+                st.code(registry.render(), language="text")
+
         # st.json(body=st.session_state.llm_output, expanded=True)
 
 
@@ -0,0 +1,400 @@
+# Copyright 2023 Aditya Mohan
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Disk backed storage of the uploads and results of sessions
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+import weakref
+from typing import Any, BinaryIO, Optional
+
+from metrics import render_gauge
+from utils import HASH_BLOCK_SIZE, generate_hash
+
+
+class FileHandle:
+    """Reference to an upload spilled to a `BlobStore`
+
+    Kept in the session state in place of the uploaded file, so that the
+    session holds a name and a path instead of the file content.
+    """
+
+    __slots__ = ("name", "file_hash", "size", "path")
+
+    def __init__(self, name: str, file_hash: str, size: int, path: str) -> None:
+        """
+        Args:
+            name (str): File name of the upload
+            file_hash (str): Hash of the content, see `generate_hash`
+            size (int): Size in bytes
+            path (str): Location of the content
+        """
+        self.name = name
+        self.file_hash = file_hash
+        self.size = size
+        self.path = path
+
+    def open(self) -> BinaryIO:
+        """Opens the content for reading
+
+        Raises:
+            FileNotFoundError: The session of the upload was evicted
+        """
+        return open(self.path, "rb")
+
+
+class BlobStore:
+    """Content addressed files in a private temporary directory
+
+    Blobs are named by the hash of their content, so identical uploads of
+    different sessions are stored once. The directory is removed when the
+    store is garbage collected or the process exits.
+    """
+
+    def __init__(self, directory: Optional[str] = None) -> None:
+        """
+        Args:
+            directory (str, optional): Parent of the store directory, defaults
+                to the system temporary directory
+        """
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = tempfile.mkdtemp(prefix="blobs-", dir=directory)
+        weakref.finalize(self, shutil.rmtree, self.path, ignore_errors=True)
+
+    def blob_path(self, key: str) -> str:
+        """Location of a blob
+
+        Args:
+            key (str): Hash of the content
+
+        Returns:
+            str: Path of the blob
+        """
+        return os.path.join(self.path, key)
+
+    def _commit(self, tmp_path: str, key: str) -> None:
+        path = self.blob_path(key)
+        if os.path.exists(path):
+            os.remove(tmp_path)
+        else:
+            os.replace(tmp_path, path)
+
+    def put_file(self, file_obj: BinaryIO, block_size: int = HASH_BLOCK_SIZE) -> tuple:
+        """Copies a file object into the store, hashing it on the way
+
+        Args:
+            file_obj (BinaryIO): Readable file object, read from its current
+                position to the end
+            block_size (int): Number of bytes copied at a time
+
+        Returns:
+            tuple: Key and size of the blob
+        """
+        digest = hashlib.sha256()
+        size = 0
+        tmp_path = os.path.join(self.path, f"{uuid.uuid4().hex}.tmp")
+        with open(tmp_path, "wb") as f:
+            for block in iter(lambda: file_obj.read(block_size), b""):
+                digest.update(block)
+                f.write(block)
+                size += len(block)
+        key = digest.hexdigest()
+        self._commit(tmp_path, key)
+        return key, size
+
+    def put(self, data: bytes) -> str:
+        """Stores bytes
+
+        Args:
+            data (bytes): Content
+
+        Returns:
+            str: Key of the blob
+        """
+        key = generate_hash(data)
+        if not os.path.exists(self.blob_path(key)):
+            tmp_path = os.path.join(self.path, f"{uuid.uuid4().hex}.tmp")
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            self._commit(tmp_path, key)
+        return key
+
+    def get(self, key: str) -> bytes:
+        """Reads a blob
+
+        Args:
+            key (str): Key of the blob
+
+        Raises:
+            FileNotFoundError: The blob was deleted
+
+        Returns:
+            bytes: Content
+        """
+        with open(self.blob_path(key), "rb") as f:
+            return f.read()
+
+    def delete(self, key: str) -> None:
+        """Deletes a blob if it exists
+
+        Args:
+            key (str): Key of the blob
+        """
+        try:
+            os.remove(self.blob_path(key))
+        except FileNotFoundError:
+            pass
+
+
+class _Session:
+    def __init__(self) -> None:
+        self.last_seen = time.monotonic()
+        self.blobs = {}
+        self.objects = {}
+
+
+class SessionStorage:
+    """Spills the uploads and results of sessions to disk
+
+    Sessions keep `FileHandle`s and blob keys in their state instead of the
+    content. Blobs are reference counted across sessions and deleted once no
+    session refers to them. Objects that have to stay in memory, e.g. the
+    result store of the last analysis, are attached to their session here so
+    that they are accounted for and released together with the blobs when the
+    session was idle for longer than `ttl` seconds.
+    """
+
+    def __init__(self, store: Optional[BlobStore] = None, ttl: float = 3600) -> None:
+        """
+        Args:
+            store (BlobStore, optional): Where blobs are spilled, defaults to
+                a store in the system temporary directory
+            ttl (float): Seconds after which an idle session is evicted
+        """
+        self.store = store or BlobStore()
+        self.ttl = ttl
+        self._sessions = {}
+        self._refs = {}
+        self._evictions = 0
+        self._lock = threading.Lock()
+
+    def _evict_idle(self, now: float) -> None:
+        for session_id in [
+            session_id
+            for session_id, session in self._sessions.items()
+            if now - session.last_seen > self.ttl
+        ]:
+            self._drop(session_id)
+            self._evictions += 1
+
+    def _drop(self, session_id: str) -> None:
+        session = self._sessions.pop(session_id)
+        for key in session.blobs:
+            self._unref(session_id, key)
+
+    def _unref(self, session_id: str, key: str) -> None:
+        refs = self._refs.get(key)
+        if refs is None:
+            return
+        refs.discard(session_id)
+        if not refs:
+            del self._refs[key]
+            self.store.delete(key)
+
+    def _session(self, session_id: str) -> _Session:
+        session = self._sessions.get(session_id)
+        if session is None:
+            session = self._sessions[session_id] = _Session()
+        session.last_seen = time.monotonic()
+        return session
+
+    def touch(self, session_id: str) -> bool:
+        """Marks a session as active and evicts the idle ones
+
+        Args:
+            session_id (str): Session id
+
+        Returns:
+            bool: False if the session was not known, e.g. because it was
+            evicted, in which case it is registered anew
+        """
+        with self._lock:
+            self._evict_idle(time.monotonic())
+            known = session_id in self._sessions
+            self._session(session_id)
+            return known
+
+    def _add_blob(self, session_id: str, key: str, size: int) -> None:
+        self._session(session_id).blobs[key] = size
+        self._refs.setdefault(key, set()).add(session_id)
+
+    def put_upload(self, session_id: str, uploaded_file) -> FileHandle:
+        """Spills an uploaded file
+
+        Args:
+            session_id (str): Session id
+            uploaded_file (UploadedFile): File uploaded by the user
+
+        Returns:
+            FileHandle: Handle to keep in the session state
+        """
+        uploaded_file.seek(0)
+        key, size = self.store.put_file(uploaded_file)
+        with self._lock:
+            if not os.path.exists(self.store.blob_path(key)):
+                # Deleted by another session releasing the same content
+                uploaded_file.seek(0)
+                self.store.put_file(uploaded_file)
+            self._add_blob(session_id, key, size)
+        uploaded_file.seek(0)
+        return FileHandle(uploaded_file.name, key, size, self.store.blob_path(key))
+
+    def put_json(self, session_id: str, value: Any) -> str:
+        """Spills a JSON serializable value, e.g. extraction results
+
+        Args:
+            session_id (str): Session id
+            value (Any): Value to store
+
+        Returns:
+            str: Key to keep in the session state
+        """
+        data = json.dumps(value).encode("utf-8")
+        key = self.store.put(data)
+        with self._lock:
+            if not os.path.exists(self.store.blob_path(key)):
+                self.store.put(data)
+            self._add_blob(session_id, key, len(data))
+        return key
+
+    def get_json(self, key: str) -> Any:
+        """Loads a value stored with `put_json`
+
+        Args:
+            key (str): Key returned by `put_json`
+
+        Raises:
+            FileNotFoundError: The session of the value was evicted
+
+        Returns:
+            Any: Stored value
+        """
+        return json.loads(self.store.get(key))
+
+    def release(self, session_id: str, key: str) -> None:
+        """Drops the reference of a session to a blob
+
+        Args:
+            session_id (str): Session id
+            key (str): Blob key or `FileHandle.file_hash`
+        """
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is not None and session.blobs.pop(key, None) is not None:
+                self._unref(session_id, key)
+
+    def attach(self, session_id: str, name: str, obj: Any) -> None:
+        """Keeps an in-memory object until the session is evicted
+
+        Objects with an `nbytes` method are included in the memory accounting.
+
+        Args:
+            session_id (str): Session id
+            name (str): Name of the object within the session
+            obj (Any): Object, None removes it
+        """
+        with self._lock:
+            objects = self._session(session_id).objects
+            if obj is None:
+                objects.pop(name, None)
+            else:
+                objects[name] = obj
+
+    def get(self, session_id: str, name: str) -> Any:
+        """Gets an object attached to a session
+
+        Args:
+            session_id (str): Session id
+            name (str): Name of the object
+
+        Returns:
+            Any: The object, None if it is not attached
+        """
+        with self._lock:
+            session = self._sessions.get(session_id)
+            return session.objects.get(name) if session is not None else None
+
+    def stats(self) -> dict:
+        """Storage statistics
+
+        Returns:
+            dict: Number of sessions, evicted sessions, bytes on disk of all
+            distinct blobs, bytes in memory of the attached objects and the
+            bytes on disk and in memory per session
+        """
+        with self._lock:
+            sessions = {
+                session_id: (dict(session.blobs), list(session.objects.values()))
+                for session_id, session in self._sessions.items()
+            }
+            evictions = self._evictions
+
+        per_session = {}
+        disk = {}
+        for session_id, (blobs, objects) in sessions.items():
+            disk.update(blobs)
+            per_session[session_id] = dict(
+                disk_bytes=sum(blobs.values()),
+                memory_bytes=sum(
+                    obj.nbytes() for obj in objects if hasattr(obj, "nbytes")
+                ),
+            )
+        return dict(
+            sessions=len(sessions),
+            evictions=evictions,
+            disk_bytes=sum(disk.values()),
+            memory_bytes=sum(s["memory_bytes"] for s in per_session.values()),
+            per_session=per_session,
+        )
+
+    def render_metrics(self) -> str:
+        """Session counts and bytes in the text exposition format
+
+        Returns:
+            str: Metrics text
+        """
+        stats = self.stats()
+        lines = render_gauge(
+            "sessions",
+            "Sessions with stored uploads or results",
+            {(): stats["sessions"]},
+        )
+        lines += render_gauge(
+            "session_storage_bytes",
+            "Bytes of the uploads and results of all sessions",
+            {
+                (("tier", "disk"),): stats["disk_bytes"],
+                (("tier", "memory"),): stats["memory_bytes"],
+            },
+        )
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,104 @@
+import json
+
+import pytest
+
+import cache
+from cache import DiskCache, MemoryCache
+
+
+class Clock:
+    def __init__(self, now: float = 1000.0) -> None:
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+    def tick(self, seconds: float = 1.0) -> None:
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache.time, "time", clock)
+    return clock
+
+
+def size(value: dict) -> int:
+    return len(json.dumps(value).encode("utf-8"))
+
+
+def test_round_trip_and_stats(tmp_path, clock):
+    store = DiskCache(str(tmp_path / "cache.sqlite3"))
+    assert store.get("a") is None
+    store.set("a", dict(text="hello"))
+    assert store.get("a") == dict(text="hello")
+    stats = store.stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (1, 1, 1)
+    assert stats["size_bytes"] == size(dict(text="hello"))
+
+
+def test_least_recently_used_entry_is_evicted_past_max_entries(tmp_path, clock):
+    store = DiskCache(str(tmp_path / "cache.sqlite3"), max_entries=2)
+    store.set("a", dict(v=1))
+    clock.tick()
+    store.set("b", dict(v=2))
+    clock.tick()
+    # Reading "a" makes "b" the least recently used entry
+    assert store.get("a") == dict(v=1)
+    clock.tick()
+    store.set("c", dict(v=3))
+
+    assert store.get("b") is None
+    assert store.get("a") == dict(v=1)
+    assert store.get("c") == dict(v=3)
+
+
+def test_entries_are_evicted_past_max_bytes(tmp_path, clock):
+    value = dict(text="x" * 100)
+    store = DiskCache(str(tmp_path / "cache.sqlite3"), max_bytes=2 * size(value))
+    for key in ("a", "b", "c"):
+        store.set(key, value)
+        clock.tick()
+
+    assert store.get("a") is None
+    assert store.get("b") == value
+    assert store.get("c") == value
+    assert store.stats()["size_bytes"] == 2 * size(value)
+
+
+def test_value_larger_than_max_bytes_is_not_kept(tmp_path, clock):
+    store = DiskCache(str(tmp_path / "cache.sqlite3"), max_bytes=10)
+    store.set("a", dict(text="x" * 100))
+    assert store.get("a") is None
+    assert store.stats()["entries"] == 0
+
+
+def test_entries_expire_after_ttl(tmp_path, clock):
+    store = DiskCache(str(tmp_path / "cache.sqlite3"), ttl=60)
+    store.set("a", dict(v=1))
+    clock.tick(30)
+    # Reads do not extend the lifetime of an entry
+    assert store.get("a") == dict(v=1)
+    clock.tick(31)
+    assert store.get("a") is None
+
+    # Expired entries are removed on the next write
+    store.set("b", dict(v=2))
+    assert store.stats()["entries"] == 1
+
+
+def test_entries_are_shared_between_instances(tmp_path, clock):
+    path = str(tmp_path / "cache.sqlite3")
+    DiskCache(path).set("a", dict(v=1))
+    assert DiskCache(path).get("a") == dict(v=1)
+
+
+def test_memory_cache_evicts_least_recently_used():
+    store = MemoryCache(max_entries=2)
+    store.set("a", 1)
+    store.set("b", 2)
+    assert store.get("a") == 1
+    store.set("c", 3)
+    assert store.get("b") is None
+    assert (store.get("a"), store.get("c")) == (1, 3)
@@ -0,0 +1,52 @@
+from chunking import PAGE_BREAK, count_tokens, merge_entities, split_text
+
+
+def test_entity_split_at_boundary_is_merged():
+    outputs = [[{"name": "A", "qty": None}], [{"name": None, "qty": 3}]]
+    assert merge_entities(outputs) == [{"name": "A", "qty": 3}]
+
+
+def test_entities_of_non_adjacent_chunks_are_not_merged():
+    outputs = [[{"name": "A", "qty": None}], [{"qty": 3}], [], [{"total": 9}]]
+    assert merge_entities(outputs) == [{"name": "A", "qty": 3}, {"total": 9}]
+
+
+def test_only_boundary_entities_of_multi_entity_chunks_are_merged():
+    outputs = [[{"name": "A"}, {"name": "B"}], [{"qty": 1}, {"price": 5}]]
+    assert merge_entities(outputs) == [
+        {"name": "A"},
+        {"name": "B", "qty": 1},
+        {"price": 5},
+    ]
+
+
+def test_conflicting_boundary_entities_are_kept_apart():
+    outputs = [[{"name": "A", "qty": 1}], [{"name": "B", "qty": 2}]]
+    assert merge_entities(outputs) == [
+        {"name": "A", "qty": 1},
+        {"name": "B", "qty": 2},
+    ]
+
+
+def test_contained_duplicates_are_dropped():
+    outputs = [[{"name": "A", "qty": 1}], [{"name": "A", "qty": 1}, {"name": "A"}]]
+    assert merge_entities(outputs) == [{"name": "A", "qty": 1}]
+
+
+def test_empty_entities_are_dropped():
+    assert merge_entities([[{"name": None, "qty": " "}], None]) == []
+
+
+def test_split_text_respects_budget_and_keeps_text():
+    text = PAGE_BREAK.join(
+        "\n\n".join(f"Paragraph {page}.{i} " + "word " * 30 for i in range(5))
+        for page in range(3)
+    )
+    chunks = split_text(text, 100)
+    assert len(chunks) > 1
+    assert all(count_tokens(chunk) <= 100 for chunk in chunks)
+    assert all(f"Paragraph 2.{i}" in "".join(chunks) for i in range(5))
+
+
+def test_short_text_is_one_chunk():
+    assert split_text("Short text", 100) == ["Short text"]
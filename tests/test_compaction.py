@@ -0,0 +1,53 @@
+from chunking import PAGE_BREAK
+from compaction import TextCompactor
+
+
+def compact(text: str) -> str:
+    return TextCompactor().compact(text)[0]
+
+
+def test_single_page_keeps_trailing_amount():
+    assert compact("Invoice\nTotal due\n1250\n") == "Invoice\nTotal due\n1250"
+
+
+def test_single_page_keeps_year_and_short_tokens():
+    text = "Name: Bob\nY N N Y\nAmount\n2023\n"
+    assert compact(text) == "Name: Bob\nY N N Y\nAmount\n2023"
+
+
+def test_single_page_keeps_spelled_out_page_number():
+    assert compact("Page 1 of 1\nTotal: 5") == "Page 1 of 1\nTotal: 5"
+
+
+def test_spelled_out_page_numbers_are_dropped():
+    pages = [f"Body {i}\nText {i}\nPage {i} of 3" for i in range(1, 4)]
+    assert compact(PAGE_BREAK.join(pages)).split(PAGE_BREAK) == [
+        f"Body {i}\nText {i}" for i in range(1, 4)
+    ]
+
+
+def test_bare_page_numbers_counting_up_are_dropped():
+    pages = [f"Body {i}\n{i}" for i in range(1, 4)]
+    assert compact(PAGE_BREAK.join(pages)).split(PAGE_BREAK) == [
+        f"Body {i}" for i in range(1, 4)
+    ]
+
+
+def test_bare_numbers_not_counting_up_are_kept():
+    text = PAGE_BREAK.join(["Subtotal\n1250", "Total due\n980"])
+    assert compact(text).split(PAGE_BREAK) == ["Subtotal\n1250", "Total due\n980"]
+
+
+def test_headers_repeated_across_pages_are_kept_once():
+    pages = [f"ACME Corp\nLine {i}\nMore {i}\nEnd {i}" for i in range(3)]
+    result, stats = TextCompactor().compact(PAGE_BREAK.join(pages))
+    assert result.count("ACME Corp") == 1
+    assert stats["headers_footers"] == 2
+
+
+def test_noise_and_boilerplate_are_dropped():
+    compactor = TextCompactor(boilerplate=[r"^confidential"])
+    result, stats = compactor.compact("Name: Bob\n~~##~~\nConfidential notice\nAge")
+    assert result == "Name: Bob\nAge"
+    assert stats["garbage"] == 1
+    assert stats["boilerplate"] == 1
@@ -0,0 +1,124 @@
+import email
+import io
+
+import pytest
+
+import ocr_client
+from ocr_client import CircuitBreaker, MultipartStream
+
+
+def parse(body: MultipartStream) -> dict:
+    data = body.read()
+    message = email.message_from_bytes(
+        f"Content-Type: {body.content_type}\r\n\r\n".encode("utf-8") + data
+    )
+    return {
+        part.get_param("name", header="content-disposition"): (
+            part.get_filename(),
+            part.get_payload(decode=True),
+        )
+        for part in message.get_payload()
+    }
+
+
+def test_body_holds_fields_and_files():
+    body = MultipartStream(
+        fields=dict(lang="en"),
+        files=[("file", ("a.pdf", io.BytesIO(b"%PDF-1.4 data"), "application/pdf"))],
+    )
+    assert parse(body) == {
+        "lang": (None, b"en"),
+        "file": ("a.pdf", b"%PDF-1.4 data"),
+    }
+
+
+def test_length_matches_the_bytes_read_in_blocks():
+    data = bytes(range(256)) * 100
+    body = MultipartStream(
+        fields=None,
+        files=[("file", ("a.png", io.BytesIO(data), "image/png"))],
+        block_size=1000,
+    )
+    chunks = []
+    while True:
+        chunk = body.read(777)
+        if not chunk:
+            break
+        assert len(chunk) <= 777
+        chunks.append(chunk)
+    assert len(body) == sum(len(chunk) for chunk in chunks)
+    assert data in b"".join(chunks)
+
+
+def test_file_is_sent_from_its_current_position():
+    file_obj = io.BytesIO(b"skipped|sent")
+    file_obj.seek(8)
+    body = MultipartStream(
+        fields=None, files=[("file", ("a.pdf", file_obj, "application/pdf"))]
+    )
+    assert parse(body)["file"] == ("a.pdf", b"sent")
+    body.reset()
+    assert len(body.read()) == len(body)
+
+
+def test_reset_sends_the_same_body_again():
+    body = MultipartStream(
+        fields=dict(lang="en"),
+        files=[("file", ("a.pdf", io.BytesIO(b"x" * 5000), "application/pdf"))],
+        block_size=64,
+    )
+    first = body.read()
+    body.reset()
+    assert body.read() == first
+    assert len(first) == len(body)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(ocr_client.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_circuit_opens_after_consecutive_failures(clock):
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30)
+    breaker.record_failure()
+    breaker.record_failure()
+    # A success in between resets the count
+    breaker.record_success()
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.allow() and not breaker.is_open
+
+    breaker.record_failure()
+    assert breaker.is_open
+    assert not breaker.allow()
+
+
+def test_single_trial_request_after_the_reset_timeout(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+    breaker.record_failure()
+    clock[0] += 29
+    assert not breaker.allow()
+
+    clock[0] += 1
+    assert breaker.allow()
+    # Only one trial at a time
+    assert not breaker.allow()
+
+    breaker.record_success()
+    assert not breaker.is_open
+    assert breaker.allow()
+
+
+def test_failed_trial_keeps_the_circuit_open(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+    breaker.record_failure()
+    clock[0] += 30
+    assert breaker.allow()
+
+    breaker.record_failure()
+    assert breaker.is_open
+    assert not breaker.allow()
+    clock[0] += 30
+    assert breaker.allow()
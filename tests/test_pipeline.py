@@ -0,0 +1,89 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+import pytest
+
+from pipeline import SingleFlight
+
+
+def start_leader(flight, key, fn):
+    """Runs `fn` under `key` on a thread and waits until it is in flight"""
+    started = threading.Event()
+    release = threading.Event()
+
+    def leader():
+        started.set()
+        release.wait(5)
+        return fn()
+
+    pool = ThreadPoolExecutor(max_workers=1)
+    future = pool.submit(flight.do, key, leader)
+    started.wait(5)
+    pool.shutdown(wait=False)
+    return future, release
+
+
+def submit_waiters(pool, flight, key, fn, count):
+    """Calls `flight.do` from `count` threads and gives them time to block"""
+    ready = threading.Semaphore(0)
+
+    def waiter():
+        ready.release()
+        return flight.do(key, fn)
+
+    waiters = [pool.submit(waiter) for _ in range(count)]
+    for _ in range(count):
+        ready.acquire(timeout=5)
+    time.sleep(0.05)
+    return waiters
+
+
+def test_concurrent_calls_with_the_same_key_run_once():
+    flight = SingleFlight("test")
+    calls = []
+    leader, release = start_leader(flight, "k", lambda: calls.append(1) or "done")
+
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        waiters = submit_waiters(pool, flight, "k", lambda: calls.append(2), 3)
+        release.set()
+        assert leader.result(5) == ("done", True)
+        assert [w.result(5) for w in waiters] == [("done", False)] * 3
+    assert calls == [1]
+    assert flight.in_flight() == 0
+
+
+def test_different_keys_do_not_wait_for_each_other():
+    flight = SingleFlight("test")
+    leader, release = start_leader(flight, "a", lambda: "a")
+    assert flight.do("b", lambda: "b") == ("b", True)
+    release.set()
+    assert leader.result(5) == ("a", True)
+
+
+def test_exception_is_handed_to_every_waiter():
+    flight = SingleFlight("test")
+
+    def fail():
+        raise ValueError("boom")
+
+    leader, release = start_leader(flight, "k", fail)
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        (waiter,) = submit_waiters(pool, flight, "k", lambda: "never", 1)
+        release.set()
+        with pytest.raises(ValueError):
+            leader.result(5)
+        with pytest.raises(ValueError):
+            waiter.result(5)
+    # Nothing is kept once the call finished
+    assert flight.do("k", lambda: "again") == ("again", True)
+
+
+def test_waiter_gives_up_after_the_timeout():
+    flight = SingleFlight("test", timeout=0.05)
+    leader, release = start_leader(flight, "k", lambda: "late")
+    with pytest.raises(FutureTimeoutError):
+        flight.do("k", lambda: "never")
+    release.set()
+    assert leader.result(5) == ("late", True)
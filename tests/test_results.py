@@ -0,0 +1,62 @@
+import io
+
+import pyarrow.parquet as pq
+
+from results import ResultStore
+from utils import build_schema
+
+
+def make_store(fields: dict) -> ResultStore:
+    schema = build_schema(
+        field_values=list(fields),
+        dtype_values=list(fields.values()),
+        required=[False] * len(fields),
+    )
+    return ResultStore(schema)
+
+
+def test_values_that_do_not_convert_are_kept_raw():
+    store = make_store({"vendor": "string", "total": "integer"})
+    store.put(0, "a.pdf", [{"vendor": "ACME", "total": "1,234"}, {"total": "n/a"}])
+    assert store.output(0) == [
+        {"vendor": "ACME", "total": 1234, "total_raw": None},
+        {"vendor": None, "total": None, "total_raw": "n/a"},
+    ]
+
+
+def test_raw_column_is_hidden_without_rejected_values():
+    store = make_store({"total": "integer"})
+    store.put(0, "a.pdf", [{"total": 7}])
+    assert list(store.frame(0).columns) == ["total"]
+
+
+def test_field_named_document_keeps_its_values():
+    store = make_store({"document": "string", "total": "integer"})
+    store.put(0, "a.pdf", [{"document": "Invoice", "total": 3}])
+    assert store.document_column == "document_1"
+    assert store.output(0) == [{"document": "Invoice", "total": 3}]
+
+    out = io.BytesIO()
+    store.export("parquet", out)
+    out.seek(0)
+    assert pq.read_table(out).to_pylist() == [
+        {"document_1": "a.pdf", "document": "Invoice", "total": 3, "total_raw": None}
+    ]
+
+
+def test_field_named_like_a_raw_column_keeps_its_values():
+    store = make_store({"total": "integer", "total_raw": "string"})
+    store.put(0, "a.pdf", [{"total": "many", "total_raw": "12 items"}])
+    assert store.raw_fields == {"total": "total_raw_1"}
+    assert store.output(0) == [
+        {"total": None, "total_raw_1": "many", "total_raw": "12 items"}
+    ]
+
+
+def test_put_replaces_the_batch_of_a_file():
+    store = make_store({"total": "integer"})
+    store.put(0, "a.pdf", [{"total": 1}])
+    store.frame(0)
+    store.put(0, "a.pdf", [{"total": 2}])
+    assert store.frame(0)["total"].tolist() == [2]
+    assert len(store) == 1
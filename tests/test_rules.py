@@ -0,0 +1,115 @@
+import pytest
+
+from rules import FieldRule, RuleExtractor, parse_integer
+from utils import build_schema
+
+INVOICE = """ACME Corp
+Invoice No.: INV-2023-042
+Invoice Date: 12/03/2023
+Email: billing@acme.com  Phone: +1 (555) 123-4567
+Subtotal: $1,000.00
+Tax: $100.00
+Total amount due: $1,100.00
+Quantity: 12
+"""
+
+
+def schema(**fields) -> dict:
+    return build_schema(
+        field_values=list(fields),
+        dtype_values=list(fields.values()),
+        required=[True] * len(fields),
+    )
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [("$1,234.00", 1234), ("-42", -42), ("€ 7", 7), ("12.5", None), ("n/a", None)],
+)
+def test_parse_integer(value, expected):
+    assert parse_integer(value) == expected
+
+
+def test_labelled_fields_are_resolved():
+    found, unresolved = RuleExtractor().extract(
+        INVOICE,
+        schema(
+            invoice_number="string",
+            invoiceDate="string",
+            email="string",
+            phone="string",
+            total_amount="integer",
+            subtotal="integer",
+        ),
+    )
+    assert found == {
+        "invoice_number": "INV-2023-042",
+        "invoiceDate": "12/03/2023",
+        "email": "billing@acme.com",
+        "phone": "+1 (555) 123-4567",
+        "total_amount": 1100,
+        "subtotal": 1000,
+    }
+    assert unresolved == dict(properties={}, required=[])
+
+
+def test_unmatched_fields_are_left_to_the_llm():
+    found, unresolved = RuleExtractor().extract(
+        INVOICE, schema(vendor_name="string", quantity="integer", total="integer")
+    )
+    assert found == {"total": 1100}
+    assert list(unresolved["properties"]) == ["vendor_name", "quantity"]
+    assert unresolved["required"] == ["vendor_name", "quantity"]
+
+
+def test_ambiguous_values_are_left_to_the_llm():
+    text = "Invoice Date: 12/03/2023\nShipping date: 14/03/2023\n"
+    found, _ = RuleExtractor().extract(text, schema(date="string"))
+    assert found == {}
+
+    # The same value repeated is not ambiguous
+    text = "Invoice Date: 12/03/2023\nDate: 12/03/2023\n"
+    found, _ = RuleExtractor().extract(text, schema(date="string"))
+    assert found == {"date": "12/03/2023"}
+
+
+def test_unlabelled_email_is_not_taken():
+    text = "Contact: billing@acme.com\n"
+    found, _ = RuleExtractor().extract(text, schema(email="string"))
+    assert found == {}
+
+
+def test_integer_with_a_fraction_is_left_to_the_llm():
+    found, _ = RuleExtractor().extract("Total: $10.50\n", schema(total="integer"))
+    assert found == {}
+
+
+def test_low_confidence_rules_are_off_by_default():
+    text = "Quantity: 12\n"
+    found, _ = RuleExtractor().extract(text, schema(quantity="integer"))
+    assert found == {}
+
+    found, _ = RuleExtractor(min_confidence=0.8).extract(
+        text, schema(quantity="integer")
+    )
+    assert found == {"quantity": 12}
+
+
+def test_rules_apply_in_order_of_precedence():
+    rules = [
+        FieldRule("first", fields=r"code", value=r"[A-Z]+", labelled=False),
+        FieldRule("second", fields=r"code", value=r"\d+", labelled=False),
+    ]
+    found, _ = RuleExtractor(rules).extract("42", schema(code="string"))
+    assert found == {"code": "42"}
+    found, _ = RuleExtractor(rules).extract("ABC 42", schema(code="string"))
+    assert found == {"code": "ABC"}
+
+
+def test_stats():
+    extractor = RuleExtractor()
+    extractor.extract(INVOICE, schema(invoice_number="string"))
+    extractor.extract(INVOICE, schema(invoice_number="string", vendor="string"))
+    assert extractor.stats() == dict(
+        fields=3, hits=2, documents=2, complete=1, hit_rate=2 / 3
+    )
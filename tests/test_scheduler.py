@@ -0,0 +1,137 @@
+import threading
+import time
+
+import pytest
+
+from scheduler import RateScheduler, TokenBucket, is_rate_limit, retry_after
+
+
+class RateLimitError(Exception):
+    def __init__(self, headers=None):
+        super().__init__("429 Too Many Requests")
+        self.status_code = 429
+        self.response = type("Response", (), dict(headers=headers or {}))()
+
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "condition not reached"
+        time.sleep(0.005)
+
+
+def key_stats(scheduler):
+    return next(iter(scheduler.stats().values()), dict(in_flight=0, queued=0))
+
+
+def test_token_bucket_delay_and_debt():
+    bucket = TokenBucket(per_minute=60)
+    now = bucket.updated
+    assert bucket.delay(60, now) == 0.0
+    bucket.take(60, now)
+    assert bucket.delay(1, now) == pytest.approx(1.0)
+    # Usage above the estimate leaves a debt that later calls wait for
+    bucket.take(30, now)
+    assert bucket.delay(1, now) == pytest.approx(31.0)
+    assert bucket.delay(1, now + 31) == pytest.approx(0.0)
+
+
+def test_rate_limit_detection_and_retry_after():
+    assert is_rate_limit(RateLimitError())
+    assert not is_rate_limit(ValueError("bad request"))
+    assert retry_after(RateLimitError({"retry-after-ms": "250"})) == 0.25
+    assert retry_after(RateLimitError({"retry-after": "2"})) == 2.0
+    assert retry_after(RateLimitError({"retry-after": "soon"})) is None
+    assert retry_after(ValueError()) is None
+
+
+def test_call_returns_result_and_releases_the_slot():
+    scheduler = RateScheduler(max_concurrency=2)
+    assert scheduler.call("sk-a", lambda: 42, tokens=10) == 42
+    (stats,) = scheduler.stats().values()
+    assert stats["in_flight"] == 0
+    assert stats["completed"] == 1
+
+
+def test_rate_limited_call_is_retried_and_halves_the_limit():
+    scheduler = RateScheduler(max_concurrency=4)
+    attempts = []
+
+    def fn():
+        attempts.append(time.monotonic())
+        if len(attempts) == 1:
+            raise RateLimitError({"retry-after-ms": "50"})
+        return "ok"
+
+    assert scheduler.call("sk-a", fn) == "ok"
+    assert attempts[1] - attempts[0] >= 0.05
+    (stats,) = scheduler.stats().values()
+    assert stats["rate_limited"] == 1
+    assert stats["limit"] < 4
+
+
+def test_rate_limit_is_raised_once_the_retries_are_exhausted():
+    scheduler = RateScheduler(max_retries=2)
+    calls = []
+
+    def fn():
+        calls.append(1)
+        raise RateLimitError({"retry-after-ms": "1"})
+
+    with pytest.raises(RateLimitError):
+        scheduler.call("sk-a", fn)
+    assert len(calls) == 3
+
+
+def test_other_errors_are_not_retried():
+    scheduler = RateScheduler()
+    calls = []
+
+    def fn():
+        calls.append(1)
+        raise ValueError("bad request")
+
+    with pytest.raises(ValueError):
+        scheduler.call("sk-a", fn)
+    assert len(calls) == 1
+    (stats,) = scheduler.stats().values()
+    assert stats["in_flight"] == 0
+    assert stats["completed"] == 0
+
+
+def test_tenants_are_admitted_round_robin():
+    scheduler = RateScheduler(max_concurrency=1)
+    release = threading.Event()
+    order = []
+
+    def call(tenant, name):
+        scheduler.call("sk-a", lambda: order.append(name), tenant=tenant)
+
+    blocker = threading.Thread(
+        target=scheduler.call, args=("sk-a", release.wait), kwargs=dict(tenant="c")
+    )
+    blocker.start()
+    wait_until(lambda: key_stats(scheduler)["in_flight"] == 1)
+
+    threads = []
+    for tenant, name in (("a", "a1"), ("a", "a2"), ("a", "a3"), ("b", "b1")):
+        thread = threading.Thread(target=call, args=(tenant, name))
+        thread.start()
+        threads.append(thread)
+        queued = len(threads)
+        wait_until(lambda: key_stats(scheduler)["queued"] == queued)
+
+    release.set()
+    for thread in [blocker] + threads:
+        thread.join(timeout=5)
+    assert order == ["a1", "b1", "a2", "a3"]
+
+
+def test_keys_have_separate_budgets():
+    scheduler = RateScheduler()
+    scheduler.configure("sk-free", rpm=1)
+    scheduler.call("sk-free", lambda: None)
+    start = time.monotonic()
+    scheduler.call("sk-user", lambda: None)
+    assert time.monotonic() - start < 1
+    assert len(scheduler.stats()) == 2
@@ -17,7 +17,16 @@ Some common utilities
 """
 
 import base64
+import copy
 import hashlib
+import io
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Callable, Optional
+
 import requests
 
 import pandas as pd
@@ -25,6 +34,20 @@ import streamlit as st
 from streamlit import runtime
 from streamlit.runtime.scriptrunner import get_script_run_ctx
 
+from cache import DiskCache
+from ocr_client import CircuitOpenError, MultipartStream, OCRClient, default_client
+from chunking import PAGE_BREAK
+from image import ImagePreprocessor
+from metrics import ERRORS, STAGE_SECONDS
+from pdf import extract_document_text_layer, extract_text_layer, split_pdf
+from pipeline import SingleFlight
+
+HASH_BLOCK_SIZE = 1024 * 1024
+OCR_FLIGHT_TIMEOUT = 900.0
+
+ocr_flight = SingleFlight("ocr", timeout=OCR_FLIGHT_TIMEOUT)
+logger = logging.getLogger(__name__)
+
 
 def displayPDF(file):
     # Opening file from file path
@@ -62,45 +85,471 @@ def build_schema(field_values: list, dtype_values: list, required: list) -> dict
     return res
 
 
-# @lru_cache(maxsize=32)
+def canonical_schema(schema: dict) -> str:
+    """Serializes a schema independent of the order of its fields
+
+    Args:
+        schema (dict): Schema built by `build_schema`
+
+    Returns:
+        str: Canonical JSON representation of the schema
+    """
+    canonical = dict(schema)
+    canonical["required"] = sorted(schema.get("required", []))
+    return json.dumps(canonical, sort_keys=True, separators=(",", ":"))
+
+
+def diff_schema(old: dict, new: dict) -> tuple:
+    """Compares two schemas built by `build_schema`
+
+    Args:
+        old (dict): Schema of the previous analysis
+        new (dict): Schema of the upcoming analysis
+
+    Returns:
+        tuple: Schema with only the properties that were added or whose type
+        or required flag changed, and the list of removed properties
+    """
+    old_required = set(old.get("required", []))
+    new_required = set(new.get("required", []))
+
+    changed = dict(properties=dict(), required=list())
+    for field, spec in new["properties"].items():
+        if (
+            field not in old["properties"]
+            or old["properties"][field] != spec
+            or (field in old_required) != (field in new_required)
+        ):
+            changed["properties"][field] = spec
+            if field in new_required:
+                changed["required"].append(field)
+
+    removed = [field for field in old["properties"] if field not in new["properties"]]
+    return changed, removed
+
+
+def merge_fields(rows: list, new_rows: list, fields: list, removed: list) -> list:
+    """Merges re-extracted fields into previously extracted entities
+
+    Entities are matched by position. Removed fields are dropped, entities
+    without a counterpart in `new_rows` get None for the re-extracted fields
+    and additional new entities are appended.
+
+    Args:
+        rows (list): Entities of the previous analysis
+        new_rows (list): Entities extracted for the changed fields only
+        fields (list): Fields that were re-extracted
+        removed (list): Fields that are no longer part of the schema
+
+    Returns:
+        list: Merged entities
+    """
+    merged = []
+    for idx in range(max(len(rows), len(new_rows))):
+        row = dict(rows[idx]) if idx < len(rows) else dict()
+        for field in removed:
+            row.pop(field, None)
+        if fields:
+            new_row = new_rows[idx] if idx < len(new_rows) else dict()
+            row.update({field: new_row.get(field) for field in fields})
+        merged.append(row)
+
+    return merged
+
+
 def get_ocr_response(
-    url: str, payload: dict, headers: dict, files: list, file_hash: str
-) -> requests.Response:
+    url: str,
+    payload: dict,
+    headers: dict,
+    files: list,
+    file_hash: str,
+    cache: Optional[DiskCache] = None,
+    client: Optional[OCRClient] = None,
+    prepare: Optional[Callable[[], tuple]] = None,
+) -> Optional[dict]:
     """Get OCR Output from either cache or the OCR service
 
     Args:
-        url (str): _description_
-        payload (dict): _description_
-        headers (dict): _description_
-        files (list): _description_
+        url (str): OCR service endpoint
+        payload (dict): Form fields sent along with the file
+        headers (dict): Request headers
+        files (list): Files to be uploaded
+        file_hash (str): Hash of the uploaded file, used as the cache key
+        cache (DiskCache, optional): Store for OCR results
+        client (OCRClient, optional): Client used to call the OCR service,
+            defaults to the process wide client
+        prepare (Callable, optional): Called on a cache miss only, returns
+            the files to upload instead of `files` and metadata to be added
+            to the result
 
     Returns:
-        requests.Response: _description_
+        Optional[dict]: OCR text and metadata or None if the OCR service failed
     """
+    if cache is not None:
+        cached = cache.get(file_hash)
+        if cached is not None:
+            return cached
 
-    @st.cache_resource
-    def cached_ocr_request(file_hash: str) -> requests.Response:
-        resp = requests.request(
-            "POST", url, headers=headers, data=payload, files=files, timeout=None
+    # Sessions uploading the same file at the same time share one request
+    try:
+        result, leader = ocr_flight.do(
+            file_hash,
+            _request_ocr,
+            url,
+            payload,
+            headers,
+            files,
+            file_hash,
+            cache,
+            client,
+            prepare,
+        )
+    except FutureTimeoutError:
+        ERRORS.inc(stage="ocr_request")
+        logger.warning("Timed out waiting for the OCR of %s", file_hash)
+        return None
+
+    return result if leader else copy.deepcopy(result)
+
+
+def _request_ocr(
+    url: str,
+    payload: dict,
+    headers: dict,
+    files: list,
+    file_hash: str,
+    cache: Optional[DiskCache],
+    client: Optional[OCRClient],
+    prepare: Optional[Callable[[], tuple]] = None,
+) -> Optional[dict]:
+    client = client or default_client()
+    extra = {}
+    if prepare is not None:
+        files, extra = prepare()
+    body = MultipartStream(fields=payload, files=files)
+    endpoint = url.rsplit("/", 1)[-1]
+    start = time.perf_counter()
+    try:
+        resp = client.post(url, body=body, headers=headers)
+    except (requests.RequestException, CircuitOpenError) as e:
+        ERRORS.inc(stage="ocr_request")
+        logger.warning("OCR request to %s failed: %s", url, e)
+        return None
+    finally:
+        ocr_seconds = time.perf_counter() - start
+        STAGE_SECONDS.observe(ocr_seconds, stage="ocr_request")
+
+    if resp.status_code != 200:
+        ERRORS.inc(stage="ocr_request")
+        logger.warning("OCR request to %s returned HTTP %s", url, resp.status_code)
+        return None
+
+    with STAGE_SECONDS.time(stage="json_decode"):
+        text = json.loads(resp.text)["text"]
+
+    result = dict(
+        text=text,
+        metadata=dict(
+            endpoint=endpoint,
+            ocr_seconds=ocr_seconds,
+            created_at=time.time(),
+            **extra,
+        ),
+    )
+    if cache is not None:
+        cache.set(file_hash, result)
+
+    return result
+
+
+def ocr_file(
+    file_name: str,
+    file_obj,
+    base_url: str,
+    pdf_endpoint: str,
+    img_endpoint: str,
+    cache: Optional[DiskCache] = None,
+    split_pages: bool = False,
+    page_workers: int = 4,
+    client: Optional[OCRClient] = None,
+    text_layer: bool = False,
+    preprocessor: Optional[ImagePreprocessor] = None,
+) -> Optional[dict]:
+    """Run OCR on a PDF or image file
+
+    Args:
+        file_name (str): Name of the file, its extension selects the endpoint
+        file_obj (BinaryIO): Readable and seekable file object
+        base_url (str): Host and port of the OCR service
+        pdf_endpoint (str): Endpoint used for PDF files
+        img_endpoint (str): Endpoint used for images
+        cache (DiskCache, optional): Store for OCR results
+        split_pages (bool): OCR the pages of PDF files individually, see
+            `ocr_pdf_pages`
+        page_workers (int): Maximum number of concurrent page OCR calls
+        client (OCRClient, optional): Client used to call the OCR service
+        text_layer (bool): Read the embedded text of born-digital PDF pages
+            locally; with `split_pages` only the pages that need it are OCRed,
+            otherwise the whole file is OCRed unless every page has a usable
+            text layer, see `read_text_layer`
+        preprocessor (ImagePreprocessor, optional): Shrinks images before
+            they are uploaded, the cache stays keyed by the original file
+
+    Returns:
+        Optional[dict]: OCR text and metadata or None if the OCR service failed
+    """
+    if file_obj.tell() > 0:
+        file_obj.seek(0)
+
+    file_hash = generate_hash(file_obj)
+    file_obj.seek(0)
+
+    byte_type: str = file_name.split(".")[-1].lower()
+
+    if byte_type == "pdf":
+        url: str = base_url + "/" + pdf_endpoint
+        content_type = "application/pdf"
+        if split_pages:
+            return ocr_pdf_pages(
+                file_name=file_name,
+                file_obj=file_obj,
+                url=url,
+                file_hash=file_hash,
+                cache=cache,
+                page_workers=page_workers,
+                client=client,
+                text_layer=text_layer,
+            )
+        if text_layer:
+            result = read_text_layer(file_obj, url, file_hash, cache=cache)
+            if result is not None:
+                return result
+    else:
+        url = base_url + "/" + img_endpoint
+        content_type = f"image/{byte_type}"
+
+    files = [("file", (file_name, file_obj, content_type))]
+    payload = {}
+    headers = {}
+
+    def prepare_image() -> tuple:
+        with STAGE_SECONDS.time(stage="image_preprocess"):
+            processed = preprocessor.process(file_obj)
+        if processed is None:
+            return files, {}
+        data, stats = processed
+        name = file_name.rsplit(".", 1)[0] + ".jpg"
+        return [("file", (name, io.BytesIO(data), "image/jpeg"))], dict(image=stats)
+
+    return get_ocr_response(
+        url=url,
+        payload=payload,
+        files=files,
+        headers=headers,
+        file_hash=file_hash,
+        cache=cache,
+        client=client,
+        prepare=(
+            prepare_image if byte_type != "pdf" and preprocessor is not None else None
+        ),
+    )
+
+
+def read_text_layer(
+    file_obj,
+    url: str,
+    file_hash: str,
+    cache: Optional[DiskCache] = None,
+    min_text_chars: int = 20,
+) -> Optional[dict]:
+    """Reads a born-digital PDF from its text layer without OCR
+
+    Args:
+        file_obj (BinaryIO): Readable and seekable PDF file object
+        url (str): OCR service endpoint for PDFs, recorded in the metadata
+        file_hash (str): Hash of the whole file
+        cache (DiskCache, optional): Store for OCR results
+        min_text_chars (int): Minimum number of characters of a usable text
+            layer
+
+    Returns:
+        Optional[dict]: Text and metadata in the format of the OCR service, or
+        None if any page needs OCR
+    """
+    if cache is not None:
+        cached = cache.get(file_hash)
+        if cached is not None:
+            return cached
+
+    start = time.perf_counter()
+    texts = extract_document_text_layer(file_obj, min_chars=min_text_chars)
+    if texts is None:
+        return None
+
+    file_obj.seek(0, io.SEEK_END)
+    size = file_obj.tell()
+    file_obj.seek(0)
+    result = dict(
+        text=PAGE_BREAK.join(texts),
+        metadata=dict(
+            endpoint=url.rsplit("/", 1)[-1],
+            ocr_seconds=time.perf_counter() - start,
+            created_at=time.time(),
+            pages=len(texts),
+            page_sources=["text_layer"] * len(texts),
+            text_layer_pages=len(texts),
+            cached_pages=0,
+            ocr_pages=0,
+            ocr_bytes_avoided=size,
+        ),
+    )
+    if cache is not None:
+        cache.set(file_hash, result)
+
+    return result
+
+
+def ocr_pdf_pages(
+    file_name: str,
+    file_obj,
+    url: str,
+    file_hash: str,
+    cache: Optional[DiskCache] = None,
+    page_workers: int = 4,
+    client: Optional[OCRClient] = None,
+    text_layer: bool = False,
+    min_text_chars: int = 20,
+) -> Optional[dict]:
+    """Run OCR on the pages of a PDF concurrently
+
+    The PDF is split locally and every page is cached under its own hash, so
+    a document that shares pages with an earlier one only pays for the pages
+    that changed. With `text_layer` the embedded text of born-digital pages is
+    used directly and only image-only pages are sent to the OCR service. The
+    page texts are joined with form feeds in page order and the metadata
+    records where the text of every page came from.
+
+    Args:
+        file_name (str): Name of the file
+        file_obj (BinaryIO): Readable and seekable PDF file object
+        url (str): OCR service endpoint for PDFs
+        file_hash (str): Hash of the whole file
+        cache (DiskCache, optional): Store for OCR results
+        page_workers (int): Maximum number of concurrent page OCR calls
+        client (OCRClient, optional): Client used to call the OCR service
+        text_layer (bool): Use the embedded text of pages that have one
+        min_text_chars (int): Minimum number of characters of a usable text
+            layer
+
+    Returns:
+        Optional[dict]: OCR text and metadata or None if the OCR of any page
+        failed
+    """
+    if cache is not None:
+        cached = cache.get(file_hash)
+        if cached is not None:
+            return cached
+
+    start = time.perf_counter()
+    pages = split_pdf(file_obj)
+    stem = file_name.rsplit(".", 1)[0]
+
+    def ocr_page(page_no: int, page: bytes) -> tuple:
+        if text_layer:
+            text = extract_text_layer(page, min_chars=min_text_chars)
+            if text is not None:
+                return dict(text=text), "text_layer"
+
+        page_hash = generate_hash(page)
+        if cache is not None:
+            cached = cache.get(page_hash)
+            if cached is not None:
+                return cached, "cache"
+
+        files = [
+            ("file", (f"{stem}_{page_no + 1}.pdf", io.BytesIO(page), "application/pdf"))
+        ]
+        result = get_ocr_response(
+            url=url,
+            payload={},
+            headers={},
+            files=files,
+            file_hash=page_hash,
+            client=client,
         )
-        return resp
+        if result is not None and cache is not None:
+            cache.set(page_hash, result)
+        return result, "ocr"
 
-    resp = cached_ocr_request(file_hash)
-    # print(file_hash)
-    # print(cached_ocr_request.cache_info())
-    return resp
+    with ThreadPoolExecutor(
+        max_workers=max(1, min(page_workers, len(pages) or 1)),
+        thread_name_prefix="ocr_page",
+    ) as pool:
+        results = list(pool.map(ocr_page, range(len(pages)), pages))
 
+    if any(page_result is None for page_result, _ in results):
+        return None
 
-def generate_hash(file_bytes: bytes) -> str:
+    page_sources = [source for _, source in results]
+    result = dict(
+        text=PAGE_BREAK.join(page_result["text"] for page_result, _ in results),
+        metadata=dict(
+            endpoint=url.rsplit("/", 1)[-1],
+            ocr_seconds=time.perf_counter() - start,
+            created_at=time.time(),
+            pages=len(pages),
+            page_sources=page_sources,
+            text_layer_pages=page_sources.count("text_layer"),
+            cached_pages=page_sources.count("cache"),
+            ocr_pages=page_sources.count("ocr"),
+            ocr_bytes_avoided=sum(
+                len(page)
+                for page, source in zip(pages, page_sources)
+                if source == "text_layer"
+            ),
+        ),
+    )
+    if cache is not None:
+        cache.set(file_hash, result)
+
+    return result
+
+
+def generate_hash(file_bytes, block_size: int = HASH_BLOCK_SIZE) -> str:
     """Generates hash from bytes
 
+    The data is hashed incrementally in fixed-size blocks, so hashing a file
+    object never holds more than one block in memory.
+
     Args:
-        file_bytes (bytes): _description_
+        file_bytes (bytes | BinaryIO): Bytes-like object or a readable file
+            object, which is read from its current position to the end
+        block_size (int): Number of bytes hashed at a time
 
     Returns:
-        str: _description_
+        str: SHA-256 hex digest
     """
-    return hashlib.sha256(file_bytes).hexdigest()
+    digest = hashlib.sha256()
+
+    if hasattr(file_bytes, "readinto"):
+        buffer = bytearray(block_size)
+        view = memoryview(buffer)
+        while True:
+            size = file_bytes.readinto(buffer)
+            if not size:
+                break
+            digest.update(view[:size])
+        return digest.hexdigest()
+
+    if hasattr(file_bytes, "read"):
+        for block in iter(lambda: file_bytes.read(block_size), b""):
+            digest.update(block)
+        return digest.hexdigest()
+
+    view = memoryview(file_bytes)
+    for offset in range(0, len(view), block_size):
+        digest.update(view[offset : offset + block_size])
+    return digest.hexdigest()
 
 
 def get_remote_ip() -> str:
@@ -0,0 +1,89 @@
+# Copyright 2023 Aditya Mohan
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Validation of extracted entities against their schema
+"""
+
+_TYPES = {
+    "string": (str,),
+    "integer": (int,),
+    "number": (int, float),
+    "boolean": (bool,),
+}
+
+
+def _filled(value) -> bool:
+    return value is not None and not (isinstance(value, str) and not value.strip())
+
+
+def missing_required(output: list, schema: dict) -> list:
+    """Required fields without a value in any extracted entity
+
+    Args:
+        output (list): Extracted entities
+        schema (dict): Schema built by `build_schema`
+
+    Returns:
+        list: Names of the missing fields
+    """
+    return [
+        field
+        for field in schema.get("required", [])
+        if not any(_filled(entity.get(field)) for entity in output or [])
+    ]
+
+
+def type_mismatches(output: list, schema: dict) -> list:
+    """Fields with a value that does not match the type of the schema
+
+    Args:
+        output (list): Extracted entities
+        schema (dict): Schema built by `build_schema`
+
+    Returns:
+        list: Names of the fields, in schema order
+    """
+    mismatched = []
+    for field, spec in schema["properties"].items():
+        types = _TYPES.get(spec.get("type"))
+        if types is None:
+            continue
+        for entity in output or []:
+            value = entity.get(field)
+            if value is None:
+                continue
+            # bool is an int subclass but never a valid integer here
+            if not isinstance(value, types) or (
+                isinstance(value, bool) and bool not in types
+            ):
+                mismatched.append(field)
+                break
+    return mismatched
+
+
+def validate_output(output: list, schema: dict) -> list:
+    """Problems of an extraction result
+
+    Args:
+        output (list): Extracted entities
+        schema (dict): Schema built by `build_schema`
+
+    Returns:
+        list: (field, reason) tuples, reason being "missing" or "type", empty
+        if the output is valid
+    """
+    return [(field, "missing") for field in missing_required(output, schema)] + [
+        (field, "type") for field in type_mismatches(output, schema)
+    ]